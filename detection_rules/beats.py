@@ -4,9 +4,13 @@
 # 2.0.
 
 """ECS Schemas management."""
+import multiprocessing
 import os
 import re
-from typing import List, Optional
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Tuple
 
 import kql
 import eql
@@ -14,8 +18,14 @@ import json
 import requests
 import yaml
 
+from .schema_artifacts import artifacts_enabled
 from .semver import Version
-from .utils import DateTimeEncoder, unzip, get_etc_path, gzip_compress, read_gzip, cached
+from .utils import DateTimeEncoder, unzip, get_cache_path, get_etc_path, gzip_compress, hash_files, read_gzip, cached
+
+BEATS_SHARDS_DIR = Path(get_cache_path("beats_schemas"))
+BEATS_CACHE_SIZE = 8
+BEATS_SHARD_CACHE_SIZE = 256
+BEATS_SCHEMA_CACHE_SIZE = 128
 
 
 def _decompress_and_save_schema(url, release_name):
@@ -196,10 +206,10 @@ def get_max_version() -> str:
     return str(max(get_versions()))
 
 
-@cached
-def read_beats_schema(version: str = None):
+def get_schema_file(version: str = None) -> str:
+    """Get the path to the beats schema of a version, where `master` is the master schema and None the latest."""
     if version and version.lower() == 'master':
-        return json.loads(read_gzip(get_etc_path('beats_schemas', 'master.json.gz')))
+        return get_etc_path('beats_schemas', 'master.json.gz')
 
     version = Version(version) if version else None
     beats_schemas = get_versions()
@@ -209,25 +219,197 @@ def read_beats_schema(version: str = None):
 
     version = version or get_max_version()
 
-    return json.loads(read_gzip(get_etc_path('beats_schemas', f'v{version}.json.gz')))
+    return get_etc_path('beats_schemas', f'v{version}.json.gz')
 
 
-def get_schema_from_datasets(beats, modules, datasets, version=None):
-    filtered = {}
-    beats_schema = read_beats_schema(version=version)
+@cached(maxsize=BEATS_CACHE_SIZE)
+def read_beats_schema(version: str = None):
+    return json.loads(read_gzip(get_schema_file(version)))
+
+
+def _write_shard(path: Path, contents):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(gzip_compress(json.dumps(contents)))
+
+
+def build_beats_shards(version: str = None, directory: Path = BEATS_SHARDS_DIR) -> Path:
+    """Split the beats schema of a version into the fields of each beat and each of its modules.
+
+    Shards are saved as <beat>.json.gz, with the fields at the root of the beat, and <beat>/<module>.json.gz, with the
+    fields of the module and each of its datasets, along with an index.json of the modules in each beat.
+    """
+    schema_file = get_schema_file(version)
+    shard_dir = Path(directory) / os.path.basename(schema_file).split('.json')[0]
+    beats_schema = json.loads(read_gzip(schema_file))
+    index = {'source_hash': hash_files([schema_file]), 'beats': {}}
+
+    def get_fields(directory, prefix=""):
+        try:
+            return get_field_schema(directory, prefix=prefix, include_common=True)
+        except KeyError:
+            # a few fields.yml files are malformed, which is only an error if a rule uses them
+            return None
+
+    # build in a temp folder which replaces the shards at once, so that readers never see a partial set of shards
+    shard_dir.parent.mkdir(parents=True, exist_ok=True)
+    temp_dir = Path(tempfile.mkdtemp(dir=shard_dir.parent, suffix='.tmp'))
+
+    try:
+        for beat, beat_dir in beats_schema.items():
+            module_dirs = beat_dir.get("folders", {}).get("module", {}).get("folders", {})
+            index['beats'][beat] = sorted(module_dirs)
+            _write_shard(temp_dir / f'{beat}.json.gz', get_fields(beat_dir))
+
+            for module, module_dir in module_dirs.items():
+                datasets = {dataset: get_fields(dataset_dir, prefix=module + ".")
+                            for dataset, dataset_dir in module_dir.get("folders", {}).items()}
+                module_shard = {'fields': get_fields(module_dir), 'datasets': datasets}
+                _write_shard(temp_dir / beat / f'{module}.json.gz', module_shard)
+
+        (temp_dir / 'index.json').write_text(json.dumps(index, sort_keys=True))
+
+        try:
+            if shard_dir.exists():
+                # a folder can only be renamed over an empty one, so the stale shards are moved aside first
+                stale_dir = temp_dir.with_suffix('.stale')
+                os.replace(shard_dir, stale_dir)
+                shutil.rmtree(stale_dir, ignore_errors=True)
+
+            os.replace(temp_dir, shard_dir)
+        except OSError:
+            # another process replaced the stale shards first
+            if not (shard_dir / 'index.json').exists():
+                raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return shard_dir
+
+
+def _load_beats_shards(version: str = None) -> Optional[Tuple[Path, dict]]:
+    schema_file = get_schema_file(version)
+    shard_dir = BEATS_SHARDS_DIR / os.path.basename(schema_file).split('.json')[0]
+
+    try:
+        index = json.loads((shard_dir / 'index.json').read_text())
+        if index.get('source_hash') == hash_files([schema_file]):
+            return shard_dir, index
+    except (OSError, ValueError):
+        pass
+
+
+@cached(maxsize=BEATS_CACHE_SIZE)
+def get_beats_shards(version: str = None) -> Optional[Tuple[Path, dict]]:
+    """Get the shard directory and index of a beats version, building them first if they are missing or stale.
+
+    Worker processes never build shards, which is left to the parent with prepare_beats_shards before they start.
+    """
+    if not artifacts_enabled():
+        return
+
+    shards = _load_beats_shards(version)
+    if shards is not None or multiprocessing.parent_process() is not None:
+        return shards
+
+    try:
+        build_beats_shards(version)
+    except OSError:
+        # an unwritable cache falls back to the full schema
+        return
+
+    return _load_beats_shards(version)
+
+
+def prepare_beats_shards():
+    """Build the missing or stale shards of every beats version that rules in this package are validated against."""
+    from .schemas import get_stack_schemas
+
+    if not artifacts_enabled():
+        return
+
+    for version in sorted({m['beats'] for m in get_stack_schemas('0.0.0').values()}):
+        get_beats_shards(version)
+
+
+@cached(maxsize=BEATS_SHARD_CACHE_SIZE)
+def read_beats_shard(path: Path):
+    return json.loads(read_gzip(path))
+
+
+def _check_shard_fields(fields: Optional[list], *path: str) -> list:
+    if fields is None:
+        raise KeyError(f"Malformed beats schema for {'.'.join(path)}")
+
+    return fields
+
+
+def get_sharded_root_schema(shards: Tuple[Path, dict], beat: str) -> dict:
+    """Get the same fields as get_beat_root_schema, reading only the shard of the beat."""
+    shard_dir, index = shards
+    if beat not in index['beats']:
+        raise KeyError(f"Unknown beats module {beat}")
 
+    flattened = _check_shard_fields(read_beats_shard(shard_dir / f'{beat}.json.gz'), beat)
+    return {field["name"]: field for field in sorted(flattened, key=lambda f: f["name"])}
+
+
+def get_sharded_sub_schema(shards: Tuple[Path, dict], beat: str, module: str, *datasets: str) -> dict:
+    """Get the same fields as get_beats_sub_schema, reading only the shard of the module."""
+    shard_dir, index = shards
+    if beat not in index['beats']:
+        raise KeyError(f"Unknown beats module {beat}")
+
+    if module in index['beats'][beat]:
+        module_shard = read_beats_shard(shard_dir / beat / f'{module}.json.gz')
+    else:
+        module_shard = {'fields': [], 'datasets': {}}
+
+    # if we only have a module then we'll work with what we got
+    if not datasets:
+        datasets = [d for d in module_shard['datasets'] if not d.startswith("_")]
+
+    flattened = []
+    for dataset in datasets:
+        # replace aws.s3 -> s3
+        if dataset.startswith(module + "."):
+            dataset = dataset[len(module) + 1:]
+
+        flattened.extend(_check_shard_fields(module_shard['datasets'].get(dataset, []), beat, module, dataset))
+
+    flattened.extend(_check_shard_fields(module_shard['fields'], beat, module))
+    return {field["name"]: field for field in sorted(flattened, key=lambda f: f["name"])}
+
+
+def get_schema_from_datasets(beats, modules, datasets, version=None):
     # infer the module if only a dataset are defined
     if not modules:
         modules.update(ds.split(".")[0] for ds in datasets if "." in ds)
 
+    # the same schema object is returned for the same fields, so that schemas built from it can be cached by identity
+    return _get_schema_from_datasets(tuple(beats), tuple(sorted(modules, key=str)), tuple(sorted(datasets, key=str)),
+                                     version=version)
+
+
+@cached(maxsize=BEATS_SCHEMA_CACHE_SIZE)
+def _get_schema_from_datasets(beats: tuple, modules: tuple, datasets: tuple, version=None) -> dict:
+    filtered = {}
+    shards = get_beats_shards(version=version)
+    beats_schema = read_beats_schema(version=version) if shards is None else None
+
     for beat in beats:
         # if no modules are specified then grab them all
         # all_modules = list(beats_schema.get(beat, {}).get("folders", {}).get("module", {}).get("folders", {}))
         # beat_modules = modules or all_modules
-        filtered.update(get_beat_root_schema(beats_schema, beat))
+        if shards is not None:
+            filtered.update(get_sharded_root_schema(shards, beat))
+        else:
+            filtered.update(get_beat_root_schema(beats_schema, beat))
 
         for module in modules:
-            filtered.update(get_beats_sub_schema(beats_schema, beat, module, *datasets))
+            if shards is not None:
+                filtered.update(get_sharded_sub_schema(shards, beat, module, *datasets))
+            else:
+                filtered.update(get_beats_sub_schema(beats_schema, beat, module, *datasets))
 
     return filtered
 
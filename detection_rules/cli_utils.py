@@ -17,7 +17,9 @@ import functools
 from . import ecs
 from .attack import matrix, tactics, build_threat_map_entry
 from .rule import TOMLRule, TOMLRuleContents
-from .rule_loader import RuleCollection, DEFAULT_RULES_DIR, dict_filter
+from .rule_cache import default_cache
+from .rule_index import RuleIndex
+from .rule_loader import RuleCollection
 from .schemas import definitions
 from .utils import clear_caches, get_path
 
@@ -37,7 +39,7 @@ def single_collection(f):
         rule_files: List[str] = kwargs.pop("rule_file")
         directories: List[str] = kwargs.pop("directory")
 
-        rules = RuleCollection()
+        rules = RuleCollection(cache=default_cache())
 
         if bool(rule_name) + bool(rule_id) + bool(rule_files) != 1:
             client_error('Required: exactly one of --rule-id, --rule-file, or --directory')
@@ -46,7 +48,7 @@ def single_collection(f):
         rules.load_directories(Path(d) for d in directories)
 
         if rule_id:
-            rules.load_directory(DEFAULT_RULES_DIR, toml_filter=dict_filter(rule__rule_id=rule_id))
+            rules.load_files(RuleIndex.default().get_paths(rule_ids=[rule_id]))
 
             if len(rules) != 1:
                 client_error(f"Could not find rule with ID {rule_id}")
@@ -71,7 +73,7 @@ def multi_collection(f):
         rule_files: List[str] = kwargs.pop("rule_file")
         directories: List[str] = kwargs.pop("directory")
 
-        rules = RuleCollection()
+        rules = RuleCollection(cache=default_cache())
 
         if not (directories or rule_id or rule_files):
             client_error('Required: at least one of --rule-id, --rule-file, or --directory')
@@ -80,7 +82,7 @@ def multi_collection(f):
         rules.load_directories(Path(d) for d in directories)
 
         if rule_id:
-            rules.load_directory(DEFAULT_RULES_DIR, toml_filter=dict_filter(rule__rule_id=rule_id))
+            rules.load_files(RuleIndex.default().get_paths(rule_ids=rule_id))
             found_ids = {rule.id for rule in rules}
             missing = set(rule_id).difference(found_ids)
 
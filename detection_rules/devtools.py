@@ -32,7 +32,7 @@ from .misc import PYTHON_LICENSE, add_client, client_error
 from .packaging import PACKAGE_FILE, Package, RELEASE_DIR, current_stack_version
 from .version_lock import default_version_lock
 from .rule import AnyRuleData, BaseRuleData, QueryRuleData, TOMLRule
-from .rule_loader import RuleCollection, production_filter
+from .rule_loader import RuleCollection, RuleStore, production_filter
 from .schemas import definitions
 from .semver import Version
 from .utils import dict_hash, get_path, load_dump
@@ -98,15 +98,15 @@ def build_integration_docs(ctx: click.Context, registry_version: str, pre: str,
         if not click.confirm(f'This will refresh tags and may overwrite local tags for: {pre} and {post}. Continue?'):
             ctx.exit(1)
 
-    pre_rules = RuleCollection()
-    pre_rules.load_git_tag(pre, remote, skip_query_validation=True)
+    # rules unchanged between the tags are only parsed once
+    store = RuleStore()
+    pre_rules = store.load_git_tag(pre, remote, skip_query_validation=True)
 
     if pre_rules.errors:
         click.echo(f'error loading {len(pre_rules.errors)} rule(s) from: {pre}, skipping:')
         click.echo(' - ' + '\n - '.join([str(p) for p in pre_rules.errors]))
 
-    post_rules = RuleCollection()
-    post_rules.load_git_tag(post, remote, skip_query_validation=True)
+    post_rules = store.load_git_tag(post, remote, skip_query_validation=True)
 
     if post_rules.errors:
         click.echo(f'error loading {len(post_rules.errors)} rule(s) from: {post}, skipping:')
@@ -732,6 +732,27 @@ def update_schemas():
         cls.save_schema()
 
 
+@dev_group.command('build-schema-artifacts')
+@click.option('--directory', '-d', type=click.Path(file_okay=False), default=None,
+              help='Directory to save artifacts to (default: .cache/schemas and .cache/beats_schemas)')
+def build_schema_artifacts(directory):
+    """Precompile ECS schemas to memory-mapped field tables and split beats schemas by beat and module."""
+    from .beats import BEATS_SHARDS_DIR, build_beats_shards, get_versions
+    from .ecs import build_schema_artifact, get_schema_map
+    from .schema_artifacts import SCHEMA_ARTIFACTS_DIR
+
+    for version in sorted(get_schema_map()):
+        path = build_schema_artifact(version, directory=Path(directory or SCHEMA_ARTIFACTS_DIR))
+        click.echo(f'Saved {path} ({path.stat().st_size / 1024:.1f} KiB)')
+
+    for version in sorted(get_versions()) + ['master']:
+        path = build_beats_shards(str(version), directory=Path(directory or BEATS_SHARDS_DIR))
+        click.echo(f'Saved beats shards to {path}')
+
+    # artifacts opened before they were (re)built are stale
+    utils.clear_caches()
+
+
 @dev_group.group('test')
 def test_group():
     """Commands for testing against stack resources."""
@@ -872,3 +893,388 @@ def rule_survey(ctx: click.Context, query, date_range, dump_file, hide_zero_coun
         json.dump(details, f, indent=2, sort_keys=True)
 
     return survey_results
+
+
+@dev_group.command('watch')
+@click.option('--directory', '-d', multiple=True, type=click.Path(file_okay=False, exists=True),
+              help='Directories of rules to watch (default: rules/)')
+@click.option('--interval', '-i', type=click.FloatRange(0.1), default=1.0, help='Seconds between checks for changes')
+def watch_rules(directory, interval):
+    """Watch rule directories and re-validate rules as they are saved."""
+    from .rule_cache import default_cache
+
+    rules = RuleCollection(cache=default_cache())
+
+    for rules_dir in directory or [RULES_DIR]:
+        rules.watch_directory(Path(rules_dir))
+
+    click.echo(f'Watching {len(rules)} rules and {len(rules.deprecated)} deprecated rules (Ctrl+C to stop)')
+    for path, error in rules.errors.items():
+        click.secho(f'error: {path}\n{error}', fg='red', err=True)
+
+    try:
+        while True:
+            time.sleep(interval)
+
+            for change in rules.reload_changes():
+                status = click.style('error', fg='red') if change.error else click.style('ok', fg='green')
+                click.echo(f'[{status}] {change.status} {change.path} ({change.elapsed * 1000:.0f}ms)')
+
+                if change.error:
+                    click.secho(str(change.error), fg='red', err=True)
+    except KeyboardInterrupt:
+        pass
+
+
+@dev_group.group('benchmark')
+def benchmark_group():
+    """Commands for benchmarking rule loading and validation."""
+
+
+@benchmark_group.command('rule-loading')
+@click.option('--directory', '-d', type=click.Path(file_okay=False, exists=True), default=RULES_DIR,
+              help='Directory of rules to load')
+@click.option('--processes', '-p', type=click.IntRange(2), default=max(2, os.cpu_count() or 1),
+              help='Number of processes for the parallel load')
+def benchmark_rule_loading(directory, processes):
+    """Compare serial and parallel load times of a rules directory."""
+    from .rule_validators import schema_validation_counts
+
+    original = os.environ.get('DR_VALIDATION_CACHE')
+    timings = {}
+
+    try:
+        # validate every query, rather than reusing the outcomes saved by previous runs
+        os.environ['DR_VALIDATION_CACHE'] = 'false'
+
+        for mode, process_count in (('serial', 1), ('parallel', processes)):
+            # start each run cold, so that schemas aren't already cached by the previous one
+            utils.clear_caches()
+            schema_validation_counts.clear()
+            rules = RuleCollection()
+
+            start = time.perf_counter()
+            rules.load_directory(Path(directory), processes=process_count)
+            timings[mode] = time.perf_counter() - start
+
+            click.echo(f'{mode} ({process_count} process(es)): loaded {len(rules)} rules and '
+                       f'{len(rules.deprecated)} deprecated rules in {timings[mode]:.2f}s')
+
+            if process_count == 1:
+                # validations in worker processes aren't counted
+                click.echo(f' - checked queries against {schema_validation_counts["validated"]} schemas, skipping '
+                           f'{schema_validation_counts["skipped"]} stack versions with identical schemas')
+    finally:
+        if original is None:
+            os.environ.pop('DR_VALIDATION_CACHE', None)
+        else:
+            os.environ['DR_VALIDATION_CACHE'] = original
+
+    click.echo(f'speedup: {timings["serial"] / timings["parallel"]:.2f}x')
+    return timings
+
+
+@benchmark_group.command('git-loading')
+@click.option('--ref', '-r', default='HEAD', help='Git tag, branch or commit to read rules from')
+def benchmark_git_loading(ref):
+    """Compare reading rules from git one process per file against a single batched process."""
+    rules_dir = os.path.relpath(RULES_DIR, get_path())
+    blobs = {path: object_id for path, object_id in utils.git_ls_blobs(ref, rules_dir).items()
+             if path.endswith('.toml')}
+    git = utils.make_git()
+
+    start = time.perf_counter()
+    for path in blobs:
+        git('show', f'{ref}:{path}')
+    per_file = time.perf_counter() - start
+    click.echo(f'git show per file: read {len(blobs)} rules in {per_file:.2f}s')
+
+    start = time.perf_counter()
+    contents = dict(utils.read_git_blobs(set(blobs.values())))
+    batched = time.perf_counter() - start
+    click.echo(f'git cat-file --batch: read {len(contents)} rules in {batched:.2f}s')
+
+    click.echo(f'speedup: {per_file / batched:.2f}x')
+    return per_file, batched
+
+
+@benchmark_group.command('schema-loading')
+def benchmark_schema_loading():
+    """Compare the time to load the schemas of every stack version from JSON and from schema artifacts."""
+    from .ecs import flatten, flatten_multi_fields, get_index_schema, get_kql_schema, get_schema_artifact, get_schemas
+
+    ecs_versions = sorted({mapping['ecs'] for mapping in utils.load_etc_dump('stack-schema-map.yaml').values()})
+    indexes = ['logs-*', 'winlogbeat-*', 'endgame-*']
+    original = os.environ.get('DR_SCHEMA_ARTIFACTS')
+    timings = {}
+
+    modes = (('eager json', 'false', True), ('lazy json', 'false', False), ('artifacts', 'true', False))
+
+    try:
+        for mode, enabled, eager in modes:
+            os.environ['DR_SCHEMA_ARTIFACTS'] = enabled
+            utils.clear_caches()
+
+            if enabled == 'true' and not all(get_schema_artifact(version) for version in ecs_versions):
+                client_error('Schema artifacts are missing or stale, run `dev build-schema-artifacts` first')
+
+            # start each run cold, so that schemas aren't already cached by the previous one
+            utils.clear_caches()
+            start = time.perf_counter()
+
+            if eager:
+                # what loading cost before schemas were read per version: every version and schema up front
+                schemas = get_schemas()
+                for version in ecs_versions:
+                    converted = flatten_multi_fields(schemas[version]['ecs_flat'])
+                    for index_name in indexes:
+                        converted.update(flatten(get_index_schema(index_name)))
+            else:
+                for version in ecs_versions:
+                    get_kql_schema(version=version, indexes=indexes)
+
+            timings[mode] = time.perf_counter() - start
+
+            click.echo(f'{mode}: loaded schemas for ECS {", ".join(ecs_versions)} in {timings[mode] * 1000:.1f}ms')
+    finally:
+        if original is None:
+            os.environ.pop('DR_SCHEMA_ARTIFACTS', None)
+        else:
+            os.environ['DR_SCHEMA_ARTIFACTS'] = original
+        utils.clear_caches()
+
+    for mode in ('lazy json', 'artifacts'):
+        click.echo(f'{mode} speedup: {timings["eager json"] / timings[mode]:.2f}x')
+
+    return timings
+
+
+@benchmark_group.command('eql-schema')
+@click.option('--repeat', '-r', type=click.IntRange(1), default=5, help='Runs of each mode, keeping the fastest')
+def benchmark_eql_schema(repeat):
+    """Compare type checking the EQL rules against their schemas, before and after caching field resolution."""
+    import eql
+    from eql.parser import LarkToEQL
+    from .ecs import KqlSchema2Eql, get_kql_schema2eql
+    from .rule_validators import EQLValidator, get_unique_schemas, parse_eql_tree, type_check_eql
+
+    class PerLookupSchema(KqlSchema2Eql):
+        """How fields were resolved before type hint tables: a new schema per check, converting every lookup."""
+
+        def __init__(self, kql_schema):
+            self.kql_schema = kql_schema
+            eql.Schema.__init__(self, {}, allow_any=True, allow_generic=False, allow_missing=False)
+
+        def get_event_type_hint(self, event_type, path):
+            from kql.parser import elasticsearch_type_family
+
+            eql_hint = self.type_mapping.get(elasticsearch_type_family(self.kql_schema.get(".".join(path))))
+            if eql_hint is not None:
+                return eql_hint, None
+
+    # parse every EQL rule and build its schemas up front, so that only type checking is timed
+    checks = []
+    for rule in RuleCollection.default():
+        data = rule.contents.data
+        if not isinstance(getattr(data, 'validator', None), EQLValidator) or \
+                rule.contents.metadata.query_schema_validation is False:
+            continue
+
+        text, lark_tree = parse_eql_tree(data.query)
+        for schema, *_ in get_unique_schemas(data, rule.contents.metadata, data.validator.ast):
+            checks.append((text, lark_tree, schema))
+
+    timings = {}
+    modes = (('per lookup', PerLookupSchema, LarkToEQL),
+             ('type hint tables', get_kql_schema2eql, LarkToEQL),
+             ('tables and field cache', get_kql_schema2eql, None))
+
+    for mode, get_schema, converter in modes:
+        kwargs = {'converter': converter} if converter is not None else {}
+        runs = []
+
+        # the first run is cold, since each mode starts without any cached schemas or fields
+        utils.clear_caches()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for text, lark_tree, schema in checks:
+                with get_schema(schema), eql.parser.elasticsearch_syntax, eql.parser.ignore_missing_functions:
+                    type_check_eql(text, lark_tree, **kwargs)
+            runs.append(time.perf_counter() - start)
+
+        timings[mode] = min(runs)
+        click.echo(f'{mode}: type checked {len(checks)} EQL queries and schemas in {timings[mode] * 1000:.1f}ms '
+                   f'(first run: {runs[0] * 1000:.1f}ms)')
+
+    for mode, *_ in modes[1:]:
+        click.echo(f'{mode} speedup: {timings["per lookup"] / timings[mode]:.2f}x')
+
+    return timings
+
+
+def get_benchmark_events(count: int) -> List[dict]:
+    """Generate deterministic ECS-like events for benchmarking query evaluation."""
+    names = ['cmd.exe', 'powershell.exe', 'svchost.exe', 'bash', 'curl', 'python3']
+    categories = [['process'], ['network'], ['process', 'network'], ['file'], ['authentication']]
+    events = []
+
+    for i in range(count):
+        events.append({
+            '@timestamp': f'2021-01-01T00:00:{i % 60:02d}Z',
+            'event': {'category': categories[i % len(categories)], 'action': f'action-{i % 7}', 'outcome': 'success'},
+            'host': {'name': f'host-{i % 13}', 'os': {'family': 'windows' if i % 2 else 'linux'}},
+            'process': {'name': names[i % len(names)], 'pid': i, 'args': [names[i % len(names)], f'--flag={i % 5}'],
+                        'parent': {'name': names[(i + 1) % len(names)]}},
+            'source': {'ip': f'10.{i % 256}.{(i // 256) % 256}.1', 'port': 1024 + i % 50000},
+            'destination': {'ip': f'192.168.{i % 256}.10', 'port': (22, 80, 443, 3389)[i % 4]},
+            'user': {'name': ('root', 'admin', 'guest')[i % 3]},
+        })
+
+    return events
+
+
+@benchmark_group.command('kql-evaluator')
+@click.option('--events', '-e', type=click.IntRange(1), default=20000, help='Number of generated events')
+@click.option('--repeat', '-r', type=click.IntRange(1), default=3, help='Runs of each mode, keeping the fastest')
+def benchmark_kql_evaluator(events, repeat):
+    """Compare documents per second of the KQL evaluator, the compiled evaluator and the batch evaluator."""
+    import kql
+
+    rules = []
+    for rule in RuleCollection.default():
+        flat = rule.contents.to_dict()
+        rules.append(dict(flat, **flat['metadata'], **flat['rule']))
+
+    inputs = {
+        'rules': (rules, ['type:eql and tags:Windows',
+                          'risk_score >= 47 and threat.tactic.name:*Evasion*',
+                          'not maturity:production or severity:(high or critical)',
+                          'index:(logs-* or winlogbeat-*) and language:kuery and not tags:Linux']),
+        'events': (get_benchmark_events(events), [
+            'event.category:process and process.name:(cmd.exe or powershell.exe) and not process.args:*flag=1*',
+            'source.ip:10.0.0.0/8 and destination.port >= 1024',
+            'event.category:(network or authentication) and user.name:root and host.os.family:windows',
+            'process.parent.name:* and not event.outcome:failure'])
+    }
+
+    def run_each(evaluators, documents):
+        for evaluator in evaluators:
+            for document in documents:
+                evaluator(document)
+
+    def run_batch(evaluators, documents):
+        # the columns are built as part of every run, and shared by each query
+        table = kql.EventTable(documents)
+        for evaluator in evaluators:
+            evaluator(table)
+
+    modes = {'evaluator': (kql.get_evaluator, run_each),
+             'compiled': (lambda query: kql.get_evaluator(query, compiled=True), run_each)}
+    if kql.columnar.numpy_installed():
+        modes['batch'] = (kql.get_batch_evaluator, run_batch)
+    else:
+        click.echo('numpy is not installed, skipping the batch evaluator')
+
+    rates = {}
+
+    for name, (documents, queries) in inputs.items():
+        for mode, (get_evaluator, run) in modes.items():
+            evaluators = [get_evaluator(query) for query in queries]
+            runs = []
+
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run(evaluators, documents)
+                runs.append(time.perf_counter() - start)
+
+            rates[name, mode] = len(documents) * len(queries) / min(runs)
+            click.echo(f'{name} ({len(documents)} x {len(queries)} queries), {mode}: '
+                       f'{rates[name, mode]:,.0f} documents/s')
+
+        for mode in modes:
+            if mode != 'evaluator':
+                click.echo(f'{name} {mode} speedup: {rates[name, mode] / rates[name, "evaluator"]:.2f}x')
+
+    return rates
+
+
+@benchmark_group.command('startup')
+@click.option('--repeat', '-r', type=click.IntRange(1), default=20, help='Runs of each mode, keeping the median')
+def benchmark_startup(repeat):
+    """Compare the startup time of the CLI with and without the cached KQL parser tables."""
+    import statistics
+    import sys
+    import tempfile
+    from kql.parser import build_lark_parser
+
+    command = [sys.executable, '-X', 'importtime', '-m', 'detection_rules', '--help']
+    runs = {'cold': [], 'warm': []}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        build_lark_parser(None)
+        click.echo(f'building the KQL parser: {(time.perf_counter() - start) * 1000:.1f}ms')
+
+        build_lark_parser(cache_dir)
+        start = time.perf_counter()
+        build_lark_parser(cache_dir)
+        click.echo(f'loading the cached KQL parser: {(time.perf_counter() - start) * 1000:.1f}ms')
+
+        # alternate the modes, so that both are affected by anything else running at the same time
+        for _ in range(repeat):
+            for mode, mode_runs in runs.items():
+                # cold runs start from an empty cache folder, warm runs reuse the one from previous runs
+                env = dict(os.environ, DR_CACHE_DIR=tempfile.mkdtemp(dir=cache_dir) if mode == 'cold' else cache_dir)
+                start = time.perf_counter()
+                output = subprocess.run(command, env=env, cwd=get_path(), stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+                elapsed = time.perf_counter() - start
+
+                # import time: self [us] | cumulative | imported package
+                parser_us = next(int(line.split(':')[1].split('|')[0]) for line in output.splitlines()
+                                 if line.split('|')[-1].strip() == 'kql.parser')
+                mode_runs.append((elapsed, parser_us / 1e6))
+
+    timings = {}
+    for mode, mode_runs in runs.items():
+        timings[mode] = statistics.median(elapsed for elapsed, _ in mode_runs)
+        timings[mode, 'kql.parser'] = statistics.median(parser for _, parser in mode_runs)
+        click.echo(f'--help, {mode} cache: {timings[mode] * 1000:.0f}ms, '
+                   f'importing kql.parser: {timings[mode, "kql.parser"] * 1000:.1f}ms')
+
+    saved = timings['cold', 'kql.parser'] - timings['warm', 'kql.parser']
+    click.echo(f'saved importing kql.parser: {saved * 1000:.1f}ms ({saved / timings["cold"]:.1%} of startup)')
+    return timings
+
+
+@benchmark_group.command('memory')
+@click.option('--directory', '-d', type=click.Path(file_okay=False, exists=True), default=RULES_DIR,
+              help='Directory of rules to load')
+def benchmark_memory(directory):
+    """Compare the memory used per rule by default and compact rule collections."""
+    import gc
+    import tracemalloc
+    from .rule_cache import default_cache
+
+    # load once beforehand, so that schemas and other global caches aren't counted against the first mode
+    RuleCollection(cache=default_cache()).load_directory(Path(directory))
+    usage = {}
+
+    for mode, compact in (('default', False), ('compact', True)):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        rules = RuleCollection(cache=default_cache(), compact=compact)
+        rules.load_directory(Path(directory))
+        gc.collect()
+
+        count = len(rules) + len(rules.deprecated)
+        usage[mode] = (tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+        del rules
+
+        click.echo(f'{mode}: {usage[mode] / 1024:.1f} KiB per rule ({count} rules)')
+
+    click.echo(f'reduction: {1 - usage["compact"] / usage["default"]:.0%}')
+    return usage
@@ -6,18 +6,24 @@
 """ECS Schemas management."""
 import copy
 import glob
+import hashlib
 import os
 import shutil
 import json
+from collections import ChainMap
 from pathlib import Path
+from typing import Dict, Mapping, Optional, Union
 
 import requests
 import eql
 import eql.types
 import yaml
+from kql import KqlSchema
 
+from .schema_artifacts import SCHEMA_ARTIFACTS_DIR, FieldTable, hash_fields, load_artifact, write_artifact
 from .semver import Version
-from .utils import DateTimeEncoder, cached, load_etc_dump, get_etc_path, gzip_compress, read_gzip, unzip
+from .utils import (DateTimeEncoder, Identity, cached, dict_hash, freeze, hash_files, hash_files_cached, identity_key,
+                    load_etc_dump, get_etc_path, gzip_compress, read_gzip, unzip)
 
 ETC_NAME = "ecs_schemas"
 ECS_SCHEMAS_DIR = get_etc_path(ETC_NAME)
@@ -83,14 +89,30 @@ def get_schema_map():
     return schema_map
 
 
+# only a few ECS versions are validated against at a time, out of every version under etc/ecs_schemas
+SCHEMA_CACHE_SIZE = 8
+# distinct combinations of versions, indexes and beats schemas
+KQL_SCHEMA_CACHE_SIZE = 256
+
+
+def read_schema(version: str, name='ecs_flat') -> dict:
+    """Decompress and parse a single schema file."""
+    file_name = get_schema_map().get(version, {}).get(name)
+
+    if file_name is None:
+        raise KeyError(f'Unknown ECS schema {name} for version {version}')
+
+    return json.loads(read_gzip(file_name))
+
+
 @cached
 def get_schemas():
-    """Get local schemas."""
+    """Get local schemas, for every version. Prefer get_schema, which only reads the requested one."""
     schema_map = get_schema_map()
 
     for version, values in schema_map.items():
-        for name, file_name in values.items():
-            schema_map[version][name] = json.loads(read_gzip(file_name))
+        for name in values:
+            schema_map[version][name] = read_schema(version, name)
 
     return schema_map
 
@@ -105,16 +127,25 @@ def get_max_version(include_master=False):
     return str(max([Version(v) for v in versions if not v.startswith('master')]))
 
 
-@cached
-def get_schema(version=None, name='ecs_flat'):
-    """Get schema by version."""
+def resolve_version(version=None) -> str:
+    """Get the directory name of a schema version, where `master` is the latest master schema and None the latest."""
     if version == 'master':
-        version = get_max_version(include_master=True)
+        return get_max_version(include_master=True)
 
-    return get_schemas()[version or str(get_max_version())][name]
+    return version or str(get_max_version())
 
 
-@cached
+@cached(maxsize=SCHEMA_CACHE_SIZE)
+def get_schema(version=None, name='ecs_flat'):
+    """Get schema by version, reading only the file for that version and name."""
+    return read_schema(resolve_version(version), name)
+
+
+def _eql_schema_key(version=None, index_patterns=None):
+    return version, tuple(index_patterns or ())
+
+
+@cached(maxsize=SCHEMA_CACHE_SIZE, key=_eql_schema_key)
 def get_eql_schema(version=None, index_patterns=None):
     """Return schema in expected format for eql."""
     schema = get_schema(version, name='ecs_flat')
@@ -155,7 +186,7 @@ def get_non_ecs_schema():
     return load_etc_dump('non-ecs-schema.json')
 
 
-@cached
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE)
 def get_index_schema(index_name):
     return get_non_ecs_schema().get(index_name, {})
 
@@ -184,29 +215,123 @@ class KqlSchema2Eql(eql.Schema):
 
     def __init__(self, kql_schema):
         self.kql_schema = kql_schema
+
+        # schemas from get_kql_schema chain their tables, whose type hints are shared by every schema using them
+        fields = kql_schema.fields if isinstance(kql_schema, KqlSchema) else kql_schema
+        tables = fields.maps if isinstance(fields, ChainMap) else [fields]
+        self.type_hints = ChainMap(*[get_type_hint_table(table) for table in tables])
         eql.Schema.__init__(self, {}, allow_any=True, allow_generic=False, allow_missing=False)
 
+    def get_type_hint(self, field: str) -> Optional[eql.types.TypeHint]:
+        return self.type_hints.get(field)
+
     def validate_event_type(self, event_type):
         # allow all event types to fill in X:
         #   `X` where ....
         return True
 
     def get_event_type_hint(self, event_type, path):
-        from kql.parser import elasticsearch_type_family
-
-        dotted = ".".join(path)
-        elasticsearch_type = self.kql_schema.get(dotted)
-        es_type_family = elasticsearch_type_family(elasticsearch_type)
-        eql_hint = self.type_mapping.get(es_type_family)
+        eql_hint = self.get_type_hint(".".join(path))
 
         if eql_hint is not None:
             return eql_hint, None
 
 
-@cached
-def get_kql_schema(version=None, indexes=None, beat_schema=None) -> dict:
-    """Get schema for KQL."""
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE, key=identity_key)
+def get_type_hint_table(fields: Mapping) -> Dict[str, Optional[eql.types.TypeHint]]:
+    """Convert a table of fields to EQL type hints, converting each distinct type once and each table only once."""
+    from kql.parser import elasticsearch_type_family
+
+    fields = fields.to_dict() if isinstance(fields, FieldTable) else fields
+    hints = {es_type: KqlSchema2Eql.type_mapping.get(elasticsearch_type_family(es_type))
+             for es_type in set(fields.values())}
+    return {field: hints[es_type] for field, es_type in fields.items()}
+
+
+def get_artifact_sources(version=None) -> list:
+    """Get the files which the schema artifact of an ECS version is built from."""
+    return [get_schema_map()[resolve_version(version)]['ecs_flat'], get_etc_path('non-ecs-schema.json')]
+
+
+def build_schema_artifact(version=None, directory=SCHEMA_ARTIFACTS_DIR) -> Path:
+    """Precompile the flattened ECS fields of a version, and the fields of each non-ecs index, to an artifact."""
+    version = resolve_version(version)
+    sections = {'ecs': flatten_multi_fields(get_schema(version, name='ecs_flat'))}
+
+    for index_name, index_schema in get_non_ecs_schema().items():
+        sections[f'index:{index_name}'] = flatten(index_schema)
+
+    path = Path(directory) / f'ecs-{version}.schema'
+    write_artifact(path, sections, hash_files(get_artifact_sources(version)))
+    return path
+
+
+@cached(maxsize=SCHEMA_CACHE_SIZE)
+def get_schema_artifact(version=None):
+    """Get the memory-mapped artifact for an ECS version, if it was built and is current."""
+    version = resolve_version(version)
+    path = Path(SCHEMA_ARTIFACTS_DIR) / f'ecs-{version}.schema'
+    return load_artifact(path, hash_files_cached(get_artifact_sources(version)))
+
+
+def _kql_schema_key(version=None, indexes=None, beat_schema=None):
+    # beat schemas are large and cached by beats.get_schema_from_datasets, so they're keyed by identity
+    return version, freeze(indexes), Identity(beat_schema)
+
+
+@cached(maxsize=SCHEMA_CACHE_SIZE)
+def _get_ecs_fields_hash(version=None) -> str:
+    artifact = get_schema_artifact(version)
+    if artifact is not None:
+        return artifact.get('ecs').fields_hash
+
+    return hash_fields(flatten_multi_fields(get_schema(version, name='ecs_flat')))
+
+
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE)
+def _get_index_fields_hash(version, index_name) -> Optional[str]:
+    artifact = get_schema_artifact(version)
+    if artifact is not None:
+        table = artifact.get(f'index:{index_name}')
+        return table.fields_hash if table else None
+
+    fields = flatten(get_index_schema(index_name))
+    return hash_fields(fields) if fields else None
+
+
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE, key=_kql_schema_key)
+def get_kql_schema_fingerprint(version=None, indexes=None, beat_schema=None) -> str:
+    """Get the fingerprint of the schema which get_kql_schema returns for the same arguments, without building it.
+
+    The fields each table of the schema adds are hashed in order, so versions with different ECS files but the same
+    fields share a fingerprint. Artifacts save these hashes, and they're only computed from JSON schemas without one.
+    """
+    hashes = [_get_index_fields_hash(version, index_name) for index_name in reversed(indexes or ())]
+    hashes = [fields_hash for fields_hash in hashes if fields_hash] + [_get_ecs_fields_hash(version)]
+
+    if isinstance(beat_schema, dict):
+        hashes.append(get_schema_fingerprint(beat_schema))
+
+    return hashlib.sha256(json.dumps(hashes).encode('utf-8')).hexdigest()
+
+
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE, key=_kql_schema_key)
+def get_kql_schema(version=None, indexes=None, beat_schema=None) -> KqlSchema:
+    """Get schema for KQL, which indexes its fields for wildcards the first time a query needs them."""
     indexes = indexes or ()
+    artifact = get_schema_artifact(version)
+    fingerprint = get_kql_schema_fingerprint(version, indexes, beat_schema)
+
+    if artifact is not None:
+        # look fields up in the memory-mapped tables, with later indexes taking precedence as they would in a dict
+        tables = [artifact.get(f'index:{index_name}') for index_name in reversed(indexes)]
+        tables = [table for table in tables if table is not None] + [artifact.get('ecs')]
+
+        if isinstance(beat_schema, dict):
+            tables.append(flatten_multi_fields(beat_schema))
+
+        return KqlSchema(ChainMap(*tables), fingerprint=fingerprint)
+
     converted = flatten_multi_fields(get_schema(version, name='ecs_flat'))
 
     for index_name in indexes:
@@ -215,7 +340,23 @@ def get_kql_schema(version=None, indexes=None, beat_schema=None) -> dict:
     if isinstance(beat_schema, dict):
         converted = dict(flatten_multi_fields(beat_schema), **converted)
 
-    return converted
+    return KqlSchema(converted, fingerprint=fingerprint)
+
+
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE, key=identity_key)
+def get_schema_fingerprint(schema: Union[dict, KqlSchema]) -> str:
+    """Get a hash of the contents of a schema, which is only computed once for each (cached) schema object."""
+    return schema.fingerprint if isinstance(schema, KqlSchema) else dict_hash(schema)
+
+
+def _schema_fingerprint_key(schema):
+    return get_schema_fingerprint(schema)
+
+
+@cached(maxsize=KQL_SCHEMA_CACHE_SIZE, key=_schema_fingerprint_key)
+def get_kql_schema2eql(schema: Union[dict, KqlSchema]) -> KqlSchema2Eql:
+    """Get the EQL schema for a KQL schema, shared by every schema with the same fields."""
+    return KqlSchema2Eql(schema)
 
 
 def download_schemas(refresh_master=True, refresh_all=False, verbose=True):
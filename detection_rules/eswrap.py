@@ -7,8 +7,9 @@
 import json
 import os
 import time
-from collections import defaultdict
-from typing import Union
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Union
 
 import click
 import elasticsearch
@@ -79,6 +80,14 @@ class RtaEvents(object):
             if verbose:
                 click.echo('No updates to rule-mapping file; No matching results')
 
+    def match_rules(self, rules: Optional[RuleCollection] = None) -> Dict[str, List[dict]]:
+        """Get the collected events which each KQL or EQL rule matches, checking every rule at once."""
+        from .rule_matcher import RuleMatcher
+        from .utils import combine_sources
+
+        matcher = RuleMatcher(rules if rules is not None else RuleCollection.default())
+        return matcher.match(combine_sources(*self.events.values()))
+
     def echo_events(self, pager=False, pretty=True):
         """Print events to stdout."""
         echo_fn = click.echo_via_pager if pager else click.echo
@@ -319,6 +328,58 @@ def normalize_data(events_file):
     events.save(dump_dir=os.path.dirname(events_file.name))
 
 
+@root.command('match-events')
+@click.argument('events-files', type=Path, nargs=-1, required=True)
+@click.option('--rule-id', '-r', multiple=True, help='Only match these rules (default: every KQL and EQL rule)')
+@click.option('--json-output', '-j', type=Path, help='Save the events matched by each rule to a JSON file')
+def match_events(events_files, rule_id, json_output):
+    """Match events from .json or .jsonl files against every rule at once.
+
+    Values are compared case-sensitively, as KQL does for keyword fields, except for EQL comparisons which are
+    case-insensitive, such as `:`.
+    """
+    import itertools
+    from .rule_matcher import RuleMatcher, iter_event_file
+
+    rules = RuleCollection.default()
+    if rule_id:
+        rules = rules.filter(lambda r: r.id in rule_id)
+
+    matcher = RuleMatcher(rules)
+    click.echo(f'Compiled {len(matcher.rules)} rules ({len(matcher.unindexed)} not indexed), '
+               f'skipped {len(matcher.unsupported)} unsupported rules')
+
+    # only keep the events themselves if they're saved, so that large files are streamed
+    counts = Counter()
+    matches = defaultdict(list)
+    start = time.perf_counter()
+
+    events = itertools.chain.from_iterable(iter_event_file(path) for path in events_files)
+    for event, matched_rules in matcher.iter_matches(events):
+        for rule in matched_rules:
+            counts[rule.id] += 1
+            if json_output:
+                matches[rule.id].append(event)
+
+    event_count = matcher.event_count
+    elapsed = time.perf_counter() - start
+    click.echo(f'Matched {event_count} events in {elapsed:.2f}s ({event_count / max(elapsed, 1e-9):,.0f} events/s)')
+
+    names = {r.id: r.name for r in rules}
+    for matched_id, count in counts.most_common():
+        click.echo(f'{count:>10}  {names[matched_id]} ({matched_id})')
+
+    for errored_id, count in matcher.errors.most_common():
+        error = matcher.first_errors[errored_id]
+        click.echo(f'{names[errored_id]} ({errored_id}) failed to evaluate {count} events, first with '
+                   f'{type(error).__name__}: {error}', err=True)
+
+    if json_output:
+        json_output.write_text(json.dumps(matches, indent=2, sort_keys=True))
+
+    return counts
+
+
 @root.group('es')
 @add_params(*elasticsearch_options)
 @click.pass_context
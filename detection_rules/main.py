@@ -20,10 +20,11 @@ import click
 from .cli_utils import rule_prompt, multi_collection
 from .misc import add_client, client_error, nested_set, parse_config
 from .rule import TOMLRule, TOMLRuleContents
+from .rule_cache import default_cache
 from .rule_formatter import toml_write
 from .rule_loader import RuleCollection
 from .schemas import all_versions, definitions
-from .utils import get_path, get_etc_path, clear_caches, load_dump, load_rule_contents
+from .utils import get_path, get_etc_path, clear_caches, get_cache_stats, load_dump, load_rule_contents
 
 RULES_DIR = get_path('rules')
 
@@ -31,14 +32,30 @@ RULES_DIR = get_path('rules')
 @click.group('detection-rules', context_settings={'help_option_names': ['-h', '--help']})
 @click.option('--debug/--no-debug', '-D/-N', is_flag=True, default=None,
               help='Print full exception stacktrace on errors')
+@click.option('--cache-stats', is_flag=True, help='Print hits, misses and evictions of in-memory caches on exit')
 @click.pass_context
-def root(ctx, debug):
+def root(ctx, debug, cache_stats):
     """Commands for detection-rules repository."""
     debug = debug if debug is not None else parse_config().get('debug')
     ctx.obj = {'debug': debug}
     if debug:
         click.secho('DEBUG MODE ENABLED', fg='yellow')
 
+    if cache_stats:
+        ctx.call_on_close(print_cache_stats)
+
+
+def print_cache_stats():
+    """Print the statistics of each cache used by this process (not including rule loading worker processes)."""
+    stats = get_cache_stats()
+    width = max([len(s['name']) for s in stats] + [len('cache')])
+
+    rows = [('cache', 'hits', 'misses', 'evictions', 'size', 'maxsize')]
+    rows.extend((s['name'], s['hits'], s['misses'], s['evictions'], s['size'], s['maxsize'] or '-') for s in stats)
+
+    for name, *counts in rows:
+        click.echo(f'{name:<{width}}' + ''.join(f'{count:>11}' for count in counts), err=True)
+
 
 @root.command('create-rule')
 @click.argument('path', type=Path)
@@ -161,7 +178,7 @@ def mass_update(ctx, query, metadata, language, field):
 @click.pass_context
 def view_rule(ctx, rule_file, api_format):
     """View an internal rule or specified rule file."""
-    rule = RuleCollection().load_file(rule_file)
+    rule = RuleCollection(cache=default_cache()).load_file(rule_file)
 
     if api_format:
         click.echo(json.dumps(rule.contents.to_api_format(), indent=2, sort_keys=True))
@@ -244,16 +261,121 @@ def export_rules(rules, outfile: Path, replace_id, stack_version, skip_unsupport
 @click.pass_context
 def validate_rule(ctx, path):
     """Check if a rule staged in rules dir validates against a schema."""
-    rule = RuleCollection().load_file(Path(path))
+    rule = RuleCollection(cache=default_cache()).load_file(Path(path))
     click.echo('Rule validation successful')
     return rule
 
 
+def disable_validation_caches():
+    """Validate every rule and query again, including in rule loading worker processes."""
+    os.environ['DR_RULE_CACHE'] = 'false'
+    os.environ['DR_VALIDATION_CACHE'] = 'false'
+
+
 @root.command('validate-all')
-def validate_all(fail):
+@click.option('--no-validation-cache', is_flag=True, help='Validate every rule, instead of only those which changed')
+@click.option('--processes', '-p', type=int, help='Number of worker processes (default: DR_LOAD_PROCESSES or 1)')
+@click.option('--slowest', '-s', type=int, default=0, help='Print the timings of the N slowest rules')
+@click.option('--json-output', '-j', type=Path, help='Save the timings and errors of every rule to a JSON file')
+def validate_all(no_validation_cache, processes, slowest, json_output):
     """Check if all rules validates against a schema."""
-    RuleCollection.default()
-    click.echo('Rule validation successful')
+    from .rule_loader import DEFAULT_RULES_DIR, get_load_processes
+
+    if no_validation_cache:
+        disable_validation_caches()
+
+    processes = processes or get_load_processes()
+    start = time.perf_counter()
+    collection = RuleCollection(cache=default_cache())
+    timings = collection.load_directory_timed(DEFAULT_RULES_DIR, processes=processes)
+    elapsed = time.perf_counter() - start
+
+    totals = {'elapsed': elapsed, 'rules': len(timings), 'cached': sum(t.cached for t in timings),
+              'schema': sum(t.schema_elapsed for t in timings), 'languages': {}, 'stack_versions': {},
+              'cached_validation': {}}
+    for timing in timings:
+        for category in ('languages', 'stack_versions', 'cached_validation'):
+            for name, seconds in getattr(timing, category).items():
+                totals[category][name] = totals[category].get(name, 0.0) + seconds
+
+    if slowest:
+        print_validation_timings(timings, totals, slowest)
+
+    if json_output:
+        json_output.write_text(json.dumps({'totals': totals, 'rules': [t.to_dict() for t in timings]}, indent=2))
+
+    if collection.errors:
+        for path, error in sorted(collection.errors.items()):
+            click.echo(f'{path}: {type(error).__name__}: {error}', err=True)
+        client_error(f'{len(collection.errors)} of {len(timings)} rules failed validation')
+
+    click.echo(f'Rule validation successful ({len(timings)} rules in {elapsed:.2f}s)')
+
+
+def print_validation_timings(timings: list, totals: dict, count: int):
+    """Print the slowest rules, and the total time spent validating each query language and stack version.
+
+    Time spent reusing saved query validation outcomes is shown apart from the languages, under reused.
+    """
+    languages = sorted(totals['languages'])
+    rows = [('rule', 'total', 'schema') + tuple(languages) + ('reused', )]
+
+    for timing in sorted(timings, key=lambda t: t.elapsed, reverse=True)[:count]:
+        name = Path(timing.path).name + (' (error)' if timing.error else ' (cached)' if timing.cached else '')
+        rule_languages = tuple(timing.languages.get(language, 0.0) for language in languages)
+        reused = sum(timing.cached_validation.values())
+        rows.append((name, timing.elapsed, timing.schema_elapsed) + rule_languages + (reused, ))
+
+    all_languages = tuple(totals['languages'][language] for language in languages)
+    all_reused = sum(totals['cached_validation'].values())
+    rows.append(('all rules', sum(t.elapsed for t in timings), totals['schema']) + all_languages + (all_reused, ))
+
+    width = max([len(row[0]) for row in rows] + [len("stack version")]) + 2
+    for name, *seconds in rows:
+        columns = [f'{s:>10.3f}' if isinstance(s, float) else f'{s:>10}' for s in seconds]
+        click.echo(f'{name:<{width}}' + ''.join(columns))
+
+    if totals['stack_versions']:
+        click.echo()
+        click.echo(f'{"stack version":<{width}}{"total":>10}')
+        for version, seconds in sorted(totals['stack_versions'].items(), key=lambda item: item[1], reverse=True):
+            click.echo(f'{version:<{width}}{seconds:>10.3f}')
+
+
+# rule-search fields which can be narrowed down with a RuleCollection index
+SEARCH_INDEXED_FIELDS = {
+    "type": "type",
+    "language": "language",
+    "maturity": "maturity",
+    "tags": "tags",
+    "index": "index",
+    "integration": "integration",
+    "min_stack_version": "min_stack_version",
+    "techniques": "technique",
+    "subtechniques": "technique",
+    "unique_fields": "fields",
+}
+
+
+def get_search_criteria(query: str) -> dict:
+    """Get index criteria which every rule matching a KQL rule-search query also matches."""
+    import kql
+
+    tree = kql.parse(query)
+    terms = tree.items if isinstance(tree, kql.ast.AndExpr) else [tree]
+    criteria = {}
+
+    for term in terms:
+        if not isinstance(term, kql.ast.FieldComparison) or term.field.name not in SEARCH_INDEXED_FIELDS:
+            continue
+
+        values = term.value.items if isinstance(term.value, kql.ast.OrValues) else [term.value]
+
+        # only plain strings are compared for equality, skipping wildcards, numbers and cidr blocks
+        if all(type(v) is kql.ast.String and "/" not in v.value for v in values):
+            criteria.setdefault(SEARCH_INDEXED_FIELDS[term.field.name], [v.value for v in values])
+
+    return criteria
 
 
 @root.command('rule-search')
@@ -268,14 +390,22 @@ def search_rules(query, columns, language, count, verbose=True, rules: Dict[str,
     from eql.build import get_engine
     from eql import parse_query
     from eql.pipes import CountPipe
-    from .rule import get_unique_query_fields
+    from .rule import LazyTOMLRule, get_unique_query_fields
 
     flattened_rules = []
-    rules = rules or {str(rule.path): rule for rule in RuleCollection.default()}
+
+    if rules is None:
+        # searching only needs the rule contents, so rules are validated only if the default collection already was
+        collection = RuleCollection.default_lazy()
+        if query and language == "kql":
+            # narrow down the rules with the collection indexes before flattening them
+            collection = collection.query(**get_search_criteria(query))
+
+        rules = {str(rule.path): rule for rule in collection}
 
     for file_name, rule in rules.items():
         flat: dict = {"file": os.path.relpath(file_name)}
-        flat.update(rule.contents.to_dict())
+        flat.update(rule.to_dict() if isinstance(rule, LazyTOMLRule) else rule.contents.to_dict())
         flat.update(flat["metadata"])
         flat.update(flat["rule"])
 
@@ -300,7 +430,7 @@ def search_rules(query, columns, language, count, verbose=True, rules: Dict[str,
 
     filtered = []
     if language == "kql":
-        evaluator = get_evaluator(query) if query else lambda x: True
+        evaluator = get_evaluator(query, compiled=True) if query else lambda x: True
         filtered = list(filter(evaluator, flattened_rules))
     elif language == "eql":
         parsed = parse_query(query, implied_any=True, implied_base=True)
@@ -328,11 +458,15 @@ def search_rules(query, columns, language, count, verbose=True, rules: Dict[str,
 
 
 @root.command("test")
+@click.option('--no-validation-cache', is_flag=True, help='Validate every rule, instead of only those which changed')
 @click.pass_context
-def test_rules(ctx):
+def test_rules(ctx, no_validation_cache):
     """Run unit tests over all of the rules."""
     import pytest
 
+    if no_validation_cache:
+        disable_validation_caches()
+
     clear_caches()
     ctx.exit(pytest.main(["-v"]))
 
@@ -4,6 +4,7 @@
 # 2.0.
 
 """Generic mixin classes."""
+import dataclasses
 from typing import TypeVar, Type, Optional, Any
 
 import marshmallow_dataclass
@@ -74,9 +75,27 @@ def patch_jsonschema(obj: dict) -> dict:
     return patched
 
 
+class FrozenSlotsMixin:
+    """Mixin class for frozen dataclasses which define __slots__ to save memory.
+
+    Pickle restores slots with setattr, which frozen dataclasses reject, so the state is restored directly.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in dataclasses.fields(self)}
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
 class MarshmallowDataclassMixin:
     """Mixin class for marshmallow serialization."""
 
+    __slots__ = ()
+
     @classmethod
     @cached
     def __schema(cls: ClassT) -> Schema:
@@ -13,13 +13,14 @@ import shutil
 import textwrap
 from collections import defaultdict
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple, Union
 
 import click
 import yaml
 
 from .misc import JS_LICENSE, cached
 from .rule import TOMLRule, QueryRuleData, ThreatMapping
+from .rule_filter import compile_filter
 from .rule_loader import DeprecatedCollection, RuleCollection, DEFAULT_RULES_DIR
 from .schemas import definitions
 from .utils import Ndjson, get_path, get_etc_path, load_etc_dump
@@ -34,24 +35,18 @@ FLEET_PKG_LOGO = get_etc_path("security-logo-color-64px.svg")
 # CHANGELOG_FILE = Path(get_etc_path('rules-changelog.json'))
 
 
-def filter_rule(rule: TOMLRule, config_filter: dict, exclude_fields: Optional[dict] = None) -> bool:
-    """Filter a rule based off metadata and a package configuration."""
-    flat_rule = rule.contents.flattened_dict()
-
-    for key, values in config_filter.items():
-        if key not in flat_rule:
-            return False
+# indexed fields which have the same values as the flattened rule keys checked by filter_rule
+PACKAGE_INDEXED_FIELDS = ("type", "language", "maturity", "tags", "index", "integration", "min_stack_version")
 
-        values = set([v.lower() if isinstance(v, str) else v for v in values])
-        rule_value = flat_rule[key]
 
-        if isinstance(rule_value, list):
-            rule_values = {v.lower() if isinstance(v, str) else v for v in rule_value}
-        else:
-            rule_values = {rule_value.lower() if isinstance(rule_value, str) else rule_value}
+def filter_rule(rule: TOMLRule, config_filter: Union[dict, Callable[[dict], bool]],
+                exclude_fields: Optional[dict] = None) -> bool:
+    """Filter a rule based off metadata and a package configuration."""
+    if not callable(config_filter):
+        config_filter = compile_filter(config_filter, case_sensitive=False)
 
-        if len(rule_values & values) == 0:
-            return False
+    if not config_filter(rule.contents.flattened_dict()):
+        return False
 
     exclude_fields = exclude_fields or {}
     if exclude_fields:
@@ -227,7 +222,15 @@ class Package(object):
         config.pop('log_deprecated', False)
         rule_filter = config.pop('filter', {})
 
-        rules = all_rules.filter(lambda r: filter_rule(r, rule_filter, exclude_fields))
+        # filter on the collection indexes where possible, and only flatten the remaining rules for other filters
+        indexed_filter = {k: v for k, v in rule_filter.items()
+                          if k in PACKAGE_INDEXED_FIELDS and not isinstance(v, dict)}
+        rule_filter = {k: v for k, v in rule_filter.items() if k not in indexed_filter}
+        rules = all_rules.query(**indexed_filter)
+
+        if rule_filter or exclude_fields:
+            rule_filter = compile_filter(rule_filter, case_sensitive=False)
+            rules = rules.filter(lambda r: filter_rule(r, rule_filter, exclude_fields))
 
         # add back in deprecated fields
         rules.deprecated = all_rules.deprecated
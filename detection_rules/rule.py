@@ -19,18 +19,23 @@ from marshmallow import ValidationError, validates_schema
 
 import kql
 from . import utils
-from .mixins import MarshmallowDataclassMixin
+from .mixins import FrozenSlotsMixin, MarshmallowDataclassMixin
 from .rule_formatter import toml_write, nested_normalize
 from .schemas import SCHEMA_DIR, definitions, downgrade, get_stack_schemas
 from .utils import cached
 
 _META_SCHEMA_REQ_DEFAULTS = {}
 MIN_FLEET_PACKAGE_VERSION = '7.13.0'
+RULE_HASH_CACHE_SIZE = 4096
 
 
 @dataclass(frozen=True)
-class RuleMeta(MarshmallowDataclassMixin):
+class RuleMeta(FrozenSlotsMixin, MarshmallowDataclassMixin):
     """Data stored in a rule's [metadata] section of TOML."""
+    __slots__ = ("creation_date", "updated_date", "deprecation_date", "comments", "integration", "maturity",
+                 "min_stack_version", "min_stack_comments", "os_type_list", "query_schema_validation",
+                 "related_endpoint_rules", "extended")
+
     creation_date: definitions.Date
     updated_date: definitions.Date
     deprecation_date: Optional[definitions.Date]
@@ -55,7 +60,9 @@ class RuleMeta(MarshmallowDataclassMixin):
 
 
 @dataclass(frozen=True)
-class BaseThreatEntry:
+class BaseThreatEntry(FrozenSlotsMixin):
+    __slots__ = ("id", "name", "reference")
+
     id: str
     name: str
     reference: str
@@ -64,12 +71,16 @@ class BaseThreatEntry:
 @dataclass(frozen=True)
 class SubTechnique(BaseThreatEntry):
     """Mapping to threat subtechnique."""
+    __slots__ = ()
+
     reference: definitions.SubTechniqueURL
 
 
 @dataclass(frozen=True)
 class Technique(BaseThreatEntry):
     """Mapping to threat subtechnique."""
+    __slots__ = ("subtechnique",)
+
     # subtechniques are stored at threat[].technique.subtechnique[]
     reference: definitions.TechniqueURL
     subtechnique: Optional[List[SubTechnique]]
@@ -78,12 +89,16 @@ class Technique(BaseThreatEntry):
 @dataclass(frozen=True)
 class Tactic(BaseThreatEntry):
     """Mapping to a threat tactic."""
+    __slots__ = ()
+
     reference: definitions.TacticURL
 
 
 @dataclass(frozen=True)
-class ThreatMapping(MarshmallowDataclassMixin):
+class ThreatMapping(FrozenSlotsMixin, MarshmallowDataclassMixin):
     """Mapping to a threat framework."""
+    __slots__ = ("framework", "tactic", "technique")
+
     framework: Literal["MITRE ATT&CK"]
     tactic: Tactic
     technique: Optional[List[Technique]]
@@ -212,6 +227,21 @@ class QueryValidator:
     def validate(self, data: 'QueryRuleData', meta: RuleMeta) -> None:
         raise NotImplementedError()
 
+    def __getstate__(self) -> dict:
+        # the parsed syntax tree is only kept for validating, and is larger than the rest of a rule once pickled
+        state = self.__dict__.copy()
+        state.pop('parsed', None)
+        return state
+
+    def validate_cached(self, data: 'QueryRuleData', meta: RuleMeta) -> None:
+        """Validate the query, or reuse the saved outcome of validating it with the same inputs."""
+        from .rule_cache import default_validation_cache, validation_cache_enabled
+
+        if validation_cache_enabled():
+            return default_validation_cache().validate(self, data, meta)
+
+        return self.validate(data, meta)
+
 
 @dataclass(frozen=True)
 class QueryRuleData(BaseRuleData):
@@ -232,7 +262,7 @@ class QueryRuleData(BaseRuleData):
     def validate_query(self, meta: RuleMeta) -> None:
         validator = self.validator
         if validator is not None:
-            return validator.validate(self, meta)
+            return validator.validate_cached(self, meta)
 
     @cached_property
     def ast(self):
@@ -361,7 +391,7 @@ class ThreatMatchRuleData(QueryRuleData):
             else:
                 return
 
-            threat_query_validator.validate(self, meta)
+            threat_query_validator.validate_cached(self, meta)
 
 
 # All of the possible rule types
@@ -432,8 +462,9 @@ class BaseRuleContents(ABC):
     def to_api_format(self, include_version=True) -> dict:
         """Convert the rule to the API format."""
 
-    @cached
+    @cached(maxsize=RULE_HASH_CACHE_SIZE, key=utils.identity_key)
     def sha256(self, include_version=False) -> str:
+        # contents are frozen, so they're keyed by identity instead of freezing every field of the rule for each call
         # get the hash of the API dict without the version by default, otherwise it'll always be dirty.
         hashable_contents = self.to_api_format(include_version=include_version)
         return utils.dict_hash(hashable_contents)
@@ -505,10 +536,16 @@ class TOMLRuleContents(BaseRuleContents, MarshmallowDataclassMixin):
         return nested_normalize(dict_obj)
 
     def flattened_dict(self) -> dict:
-        flattened = dict()
-        flattened.update(self.data.to_dict())
-        flattened.update(self.metadata.to_dict())
-        return flattened
+        """Get the rule and metadata fields in a single dictionary, which is cached and shouldn't be modified."""
+        if '_flattened_dict' not in self.__dict__:
+            flattened = dict()
+            flattened.update(self.data.to_dict())
+            flattened.update(self.metadata.to_dict())
+
+            # circumvent frozen class
+            self.__dict__['_flattened_dict'] = flattened
+
+        return self.__dict__['_flattened_dict']
 
     def to_api_format(self, include_version=True) -> dict:
         """Convert the TOML rule to the API format."""
@@ -551,6 +588,71 @@ class TOMLRule:
             f.write('\n')
 
 
+class LazyTOMLRule:
+    """A rule which only parses its TOML, deferring deserialization and query validation until the contents are used.
+
+    The id, name, path, metadata and the raw TOML are available without validating the rule. Accessing the contents,
+    or any other attribute of TOMLRule, validates the rule the same way as loading it directly.
+    """
+
+    def __init__(self, toml_dict: dict, path: Optional[Path] = None, version_lock=None, gh_pr: Any = None):
+        self.toml_dict = toml_dict
+        self.path = path
+        self.gh_pr = gh_pr
+        self._version_lock = version_lock
+        self._rule: Optional[TOMLRule] = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(path={self.path!r}, validated={self.validated})"
+
+    def __getattr__(self, name: str):
+        # delegate everything else to the validated rule, skipping private attributes which are looked up by pickle
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return getattr(self.validate(), name)
+
+    @property
+    def id(self) -> definitions.UUIDString:
+        return self.toml_dict["rule"]["rule_id"]
+
+    @property
+    def name(self) -> str:
+        return self.toml_dict["rule"]["name"]
+
+    def to_dict(self) -> dict:
+        """Get the same dictionary as TOMLRuleContents.to_dict, normalizing the TOML instead of validating it."""
+        if self._rule is not None:
+            return self._rule.contents.to_dict()
+
+        return nested_normalize(copy.deepcopy(self.toml_dict))
+
+    @cached_property
+    def metadata(self) -> RuleMeta:
+        """Get the validated metadata, without validating the rest of the rule."""
+        if self._rule is not None:
+            return self._rule.contents.metadata
+
+        return RuleMeta.from_dict(self.toml_dict["metadata"])
+
+    @property
+    def validated(self) -> bool:
+        return self._rule is not None
+
+    @property
+    def contents(self) -> TOMLRuleContents:
+        return self.validate().contents
+
+    def validate(self) -> TOMLRule:
+        """Deserialize and validate the rule, including its query, and return the validated rule."""
+        if self._rule is None:
+            contents = TOMLRuleContents.from_dict(self.toml_dict)
+            contents.set_version_lock(self._version_lock)
+            self._rule = TOMLRule(contents=contents, path=self.path, gh_pr=self.gh_pr)
+
+        return self._rule
+
+
 @dataclass(frozen=True)
 class DeprecatedRuleContents(BaseRuleContents):
     metadata: dict
@@ -624,9 +726,10 @@ def downgrade_contents_from_rule(rule: TOMLRule, target_version: str) -> dict:
     return payload
 
 
-def get_unique_query_fields(rule: TOMLRule) -> List[str]:
+def get_unique_query_fields(rule: Union[TOMLRule, LazyTOMLRule]) -> List[str]:
     """Get a list of unique fields used in a rule query from rule contents."""
-    contents = rule.contents.to_api_format()
+    contents = rule.toml_dict['rule'] if isinstance(rule, LazyTOMLRule) and not rule.validated \
+        else rule.contents.to_api_format()
     language = contents.get('language')
     query = contents.get('query')
     if language in ('kuery', 'eql'):
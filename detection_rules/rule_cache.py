@@ -0,0 +1,263 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Persistent cache of parsed and validated rules."""
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import eql
+
+from .rule import DeprecatedRuleContents, QueryRuleData, QueryValidator, RuleMeta, TOMLRuleContents
+from .utils import CURR_DIR, ROOT_DIR, cached, get_cache_path, get_etc_path, hash_files_cached
+
+RULE_CACHE_DIR = Path(get_cache_path("rules"))
+VALIDATION_CACHE_DIR = Path(get_cache_path("validation"))
+SCHEMA_INPUTS = ("ecs_schemas", "beats_schemas", "non-ecs-schema.json", "stack-schema-map.yaml")
+# modules which can change the outcome of validating a query against the schemas
+QUERY_VALIDATION_INPUTS = ("rule_validators.py", "ecs.py", "beats.py", "schema_artifacts.py", "schemas/__init__.py")
+
+RuleContents = Union[TOMLRuleContents, DeprecatedRuleContents]
+
+
+def _expand_files(paths: Iterable[Path]) -> List[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(p for p in path.rglob("*") if p.is_file())
+        else:
+            files.append(path)
+
+    return files
+
+
+@cached
+def get_validation_fingerprint() -> str:
+    """Hash everything besides the rule itself which can change the outcome of validating a rule."""
+    from .packaging import load_current_package_version
+
+    code_dirs = [Path(CURR_DIR), Path(ROOT_DIR) / "kql"]
+    code_files = [p for d in code_dirs for p in d.rglob("*") if p.suffix in (".py", ".g")]
+    schema_files = _expand_files(Path(get_etc_path(name)) for name in SCHEMA_INPUTS)
+
+    digest = hashlib.sha256()
+    digest.update(load_current_package_version().encode("utf-8"))
+    digest.update(hash_files_cached(code_files).encode("utf-8"))
+    digest.update(hash_files_cached(schema_files).encode("utf-8"))
+    return digest.hexdigest()
+
+
+@cached
+def get_query_validation_fingerprint() -> str:
+    """Hash everything besides the query, its index patterns and min_stack_version which can change its validation."""
+    from .packaging import load_current_package_version
+
+    kql_files = [p for p in (Path(ROOT_DIR) / "kql").rglob("*") if p.suffix in (".py", ".g")]
+    code_files = kql_files + [Path(CURR_DIR) / name for name in QUERY_VALIDATION_INPUTS]
+    schema_files = _expand_files(Path(get_etc_path(name)) for name in SCHEMA_INPUTS)
+
+    digest = hashlib.sha256()
+    digest.update(load_current_package_version().encode("utf-8"))
+    digest.update(eql.__version__.encode("utf-8"))
+    digest.update(hash_files_cached(code_files).encode("utf-8"))
+    digest.update(hash_files_cached(schema_files).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _setting_enabled(name: str) -> bool:
+    from .misc import getdefault
+
+    value = getdefault(name)()
+    return value is None or str(value).lower() not in ("0", "false", "no", "off")
+
+
+def cache_enabled() -> bool:
+    """Check if the rule cache is enabled, from DR_RULE_CACHE or the config file (default: enabled)."""
+    return _setting_enabled("rule_cache")
+
+
+def validation_cache_enabled() -> bool:
+    """Check if the validation cache is enabled, from DR_VALIDATION_CACHE or the config file (default: enabled)."""
+    return _setting_enabled("validation_cache")
+
+
+class RuleCache:
+    """Content-addressed cache of validated rule contents, keyed by the TOML bytes and validation fingerprint."""
+
+    def __init__(self, directory: Path = RULE_CACHE_DIR, fingerprint: Optional[str] = None):
+        self.fingerprint = fingerprint or get_validation_fingerprint()
+        self.directory = Path(directory)
+        self.hits = 0
+        self.misses = 0
+        self._pruned = False
+
+    @property
+    def cache_dir(self) -> Path:
+        return self.directory / self.fingerprint[:32]
+
+    @staticmethod
+    def key(toml_bytes: bytes) -> str:
+        return hashlib.sha256(toml_bytes).hexdigest()
+
+    def get(self, toml_bytes: bytes) -> Optional[RuleContents]:
+        """Get previously validated contents for the raw bytes of a TOML file."""
+        path = self.cache_dir / f"{self.key(toml_bytes)}.pickle"
+
+        try:
+            with open(path, "rb") as f:
+                contents = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            self.misses += 1
+            return
+
+        self.hits += 1
+        return contents
+
+    def put(self, toml_bytes: bytes, contents: RuleContents):
+        """Save validated contents for the raw bytes of a TOML file, unless the cache folder can't be written."""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._prune()
+
+            # write to a temp file and rename, so that concurrent readers never see partial files
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        except OSError:
+            # read-only checkouts and installs are loaded without caching
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(contents, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.cache_dir / f"{self.key(toml_bytes)}.pickle")
+        except OSError:
+            # a full cache folder only loses the speedup
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def _prune(self):
+        """Remove entries created with a stale fingerprint."""
+        if self._pruned:
+            return
+
+        for stale in self.directory.iterdir():
+            if stale.is_dir() and stale != self.cache_dir:
+                shutil.rmtree(stale, ignore_errors=True)
+
+        self._pruned = True
+
+    def clear(self):
+        """Remove all cached rules."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def default_cache() -> Optional[RuleCache]:
+    """Get the rule cache used by CLI commands, unless it is disabled."""
+    return RuleCache() if cache_enabled() else None
+
+
+def dump_query_error(exc: eql.errors.EqlParseError) -> dict:
+    """Get the type and arguments of a query error, which can't be unpickled, to rebuild it with load_query_error."""
+    cls = type(exc)
+    return {"type": f"{cls.__module__}.{cls.__qualname__}",
+            "args": [exc.error_msg, exc.line, exc.column, exc.source, exc.caret.count("^"), exc.trailer]}
+
+
+def load_query_error(error: dict) -> eql.errors.EqlParseError:
+    module_name, class_name = error["type"].rsplit(".", 1)
+    cls = getattr(importlib.import_module(module_name), class_name)
+
+    if not (isinstance(cls, type) and issubclass(cls, eql.errors.EqlParseError)):
+        raise TypeError(f"Unexpected error type {error['type']}")
+
+    return cls(*error["args"])
+
+
+class ValidationCache(RuleCache):
+    """Persistent outcomes of validating queries, keyed by the query and everything else its validation depends on.
+
+    Both successes and errors raised by the query parsers are saved, and errors are raised again exactly as they were.
+    """
+
+    def __init__(self, directory: Path = VALIDATION_CACHE_DIR, fingerprint: Optional[str] = None):
+        super().__init__(directory, fingerprint or get_query_validation_fingerprint())
+
+    @staticmethod
+    def get_key(validator: QueryValidator, data: QueryRuleData, meta: RuleMeta) -> str:
+        inputs = [type(validator).__name__, validator.query, data.index, meta.min_stack_version,
+                  meta.query_schema_validation, meta.maturity == "deprecated"]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_outcome(self, key: str):
+        """Get the error of a previous validation, None if it succeeded, or raise a KeyError if it wasn't saved."""
+        try:
+            outcome = json.loads((self.cache_dir / f"{key}.json").read_text())
+            error = outcome["error"]
+            error = load_query_error(error) if error is not None else None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, ImportError):
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        return error
+
+    def put_outcome(self, key: str, error: Optional[eql.errors.EqlParseError] = None):
+        """Save the outcome of validating a query, unless the cache folder can't be written."""
+        contents = json.dumps({"error": dump_query_error(error) if error is not None else None})
+        temp_path = None
+
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._prune()
+
+            temp_path = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+            temp_path.write_text(contents)
+            os.replace(temp_path, self.cache_dir / f"{key}.json")
+        except OSError:
+            # the query was still validated, and is only validated again next time
+            if temp_path is not None:
+                with contextlib.suppress(OSError):
+                    temp_path.unlink()
+
+    def validate(self, validator: QueryValidator, data: QueryRuleData, meta: RuleMeta):
+        """Validate a query, unless the outcome of validating it with the same inputs was saved."""
+        from .rule_validators import record_cached_validation
+
+        start = time.perf_counter()
+        key = self.get_key(validator, data, meta)
+
+        try:
+            error = self.get_outcome(key)
+        except KeyError:
+            pass
+        else:
+            record_cached_validation(validator.language, start)
+            if error is not None:
+                raise error
+            return
+
+        try:
+            validator.validate(data, meta)
+        except eql.errors.EqlParseError as exc:
+            self.put_outcome(key, exc)
+            raise
+
+        self.put_outcome(key)
+
+
+@cached
+def default_validation_cache() -> ValidationCache:
+    """Get the validation cache shared by every rule loaded by this process."""
+    return ValidationCache()
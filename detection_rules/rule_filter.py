@@ -0,0 +1,193 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Compile filters over rule dictionaries into predicates.
+
+A filter is a mapping of dotted (or __ delimited) paths to conditions, all of which must match:
+
+    {"metadata.maturity": "production",                 # equality
+     "rule.type": ["eql", "query"],                     # any of the values
+     "rule.name": {"glob": "*PowerShell*"},             # operators, which must all match
+     "rule.risk_score": {"gte": 47, "lt": 73},
+     "or": [{"rule.tags": "Windows"}, {"not": {"rule.language": "eql"}}]}
+
+The keys `and`, `or` and `not` combine nested filters. When a path leads to a list, the condition matches if any of the
+values in the list do, and paths which don't exist never match, besides `{"exists": false}`.
+"""
+import fnmatch
+import operator
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+Predicate = Callable[[dict], bool]
+FilterSpec = Union[Dict[str, Any], List[Dict[str, Any]]]
+
+RANGE_OPERATORS = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+VALUE_OPERATORS = ("eq", "in", "glob", "regex", "exists") + tuple(RANGE_OPERATORS)
+
+MISSING = object()
+
+
+def _always(_obj: dict) -> bool:
+    return True
+
+
+def _compile_keys(keys: Tuple[str, ...]) -> Callable[[Any], Any]:
+    key, rest = keys[0], keys[1:]
+    get_rest = _compile_keys(rest) if rest else None
+
+    def getter(obj: Any) -> Any:
+        if isinstance(obj, list):
+            # descend into each entry of a list, such as rule.threat.tactic.id
+            values = []
+            for entry in obj:
+                value = getter(entry)
+                if value is not MISSING:
+                    values.extend(value if isinstance(value, list) else [value])
+            return values or MISSING
+
+        elif not isinstance(obj, dict) or key not in obj:
+            return MISSING
+
+        return obj[key] if get_rest is None else get_rest(obj[key])
+
+    return getter
+
+
+def compile_path(path: str) -> Callable[[Any], Any]:
+    """Get a callable that returns the value at a dotted (or __ delimited) path, or MISSING."""
+    return _compile_keys(tuple(path.replace("__", ".").split(".")))
+
+
+def _normalize(value: Any, case_sensitive: bool) -> Any:
+    return value if case_sensitive or not isinstance(value, str) else value.lower()
+
+
+def _compile_value_check(op: str, expected: Any, case_sensitive: bool) -> Callable[[Any], bool]:
+    """Compile a check of a single value (not a list) against an operator."""
+    if op == "eq":
+        expected = _normalize(expected, case_sensitive)
+        return lambda value: _normalize(value, case_sensitive) == expected
+
+    elif op == "in":
+        expected = [_normalize(e, case_sensitive) for e in expected]
+        try:
+            expected = frozenset(expected)
+        except TypeError:
+            # unhashable values are checked with a linear scan
+            pass
+        return lambda value: _normalize(value, case_sensitive) in expected
+
+    elif op in ("glob", "regex"):
+        pattern = fnmatch.translate(expected) if op == "glob" else expected
+        search = re.compile(pattern, 0 if case_sensitive else re.IGNORECASE).search
+        return lambda value: isinstance(value, str) and search(value) is not None
+
+    elif op in RANGE_OPERATORS:
+        compare = RANGE_OPERATORS[op]
+
+        def check(value: Any) -> bool:
+            try:
+                return compare(value, expected)
+            except TypeError:
+                return False
+
+        return check
+
+    raise ValueError(f"Unknown filter operator {op}, expected one of: {', '.join(VALUE_OPERATORS)}")
+
+
+def _compile_condition(path: str, condition: Any, case_sensitive: bool) -> Predicate:
+    """Compile a condition on the value at a path."""
+    getter = compile_path(path)
+
+    if isinstance(condition, dict):
+        operators = dict(condition)
+    elif isinstance(condition, (list, set, tuple)):
+        operators = {"in": condition}
+    else:
+        operators = {"eq": condition}
+
+    exists = operators.pop("exists", True)
+    checks = tuple(_compile_value_check(op, expected, case_sensitive) for op, expected in operators.items())
+
+    if len(checks) == 1:
+        check, = checks
+    else:
+        def check(value: Any) -> bool:
+            for c in checks:
+                if not c(value):
+                    return False
+            return True
+
+    if not exists:
+        return lambda obj: getter(obj) in (MISSING, None)
+
+    def predicate(obj: dict) -> bool:
+        value = getter(obj)
+
+        if value is MISSING or value is None:
+            return False
+        elif isinstance(value, list):
+            return any(check(v) for v in value)
+
+        return check(value)
+
+    return predicate
+
+
+def _compile_all(predicates: List[Predicate]) -> Predicate:
+    if not predicates:
+        return _always
+    elif len(predicates) == 1:
+        return predicates[0]
+
+    predicates = tuple(predicates)
+
+    def predicate(obj: dict) -> bool:
+        for p in predicates:
+            if not p(obj):
+                return False
+        return True
+
+    return predicate
+
+
+def _compile_any(predicates: List[Predicate]) -> Predicate:
+    if not predicates:
+        return lambda obj: False
+    elif len(predicates) == 1:
+        return predicates[0]
+
+    predicates = tuple(predicates)
+
+    def predicate(obj: dict) -> bool:
+        for p in predicates:
+            if p(obj):
+                return True
+        return False
+
+    return predicate
+
+
+def compile_filter(spec: Optional[FilterSpec] = None, case_sensitive=True, **criteria) -> Predicate:
+    """Compile a filter, from a mapping and/or keyword arguments, into a callable that checks a dictionary."""
+    spec = spec or {}
+    if isinstance(spec, list):
+        return _compile_all([compile_filter(s, case_sensitive) for s in spec])
+
+    predicates = []
+    for key, condition in dict(spec, **criteria).items():
+        if key == "and":
+            predicates.append(compile_filter(condition, case_sensitive))
+        elif key == "or":
+            predicates.append(_compile_any([compile_filter(s, case_sensitive) for s in condition]))
+        elif key == "not":
+            negated = compile_filter(condition, case_sensitive)
+            predicates.append(lambda obj, negated=negated: not negated(obj))
+        else:
+            predicates.append(_compile_condition(key, condition, case_sensitive))
+
+    return _compile_all(predicates)
@@ -0,0 +1,104 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Persistent index of rule IDs and names to rule files."""
+import contextlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pytoml
+
+from .rule_loader import DEFAULT_RULES_DIR
+from .utils import get_cache_path
+
+RULE_INDEX_FILE = Path(get_cache_path("rule-index.json"))
+
+
+class RuleIndex:
+    """Map rule IDs and names to the files which define them, without validating the rules."""
+
+    __default = None
+
+    def __init__(self, directory: Path = DEFAULT_RULES_DIR, index_file: Optional[Path] = RULE_INDEX_FILE):
+        self.directory = Path(directory).resolve()
+        self.index_file = index_file
+        self.entries: Dict[str, dict] = {}
+
+        if index_file is not None:
+            try:
+                saved = json.loads(index_file.read_text())
+                if saved.get("directory") == str(self.directory):
+                    self.entries = saved["entries"]
+            except (OSError, ValueError, KeyError, AttributeError):
+                # rebuild a missing, unreadable or corrupted index
+                self.entries = {}
+
+    @staticmethod
+    def _read_entry(path: Path, stat: os.stat_result) -> dict:
+        contents = pytoml.loads(path.read_text(encoding="utf-8"))
+        rule = contents.get("rule", {})
+        return {"rule_id": rule.get("rule_id"), "name": rule.get("name"),
+                "mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+    def refresh(self) -> bool:
+        """Re-read only the files added or changed since the index was saved and drop deleted ones."""
+        current = {}
+        changed = False
+
+        for path in sorted(self.directory.rglob("*.toml")):
+            stat = path.stat()
+            key = str(path)
+            entry = self.entries.get(key)
+
+            if entry is None or (entry["mtime"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+                try:
+                    entry = self._read_entry(path, stat)
+                except pytoml.TomlError:
+                    # invalid files are still indexed, so they aren't re-read until they change
+                    entry = {"rule_id": None, "name": None, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+                changed = True
+
+            current[key] = entry
+
+        changed = changed or len(current) != len(self.entries)
+        self.entries = current
+
+        if changed and self.index_file is not None:
+            self.save()
+
+        return changed
+
+    def save(self):
+        """Save the index to disk, unless the cache folder can't be written."""
+        temp_file = self.index_file.with_suffix(f".{os.getpid()}.tmp")
+
+        try:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file.write_text(json.dumps({"directory": str(self.directory), "entries": self.entries},
+                                            sort_keys=True))
+            os.replace(temp_file, self.index_file)
+        except OSError:
+            # read-only checkouts and installs rebuild the index in memory each time
+            with contextlib.suppress(OSError):
+                temp_file.unlink()
+
+    def get_paths(self, rule_ids: Optional[List[str]] = None, names: Optional[List[str]] = None) -> List[Path]:
+        """Get the paths to files which define any of the rule IDs or names."""
+        rule_ids = set(rule_ids or [])
+        names = set(names or [])
+
+        return [Path(path) for path, entry in sorted(self.entries.items())
+                if entry["rule_id"] in rule_ids or entry["name"] in names]
+
+    @classmethod
+    def default(cls) -> "RuleIndex":
+        """Return the refreshed index of the default rules directory."""
+        if cls.__default is None:
+            cls.__default = cls()
+
+        cls.__default.refresh()
+        return cls.__default
@@ -4,19 +4,25 @@
 # 2.0.
 
 """Load rule metadata transform between rule and api formats."""
+import dataclasses
 import io
+import pickle
+import time
 from collections import OrderedDict
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Iterable, Callable, Optional, Union
+from typing import Any, Dict, List, Iterable, Callable, Optional, Set, Tuple, Union
 
 import click
+import eql
 import pytoml
 from marshmallow.exceptions import ValidationError
 
 from . import utils
 from .mappings import RtaMappings
-from .rule import DeprecatedRule, DeprecatedRuleContents, TOMLRule, TOMLRuleContents
+from .rule_cache import RuleCache, RuleContents, default_cache, dump_query_error, load_query_error
+from .rule_filter import MISSING, FilterSpec, compile_filter, compile_path
+from .rule import DeprecatedRule, DeprecatedRuleContents, LazyTOMLRule, ThreatMapping, TOMLRule, TOMLRuleContents
 from .schemas import definitions
 from .utils import get_path, cached
 
@@ -24,43 +30,32 @@ DEFAULT_RULES_DIR = Path(get_path("rules"))
 DEFAULT_DEPRECATED_DIR = DEFAULT_RULES_DIR / '_deprecated'
 RTA_DIR = get_path("rta")
 FILE_PATTERN = r'^([a-z0-9_])+\.(json|toml)$'
+GITHUB_PR_CACHE_SIZE = 4
 
+# fields with values repeated across many rules, which are interned by compact collections
+INTERNED_KEYS = frozenset(["author", "creation_date", "framework", "id", "index", "integration", "language", "license",
+                           "maturity", "min_stack_version", "name", "os_type_list", "reference", "severity", "tags",
+                           "timestamp_override", "type", "updated_date"])
 
-def path_getter(value: str) -> Callable[[dict], bool]:
+
+def path_getter(value: str) -> Callable[[dict], Any]:
     """Get the path from a Python object."""
-    path = value.replace("__", ".").split(".")
+    getter = compile_path(value)
 
     def callback(obj: dict):
-        for p in path:
-            if isinstance(obj, dict) and p in path:
-                obj = obj[p]
-            else:
-                return None
-
-        return obj
+        value = getter(obj)
+        return None if value is MISSING else value
 
     return callback
 
 
 def dict_filter(_obj: Optional[dict] = None, **critieria) -> Callable[[dict], bool]:
-    """Get a callable that will return true if a dictionary matches a set of criteria.
+    """Get a callable that will return true if a dictionary matches all of a set of criteria.
 
     * each key is a dotted (or __ delimited) path into a dictionary to check
-    * each value is a value or list of values to match
+    * each value is a value or list of values to match, or any filter supported by compile_filter
     """
-    critieria.update(_obj or {})
-    checkers = [(path_getter(k), set(v) if isinstance(v, (list, set, tuple)) else {v}) for k, v in critieria.items()]
-
-    def callback(obj: dict) -> bool:
-        for getter, expected in checkers:
-            target_values = getter(obj)
-            target_values = set(target_values) if isinstance(target_values, (list, set, tuple)) else {target_values}
-
-            return bool(expected.intersection(target_values))
-
-        return False
-
-    return callback
+    return compile_filter(_obj, **critieria)
 
 
 def metadata_filter(**metadata) -> Callable[[TOMLRule], bool]:
@@ -77,6 +72,61 @@ def metadata_filter(**metadata) -> Callable[[TOMLRule], bool]:
 production_filter = metadata_filter(maturity="production")
 
 
+def _get_query_fields(rule: TOMLRule) -> List[str]:
+    from .rule import get_unique_query_fields
+    return get_unique_query_fields(rule) or []
+
+
+def _get_technique_ids(rule: TOMLRule) -> List[str]:
+    flat_threat = ThreatMapping.flatten(rule.contents.data.threat)
+    return flat_threat.technique_ids + flat_threat.sub_technique_ids
+
+
+# fields which can be queried with RuleCollection.query, and the values of each field for a rule
+INDEXED_FIELDS: Dict[str, Callable[[TOMLRule], Iterable[Any]]] = {
+    "type": lambda r: [r.contents.data.type],
+    "language": lambda r: [getattr(r.contents.data, "language", None)],
+    "maturity": lambda r: [r.contents.metadata.maturity],
+    "tags": lambda r: r.contents.data.tags or [],
+    "index": lambda r: getattr(r.contents.data, "index", None) or [],
+    "integration": lambda r: [r.contents.metadata.integration],
+    "min_stack_version": lambda r: [r.contents.metadata.min_stack_version],
+    "tactic": lambda r: ThreatMapping.flatten(r.contents.data.threat).tactic_ids,
+    "technique": _get_technique_ids,
+    "fields": _get_query_fields,
+}
+
+
+# paths in the TOML of the INDEXED_FIELDS, to index lazy rules without validating them
+LAZY_INDEXED_PATHS: Dict[str, List[Callable[[dict], Any]]] = {
+    "type": [compile_path("rule.type")],
+    "language": [compile_path("rule.language")],
+    "maturity": [compile_path("metadata.maturity")],
+    "tags": [compile_path("rule.tags")],
+    "index": [compile_path("rule.index")],
+    "integration": [compile_path("metadata.integration")],
+    "min_stack_version": [compile_path("metadata.min_stack_version")],
+    "tactic": [compile_path("rule.threat.tactic.id")],
+    "technique": [compile_path("rule.threat.technique.id"), compile_path("rule.threat.technique.subtechnique.id")],
+}
+
+
+def _get_indexed_values(rule: Union[TOMLRule, LazyTOMLRule], name: str) -> Iterable[Any]:
+    if isinstance(rule, LazyTOMLRule) and not rule.validated and name in LAZY_INDEXED_PATHS:
+        values = []
+        for getter in LAZY_INDEXED_PATHS[name]:
+            value = getter(rule.toml_dict)
+            if value is not MISSING:
+                values.extend(value if isinstance(value, list) else [value])
+        return values
+
+    return INDEXED_FIELDS[name](rule)
+
+
+def _index_value(value: Any) -> Any:
+    return value.lower() if isinstance(value, str) else value
+
+
 def load_locks_from_tag(remote: str, tag: str) -> (str, dict, dict):
     """Loads version and deprecated lock files from git tag."""
     import json
@@ -103,6 +153,47 @@ def load_locks_from_tag(remote: str, tag: str) -> (str, dict, dict):
     return commit_hash, version, deprecated
 
 
+def get_load_processes() -> int:
+    """Get the number of processes used to load rules, from DR_LOAD_PROCESSES or the config file."""
+    from .misc import getdefault
+
+    processes = getdefault('load_processes')()
+    return int(processes) if processes else 1
+
+
+@dataclass
+class RuleChange:
+    """A rule file which was added, modified or deleted since it was last loaded."""
+
+    status: str
+    path: Path
+    elapsed: float = 0.0
+    error: Optional[Exception] = None
+
+
+@dataclass
+class RuleTiming:
+    """Time spent parsing and validating a rule file, with the time spent validating queries broken down."""
+
+    path: Path
+    elapsed: float = 0.0
+    languages: Dict[str, float] = field(default_factory=dict)
+    stack_versions: Dict[str, float] = field(default_factory=dict)
+    cached_validation: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+    cached: bool = False
+
+    @property
+    def schema_elapsed(self) -> float:
+        """Time spent outside of query validation, mostly deserializing and validating the rule with marshmallow."""
+        return max(0.0, self.elapsed - sum(self.languages.values()) - sum(self.cached_validation.values()))
+
+    def to_dict(self) -> dict:
+        return {"path": str(self.path), "elapsed": self.elapsed, "schema": self.schema_elapsed, "cached": self.cached,
+                "languages": self.languages, "stack_versions": self.stack_versions,
+                "cached_validation": self.cached_validation, "error": self.error}
+
+
 @dataclass
 class BaseCollection:
     """Base class for collections."""
@@ -145,7 +236,8 @@ class RuleCollection(BaseCollection):
 
     __default = None
 
-    def __init__(self, rules: Optional[List[TOMLRule]] = None):
+    def __init__(self, rules: Optional[List[TOMLRule]] = None, cache: Optional[RuleCache] = None, lazy=False,
+                 compact=False):
         from .version_lock import VersionLock
 
         self.id_map: Dict[definitions.UUIDString, TOMLRule] = {}
@@ -154,9 +246,15 @@ class RuleCollection(BaseCollection):
         self.deprecated: DeprecatedCollection = DeprecatedCollection()
         self.errors: Dict[Path, Exception] = {}
         self.frozen = False
+        self.cache = cache
+        self.lazy = lazy
+        self.compact = compact
 
         self._toml_load_cache: Dict[Path, dict] = {}
         self._version_lock: Optional[VersionLock] = None
+        self._watched_dirs: Dict[Path, bool] = {}
+        self._file_stats: Dict[Path, Tuple[int, int]] = {}
+        self._indexes: Dict[str, Dict[Any, Set[definitions.UUIDString]]] = {}
 
         for rule in (rules or []):
             self.add_rule(rule)
@@ -174,6 +272,56 @@ class RuleCollection(BaseCollection):
 
         return filtered_collection
 
+    def _get_index(self, name: str) -> Dict[Any, Set[definitions.UUIDString]]:
+        """Get the map of values to rule IDs for an indexed field, building it on first use."""
+        if name not in INDEXED_FIELDS:
+            raise ValueError(f"Unable to query rules by {name}, expected one of: {', '.join(INDEXED_FIELDS)}")
+
+        if name not in self._indexes:
+            self._indexes[name] = {}
+            for rule in self.rules:
+                self._index_rule(rule, name)
+
+        return self._indexes[name]
+
+    def _index_rule(self, rule: TOMLRule, *names: str):
+        for name in names or self._indexes:
+            for value in _get_indexed_values(rule, name):
+                if value is not None:
+                    self._indexes[name].setdefault(_index_value(value), set()).add(rule.id)
+
+    def _unindex_rule(self, rule: TOMLRule):
+        for index in self._indexes.values():
+            for rule_ids in index.values():
+                rule_ids.discard(rule.id)
+
+    def query(self, **criteria: Union[Any, Iterable[Any]]) -> 'RuleCollection':
+        """Retrieve the rules matching every criteria, using indexes which are kept up to date as rules are added.
+
+        * each key is one of the INDEXED_FIELDS
+        * each value is a value or list of values, any of which can match (case-insensitive)
+        """
+        matched: Optional[Set[definitions.UUIDString]] = None
+
+        # intersect the smallest sets first
+        candidates = []
+        for name, values in criteria.items():
+            index = self._get_index(name)
+            values = values if isinstance(values, (list, set, tuple)) else [values]
+            candidates.append(set().union(*(index.get(_index_value(v), ()) for v in values)))
+
+        for rule_ids in sorted(candidates, key=len):
+            matched = rule_ids if matched is None else matched & rule_ids
+            if not matched:
+                break
+
+        filtered_collection = RuleCollection()
+        for rule in self.rules:
+            if matched is None or rule.id in matched:
+                filtered_collection.add_rule(rule)
+
+        return filtered_collection
+
     @staticmethod
     def deserialize_toml_string(contents: Union[bytes, str]) -> dict:
         return pytoml.loads(contents)
@@ -214,51 +362,145 @@ class RuleCollection(BaseCollection):
         self._assert_new(rule)
         self.id_map[rule.id] = rule
         self.rules.append(rule)
+        self._index_rule(rule)
 
     def add_deprecated_rule(self, rule: DeprecatedRule):
         self._assert_new(rule, is_deprecated=True)
         self.deprecated.id_map[rule.id] = rule
         self.deprecated.rules.append(rule)
 
-    def load_dict(self, obj: dict, path: Optional[Path] = None) -> Union[TOMLRule, DeprecatedRule]:
+    @staticmethod
+    def contents_from_dict(obj: dict) -> Union[TOMLRuleContents, DeprecatedRuleContents]:
+        """Deserialize and validate rule contents without adding them to a collection."""
         # bypass rule object load (load_dict) and load as a dict only
         if obj.get('metadata', {}).get('maturity', '') == 'deprecated':
-            contents = DeprecatedRuleContents.from_dict(obj)
-            contents.set_version_lock(self._version_lock)
+            return DeprecatedRuleContents.from_dict(obj)
+        else:
+            return TOMLRuleContents.from_dict(obj)
+
+    def add_contents(self, contents: Union[TOMLRuleContents, DeprecatedRuleContents],
+                     path: Optional[Path] = None) -> Union[TOMLRule, DeprecatedRule]:
+        """Wrap validated contents in a rule object and add it to the collection."""
+        contents.set_version_lock(self._version_lock)
+
+        if self.compact:
+            utils.intern_strings(contents, INTERNED_KEYS)
+
+        if isinstance(contents, DeprecatedRuleContents):
             deprecated_rule = DeprecatedRule(path, contents)
             self.add_deprecated_rule(deprecated_rule)
             return deprecated_rule
         else:
-            contents = TOMLRuleContents.from_dict(obj)
-            contents.set_version_lock(self._version_lock)
             rule = TOMLRule(path=path, contents=contents)
             self.add_rule(rule)
             return rule
 
+    def load_dict(self, obj: dict, path: Optional[Path] = None) -> Union[TOMLRule, DeprecatedRule]:
+        return self.add_contents(self.contents_from_dict(obj), path=path)
+
+    def _load_from_default(self, path: Path) -> Optional[Union[TOMLRule, DeprecatedRule]]:
+        """Reuse a rule already loaded by the default collection."""
+        if self.__default is not None and self is not self.__default:
+            if path in self.__default.file_map:
+                rule = self.__default.file_map[path]
+                self.add_rule(rule)
+                return rule
+            elif path in self.__default.deprecated.file_map:
+                deprecated_rule = self.__default.deprecated.file_map[path]
+                self.add_deprecated_rule(deprecated_rule)
+                return deprecated_rule
+
+    def _in_default(self, path: Path) -> bool:
+        if self.__default is None or self is self.__default:
+            return False
+
+        return path in self.__default.file_map or path in self.__default.deprecated.file_map
+
     def load_file(self, path: Path) -> Union[TOMLRule, DeprecatedRule]:
         try:
             path = path.resolve()
 
             # use the default rule loader as a cache.
             # if it already loaded the rule, then we can just use it from that
-            if self.__default is not None and self is not self.__default:
-                if path in self.__default.file_map:
-                    rule = self.__default.file_map[path]
-                    self.add_rule(rule)
-                    return rule
-                elif path in self.__default.deprecated.file_map:
-                    deprecated_rule = self.__default.deprecated.file_map[path]
-                    self.add_deprecated_rule(deprecated_rule)
-                    return deprecated_rule
+            rule = self._load_from_default(path)
+            if rule is not None:
+                return rule
+
+            if self.lazy:
+                return self._load_lazy_file(path)
+
+            if self.cache is not None:
+                return self._load_cached_file(path)
 
             obj = self._load_toml_file(path)
             return self.load_dict(obj, path=path)
         except Exception:
             print(f"Error loading rule in {path}")
             raise
+        finally:
+            if self.compact:
+                self._toml_load_cache.pop(path, None)
+
+    def _load_lazy_file(self, path: Path) -> Union[TOMLRule, LazyTOMLRule, DeprecatedRule]:
+        """Load a file without validating it, unless it was already validated in the rule cache."""
+        if self.cache is not None:
+            contents = self.cache.get(path.read_bytes())
+            if contents is not None:
+                return self.add_contents(contents, path)
+
+        obj = self._load_toml_file(path)
+        if obj.get('metadata', {}).get('maturity', '') == 'deprecated':
+            return self.load_dict(obj, path=path)
+
+        if self.compact:
+            obj = utils.intern_strings(obj, INTERNED_KEYS)
+
+        rule = LazyTOMLRule(obj, path=path, version_lock=self._version_lock)
+        self.add_rule(rule)
+        return rule
+
+    def validate(self):
+        """Validate every lazily loaded rule, replacing them with the validated rules.
+
+        Errors for every invalid rule are recorded, and the first one is raised after validating the rest.
+        """
+        errors = []
+
+        for i, rule in enumerate(self.rules):
+            if not isinstance(rule, LazyTOMLRule):
+                continue
+
+            try:
+                validated = rule.validate()
+            except Exception as e:
+                print(f"Error loading rule in {rule.path}")
+                self.errors[rule.path] = e
+                errors.append(e)
+                continue
+
+            self.rules[i] = validated
+            self.id_map[validated.id] = validated
+            if validated.path is not None:
+                self.file_map[validated.path.resolve()] = validated
+
+        if errors:
+            raise errors[0]
+
+    def _load_cached_file(self, path: Path) -> Union[TOMLRule, DeprecatedRule]:
+        """Load a file from the rule cache, or validate it and add it to the cache."""
+        toml_bytes = path.read_bytes()
+        contents = self.cache.get(toml_bytes)
 
-    def load_git_tag(self, branch: str, remote: Optional[str] = None, skip_query_validation=False):
-        """Load rules from a Git branch."""
+        if contents is None:
+            contents = self.contents_from_dict(self._load_toml_file(path))
+            self.cache.put(toml_bytes, contents)
+
+        return self.add_contents(contents, path)
+
+    def load_git_tag(self, branch: str, remote: Optional[str] = None, skip_query_validation=False,
+                     processes: Optional[int] = None,
+                     blob_cache: Optional[Dict[Tuple[str, bool], RuleContents]] = None):
+        """Load rules from a Git branch, optionally sharing rules parsed from identical git blobs."""
         from .version_lock import VersionLock
 
         commit_hash, v_lock, d_lock = load_locks_from_tag(remote, branch)
@@ -269,43 +511,253 @@ class RuleCollection(BaseCollection):
         version_lock = VersionLock(version_lock=v_lock, deprecated_lock=d_lock, name=v_lock_name)
         self._version_lock = version_lock
 
-        git = utils.make_git()
-        rules_dir = DEFAULT_RULES_DIR.relative_to(get_path("."))
-        paths = git("ls-tree", "-r", "--name-only", branch, rules_dir).splitlines()
+        blobs = self._read_git_rules(branch)
+        blob_cache = {} if blob_cache is None else blob_cache
+        shared = {path: blob_cache[object_id, skip_query_validation] for path, (object_id, _) in blobs.items()
+                  if (object_id, skip_query_validation) in blob_cache}
+        pending = [path for path in blobs if path not in shared]
+        processes = get_load_processes() if processes is None else processes
+        loaded = {}
+        worker_errors = {}
 
-        for path in paths:
-            path = Path(path)
-            if path.suffix != ".toml":
-                continue
+        if processes > 1 and pending:
+            jobs = [(path, blobs[path][1], skip_query_validation) for path in pending]
+            chunksize = max(1, len(jobs) // (processes * 4))
 
-            contents = git("show", f"{branch}:{path}")
-            toml_dict = self.deserialize_toml_string(contents)
+            with _start_pool(processes) as pool:
+                for path, contents, error in pool.imap_unordered(_load_git_rule_worker, jobs, chunksize=chunksize):
+                    loaded[path] = contents
+                    if error is not None:
+                        worker_errors[path] = _load_worker_error(error)
 
-            if skip_query_validation:
-                toml_dict['metadata']['query_schema_validation'] = False
+        for path, (object_id, text) in blobs.items():
+            contents = shared.get(path) or loaded.get(path)
 
             try:
-                self.load_dict(toml_dict, path)
+                if path in worker_errors:
+                    raise worker_errors[path]
+                elif contents is None:
+                    contents = _parse_rule(text, skip_query_validation)
+
+                blob_cache[object_id, skip_query_validation] = contents
+                # each revision gets its own contents object, to hold its version lock, but shares the rule data
+                self.add_contents(dataclasses.replace(contents), path)
             except ValidationError as e:
                 self.errors[path] = e
                 continue
 
-    def load_files(self, paths: Iterable[Path]):
+    @staticmethod
+    def _read_git_rules(branch: str) -> Dict[Path, Tuple[str, str]]:
+        """Read the blob ID and contents of every rule file within a git ref, in sorted path order."""
+        rules_dir = DEFAULT_RULES_DIR.relative_to(get_path("."))
+        blobs = {Path(path): object_id for path, object_id in utils.git_ls_blobs(branch, str(rules_dir)).items()
+                 if path.endswith(".toml")}
+        contents = dict(utils.read_git_blobs(set(blobs.values())))
+
+        return {path: (object_id, contents[object_id].decode("utf-8")) for path, object_id in sorted(blobs.items())}
+
+    def load_files(self, paths: Iterable[Path], processes: Optional[int] = None):
         """Load multiple files into the collection."""
+        # lazy rules are only parsed, which isn't worth spreading across processes
+        if processes is not None and processes > 1 and not self.lazy:
+            return self._load_files_parallel(paths, processes)
+
         for path in paths:
             self.load_file(path)
 
-    def load_directory(self, directory: Path, recursive=True, toml_filter: Optional[Callable[[dict], bool]] = None):
+    def _load_files_parallel(self, paths: Iterable[Path], processes: int):
+        """Parse and validate files across a pool of processes and add them in sorted path order."""
+        paths = sorted(path.resolve() for path in paths)
+        pending = [path for path in paths if not self._in_default(path)]
+        loaded = {}
+        raw_files = {}
+
+        if self.cache is not None:
+            raw_files = {path: path.read_bytes() for path in pending}
+            loaded = {path: self.cache.get(raw_files[path]) for path in pending}
+            pending = [path for path in pending if loaded[path] is None]
+
+        worker_errors = {}
+
+        if pending:
+            chunksize = max(1, len(pending) // (processes * 4))
+            with _start_pool(processes) as pool:
+                for path, contents, error in pool.imap_unordered(_load_rule_worker, pending, chunksize=chunksize):
+                    loaded[path] = contents
+                    if error is not None:
+                        worker_errors[path] = _load_worker_error(error)
+                    elif self.cache is not None:
+                        self.cache.put(raw_files[path], contents)
+
+        errors = []
+        for path in paths:
+            contents = loaded.get(path)
+
+            try:
+                if path in worker_errors:
+                    print(f"Error loading rule in {path}")
+                    raise worker_errors[path]
+                elif contents is None:
+                    # shared with the default collection
+                    self.load_file(path)
+                else:
+                    self.add_contents(contents, path)
+            except Exception as e:
+                self.errors[path] = e
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+
+    def load_files_timed(self, paths: Iterable[Path], processes: Optional[int] = None) -> List[RuleTiming]:
+        """Validate and add every file, timing each and collecting every error in self.errors instead of raising."""
+        paths = sorted(path.resolve() for path in paths)
+        pending = paths
+        results = {}
+        raw_files = {}
+
+        if self.cache is not None:
+            raw_files = {path: path.read_bytes() for path in paths}
+            for path in paths:
+                contents = self.cache.get(raw_files[path])
+                if contents is not None:
+                    results[path] = (contents, RuleTiming(path, cached=True))
+            pending = [path for path in paths if path not in results]
+
+        if processes is not None and processes > 1 and len(pending) > 1:
+            chunksize = max(1, len(pending) // (processes * 4))
+            with _start_pool(processes) as pool:
+                validated = list(pool.imap_unordered(_time_rule_worker, pending, chunksize=chunksize))
+        else:
+            validated = [_time_rule_worker(path) for path in pending]
+
+        for path, contents, timing, error in validated:
+            results[path] = (contents, timing)
+            if error is not None:
+                self.errors[path] = _load_worker_error(error)
+            elif self.cache is not None:
+                self.cache.put(raw_files[path], contents)
+
+        timings = []
+        for path in paths:
+            contents, timing = results[path]
+            timings.append(timing)
+
+            if contents is None:
+                continue
+
+            try:
+                self.add_contents(contents, path)
+            except Exception as e:
+                self.errors[path] = e
+                timing.error = timing.error or f'{type(e).__name__}: {e}'
+
+        return timings
+
+    def load_directory_timed(self, directory: Path, recursive=True,
+                             processes: Optional[int] = None) -> List[RuleTiming]:
+        return self.load_files_timed(self._get_paths(directory, recursive=recursive), processes=processes)
+
+    def load_directory(self, directory: Path, recursive=True,
+                       toml_filter: Optional[Union[Callable[[dict], bool], FilterSpec]] = None,
+                       processes: Optional[int] = None):
         paths = self._get_paths(directory, recursive=recursive)
         if toml_filter is not None:
+            toml_filter = toml_filter if callable(toml_filter) else compile_filter(toml_filter)
             paths = [path for path in paths if toml_filter(self._load_toml_file(path))]
 
-        self.load_files(paths)
+        self.load_files(paths, processes=processes)
 
     def load_directories(self, directories: Iterable[Path], recursive=True,
-                         toml_filter: Optional[Callable[[dict], bool]] = None):
+                         toml_filter: Optional[Union[Callable[[dict], bool], FilterSpec]] = None,
+                         processes: Optional[int] = None):
         for path in directories:
-            self.load_directory(path, recursive=recursive, toml_filter=toml_filter)
+            self.load_directory(path, recursive=recursive, toml_filter=toml_filter, processes=processes)
+
+    def remove_file(self, path: Path) -> Optional[Union[TOMLRule, DeprecatedRule]]:
+        """Remove a loaded rule or deprecated rule from the collection by its path."""
+        assert not self.frozen, f"Unable to remove rule {path} from a frozen collection"
+        path = path.resolve()
+        self._toml_load_cache.pop(path, None)
+        self.errors.pop(path, None)
+
+        for collection in (self, self.deprecated):
+            rule = collection.file_map.pop(path, None)
+
+            if rule is not None:
+                collection.id_map.pop(rule.id, None)
+                collection.rules = [r for r in collection.rules if r is not rule]
+
+                if collection is self:
+                    self._unindex_rule(rule)
+                return rule
+
+    def watch_directory(self, directory: Path, recursive=True):
+        """Load a directory and track its files, so that changes can be loaded later with reload_changes."""
+        self._watched_dirs[directory.resolve()] = recursive
+
+        for path in self._get_paths(directory, recursive=recursive):
+            self._reload_file(path.resolve())
+
+    def _reload_file(self, path: Path) -> Optional[Exception]:
+        """(Re)load a watched file, bypassing the default collection and recording any errors."""
+        try:
+            stat = path.stat()
+        except OSError:
+            # removed since it was listed, such as an editor's lock file, so it's treated as deleted
+            self._file_stats.pop(path, None)
+            return
+
+        self._file_stats[path] = stat.st_mtime_ns, stat.st_size
+        self._toml_load_cache.pop(path, None)
+
+        try:
+            if self.cache is not None:
+                self._load_cached_file(path)
+            else:
+                self.load_dict(self._load_toml_file(path), path=path)
+        except Exception as e:
+            self.errors[path] = e
+            return e
+
+    def reload_changes(self) -> List[RuleChange]:
+        """Reload only the watched files which were added, modified or deleted since they were last loaded."""
+        current = {}
+        for directory, recursive in self._watched_dirs.items():
+            for path in self._get_paths(directory, recursive=recursive):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    # deleted since the directory was listed, or a dangling link such as an editor's lock file
+                    continue
+
+                current[path.resolve()] = stat.st_mtime_ns, stat.st_size
+
+        changes = []
+        for path in sorted(set(current) | set(self._file_stats)):
+            if path not in current:
+                status = 'deleted'
+            elif path not in self._file_stats:
+                status = 'added'
+            elif current[path] != self._file_stats[path]:
+                status = 'modified'
+            else:
+                continue
+
+            start = time.perf_counter()
+            self.remove_file(path)
+            error = None
+
+            if status == 'deleted':
+                self._file_stats.pop(path)
+            else:
+                error = self._reload_file(path)
+                if path not in self._file_stats:
+                    status = 'deleted'
+
+            changes.append(RuleChange(status, path, time.perf_counter() - start, error))
+
+        return changes
 
     def freeze(self):
         """Freeze the rule collection and make it immutable going forward."""
@@ -315,13 +767,24 @@ class RuleCollection(BaseCollection):
     def default(cls) -> 'RuleCollection':
         """Return the default rule collection, which retrieves from rules/."""
         if cls.__default is None:
-            collection = RuleCollection()
-            collection.load_directory(DEFAULT_RULES_DIR)
+            collection = RuleCollection(cache=default_cache())
+            collection.load_directory(DEFAULT_RULES_DIR, processes=get_load_processes())
             collection.freeze()
             cls.__default = collection
 
         return cls.__default
 
+    @classmethod
+    def default_lazy(cls) -> 'RuleCollection':
+        """Return the default rule collection if it was loaded, otherwise load rules/ lazily, without validation."""
+        if cls.__default is not None:
+            return cls.__default
+
+        collection = RuleCollection(cache=default_cache(), lazy=True)
+        collection.load_directory(DEFAULT_RULES_DIR)
+        collection.freeze()
+        return collection
+
     def compare_collections(self, other: 'RuleCollection'
                             ) -> (Dict[str, TOMLRule], Dict[str, TOMLRule], Dict[str, DeprecatedRule]):
         """Get the changes between two sets of rules."""
@@ -350,6 +813,11 @@ class RuleCollection(BaseCollection):
                 new_rules[rule.id] = rule
             else:
                 pre_rule = self.id_map[rule.id]
+
+                # rules shared between revisions are unchanged, without needing to hash them
+                if rule.contents.data is pre_rule.contents.data:
+                    continue
+
                 if rule.contents.sha256() != pre_rule.contents.sha256():
                     changed_rules[rule.id] = rule
 
@@ -360,7 +828,136 @@ class RuleCollection(BaseCollection):
         return changed_rules, new_rules, newly_deprecated
 
 
-@cached
+class RuleStore:
+    """Load rule collections from multiple revisions, sharing the rules which are identical between them."""
+
+    def __init__(self, compact=False):
+        self.blob_cache: Dict[Tuple[str, bool], RuleContents] = {}
+        self.revisions: Dict[str, RuleCollection] = {}
+        self.compact = compact
+
+    def load_git_tag(self, branch: str, remote: Optional[str] = None, skip_query_validation=False,
+                     processes: Optional[int] = None) -> RuleCollection:
+        """Load the rules from a git ref, only parsing rule files which weren't loaded from another revision."""
+        collection = RuleCollection(compact=self.compact)
+        collection.load_git_tag(branch, remote, skip_query_validation=skip_query_validation, processes=processes,
+                                blob_cache=self.blob_cache)
+        self.revisions[branch] = collection
+        return collection
+
+    def load_directory(self, directory: Path = DEFAULT_RULES_DIR, recursive=True) -> RuleCollection:
+        """Load the rules from the working tree, reusing rules whose files match a blob loaded from git."""
+        from .version_lock import default_version_lock
+
+        collection = RuleCollection(compact=self.compact)
+        collection._version_lock = default_version_lock
+
+        for path in collection._get_paths(directory, recursive=recursive):
+            path = path.resolve()
+            raw = path.read_bytes()
+            key = utils.git_blob_id(raw), False
+
+            try:
+                if key not in self.blob_cache:
+                    self.blob_cache[key] = _parse_rule(raw.decode("utf-8"))
+
+                collection.add_contents(dataclasses.replace(self.blob_cache[key]), path)
+            except Exception:
+                print(f"Error loading rule in {path}")
+                raise
+
+        self.revisions[str(directory)] = collection
+        return collection
+
+    def __len__(self):
+        """Get the number of unique rule files parsed across all revisions."""
+        return len(self.blob_cache)
+
+
+def _parse_rule(text: str, skip_query_validation=False) -> RuleContents:
+    """Parse and validate the TOML text of a rule."""
+    toml_dict = RuleCollection.deserialize_toml_string(text)
+
+    if skip_query_validation:
+        toml_dict['metadata']['query_schema_validation'] = False
+
+    return RuleCollection.contents_from_dict(toml_dict)
+
+
+def _start_pool(processes: int):
+    """Start a pool of worker processes, after building the beats shards which the workers only read."""
+    from multiprocessing import Pool
+    from .beats import prepare_beats_shards
+
+    prepare_beats_shards()
+    return Pool(processes=processes)
+
+
+def _dump_worker_error(exc: Exception):
+    """Get an exception raised in a worker process in a form which can be sent back to the parent."""
+    if isinstance(exc, eql.errors.EqlParseError):
+        return dump_query_error(exc)
+
+    try:
+        # some exceptions can be pickled but not unpickled, so they're checked both ways
+        pickle.loads(pickle.dumps(exc))
+        return exc
+    except Exception:
+        return Exception(f'{type(exc).__name__}: {exc}')
+
+
+def _load_worker_error(error) -> Exception:
+    return load_query_error(error) if isinstance(error, dict) else error
+
+
+def _load_rule_worker(path: Path) -> Tuple[Path, Optional[RuleContents], Any]:
+    """Parse and validate a single rule file within a worker process."""
+    try:
+        return path, _parse_rule(path.read_text(encoding="utf-8")), None
+    except Exception as e:
+        return path, None, _dump_worker_error(e)
+
+
+def _time_rule_worker(path: Path) -> Tuple[Path, Optional[RuleContents], RuleTiming, Any]:
+    """Parse and validate a single rule file, recording where the time was spent."""
+    from .rule_validators import profile_validation
+
+    timing = RuleTiming(path)
+    contents = None
+    error = None
+
+    with profile_validation() as profile:
+        start = time.perf_counter()
+        try:
+            contents = _parse_rule(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            timing.error = f'{type(e).__name__}: {e}'
+            error = _dump_worker_error(e)
+        timing.elapsed = time.perf_counter() - start
+
+    timing.languages = dict(profile['languages'])
+    timing.stack_versions = dict(profile['stack_versions'])
+    timing.cached_validation = dict(profile['cached_validation'])
+    return path, contents, timing, error
+
+
+def _load_git_rule_worker(job: Tuple[Path, str, bool]) -> Tuple[Path, Optional[RuleContents], Any]:
+    """Parse and validate the text of a rule read from git within a worker process."""
+    path, text, skip_query_validation = job
+
+    try:
+        return path, _parse_rule(text, skip_query_validation), None
+    except Exception as e:
+        return path, None, _dump_worker_error(e)
+
+
+def _github_pr_rules_key(labels: list = None, repo: str = 'elastic/detection-rules', token=None, threads=50,
+                         verbose=True):
+    # the thread count and verbosity don't change which rules are loaded
+    return frozenset(labels or ()), repo, token
+
+
+@cached(maxsize=GITHUB_PR_CACHE_SIZE, key=_github_pr_rules_key)
 def load_github_pr_rules(labels: list = None, repo: str = 'elastic/detection-rules', token=None, threads=50,
                          verbose=True) -> (Dict[str, TOMLRule], Dict[str, TOMLRule], Dict[str, list]):
     """Load all rules active as a GitHub PR."""
@@ -428,7 +1025,11 @@ __all__ = (
     "load_github_pr_rules",
     "DeprecatedCollection",
     "DeprecatedRule",
+    "RuleChange",
+    "INDEXED_FIELDS",
+    "INTERNED_KEYS",
     "RuleCollection",
+    "RuleStore",
     "metadata_filter",
     "production_filter",
     "dict_filter",
@@ -0,0 +1,287 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Match streams of events against many rules at once.
+
+Every rule with a KQL query, or an EQL query which can be expressed in KQL (event queries without sequences or
+unsupported functions), is compiled with kql.get_evaluator. Most queries require a field to equal one of a few literal
+values, such as `process.name:(cmd.exe or powershell.exe)`. These are indexed, so that each event is only evaluated
+against the rules which require a value the event has, along with the rules that couldn't be indexed.
+
+Fields are read from each event once for every rule, with a plan of the field paths shared by all of the indexes.
+Like kql.get_evaluator, values are compared case-sensitively, except for EQL comparisons which Elasticsearch makes
+case-insensitive, such as `:`. Both sides of these are lower-cased, and the indexes are keyed by lower-cased values.
+"""
+import json
+import re
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+
+import eql
+from eql import utils
+from eql.functions import CidrMatch
+
+import kql
+from kql.ast import AndExpr, FieldComparison, OrValues, String, Wildcard
+from kql.eql2kql import Eql2Kql
+from kql.errors import KqlRuntimeError
+from kql.evaluator import CompiledFilterGenerator
+
+from .rule import TOMLRule
+
+# fields with only a handful of distinct values, which are only indexed if a query has nothing better
+LOW_SELECTIVITY_FIELDS = frozenset({"event.category", "event.type", "event.kind", "event.outcome", "event.module",
+                                    "event.dataset", "host.os.type", "host.os.family", "host.os.platform"})
+
+Anchor = Tuple[str, FrozenSet[str]]
+
+
+class InsensitiveString(String):
+    """A lower-cased string, which is compared to lower-cased values as EQL `:` does."""
+
+
+class InsensitiveWildcard(Wildcard):
+    """A lower-cased wildcard, which is matched against lower-cased values as EQL `:` does."""
+
+
+class EqlToKqlMatcher(Eql2Kql):
+    """Convert EQL to KQL, keeping the wildcards in `:` comparisons, which are otherwise converted to literals.
+
+    The strings in `:` comparisons are lower-cased and marked as case-insensitive, which the optimizer keeps as it
+    groups values by field.
+    """
+
+    def _walk_function_call(self, tree):
+        converted = super()._walk_function_call(tree)
+
+        if tree.name == "wildcard":
+            values = converted.value.items
+            converted.value.items = [(InsensitiveWildcard if "*" in v.value else InsensitiveString)(v.value.lower())
+                                     if isinstance(v, String) else v for v in values]
+
+        return converted
+
+
+def _lower_terms(check: Callable) -> Callable:
+    def check_lowered(term):
+        if utils.is_string(term):
+            return check(term.lower())
+        elif isinstance(term, list):
+            for t in term:
+                if check_lowered(t):
+                    return True
+            return False
+
+        return check(term)
+
+    return check_lowered
+
+
+class MatcherFilterGenerator(CompiledFilterGenerator):
+    """Compile a KQL tree from get_rule_tree, lower-casing the values compared to case-insensitive strings."""
+
+    def _term_check(self, tree, compare):
+        if isinstance(tree, InsensitiveWildcard):
+            pattern = ".*?".join(map(re.escape, tree.value.split("*")))
+            fullmatch = re.compile(pattern, re.UNICODE | re.DOTALL).fullmatch
+            return _lower_terms(lambda term: term is not None and fullmatch(term) is not None)
+        elif isinstance(tree, InsensitiveString):
+            return _lower_terms(self._compile_value_check(tree.value, compare))
+
+        return super()._term_check(tree, compare)
+
+
+def get_rule_tree(rule: TOMLRule) -> kql.ast.KqlNode:
+    """Get the KQL tree of a rule's query, or raise an error if it has none or it can't be converted to KQL."""
+    data = rule.contents.data
+    language = getattr(data, "language", None)
+
+    if data.type not in ("query", "eql"):
+        # other types, such as thresholds and indicator matches, match more than single events
+        raise ValueError(f"Unable to match {data.type} rules")
+    elif language == "kuery":
+        return data.ast
+    elif language == "eql":
+        return EqlToKqlMatcher().walk(data.ast).optimize(recursive=True)
+
+    raise ValueError(f"Unable to match {language} rules")
+
+
+def _is_indexable(value: str) -> bool:
+    """Check if a literal only ever equals the identical string, and not numbers or addresses within a cidr block."""
+    try:
+        int(value)
+        return False
+    except ValueError:
+        return not CidrMatch.cidr_compiled.match(value)
+
+
+def _get_literals(value: kql.ast.KqlNode) -> Optional[FrozenSet[str]]:
+    if isinstance(value, String) and _is_indexable(value.value):
+        return frozenset([value.value])
+    elif isinstance(value, OrValues):
+        literals = [_get_literals(item) for item in value.items]
+        if all(literals):
+            return frozenset().union(*literals)
+
+
+def get_anchor(tree: kql.ast.KqlNode) -> Optional[Anchor]:
+    """Get a field and the literal values it must equal one of for the query to match, preferring selective fields."""
+    candidates = []
+
+    for term in tree.items if isinstance(tree, AndExpr) else [tree]:
+        if isinstance(term, FieldComparison) and "*" not in term.field.name:
+            literals = _get_literals(term.value)
+            if literals:
+                field = term.field.name
+                candidates.append((field in LOW_SELECTIVITY_FIELDS, len(literals), field, literals))
+
+    if candidates:
+        _, _, field, literals = min(candidates, key=lambda c: c[:3])
+        return field, literals
+
+
+@dataclass
+class CompiledRule:
+    """A rule compiled for matching."""
+
+    rule: TOMLRule
+    evaluator: Callable[[dict], bool]
+    anchor: Optional[Anchor] = None
+
+
+def _collect_terms(value, found: Set[int], index: Dict[str, List[int]]):
+    """Add the rules indexed under each string value, descending into lists as the evaluators do."""
+    if isinstance(value, str):
+        positions = index.get(value.lower())
+        if positions is not None:
+            found.update(positions)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _collect_terms(v, found, index)
+
+
+def _walk_plan(document, plan: dict, found: Set[int]):
+    """Walk the fields of a document in the plan, adding the positions of the rules indexed by the values found."""
+    if isinstance(document, dict):
+        for key, (index, subplan) in plan.items():
+            value = document.get(key)
+            if value is None:
+                continue
+
+            if index is not None:
+                _collect_terms(value, found, index)
+            if subplan:
+                _walk_plan(value, subplan, found)
+
+    elif isinstance(document, (list, tuple)):
+        for d in document:
+            _walk_plan(d, plan, found)
+
+
+class RuleMatcher:
+    """Match events against every supported rule, only evaluating the rules which could match each event."""
+
+    def __init__(self, rules: Iterable[TOMLRule]):
+        self.rules: List[CompiledRule] = []
+        self.unsupported: Dict[str, str] = {}
+        self.errors: Counter = Counter()
+        self.first_errors: Dict[str, Exception] = {}
+        self.event_count = 0
+        self.unindexed: List[int] = []
+        self.plan: dict = {}
+
+        for rule in rules:
+            try:
+                tree = get_rule_tree(rule)
+                evaluator = MatcherFilterGenerator.filter(tree)
+            except (ValueError, eql.EqlError) as exc:
+                self.unsupported[rule.id] = str(exc).splitlines()[0] if str(exc) else type(exc).__name__
+                continue
+
+            self.add(CompiledRule(rule, evaluator, get_anchor(tree)))
+
+    def add(self, compiled: CompiledRule):
+        """Add a compiled rule to the matcher and its index."""
+        position = len(self.rules)
+        self.rules.append(compiled)
+
+        if compiled.anchor is None:
+            self.unindexed.append(position)
+            return
+
+        field, literals = compiled.anchor
+        plan = self.plan
+        *parents, leaf = field.split(".")
+
+        for key in parents:
+            index, subplan = plan.setdefault(key, (None, {}))
+            plan = subplan
+
+        index, subplan = plan.get(leaf, (None, {}))
+        if index is None:
+            index = {}
+            plan[leaf] = (index, subplan)
+
+        # keyed by lower-cased values, so that values which only match case-insensitively are found too
+        for literal in literals:
+            index.setdefault(literal.lower(), []).append(position)
+
+    def candidates(self, event: dict) -> List[CompiledRule]:
+        """Get the rules which could match an event, in the order they were added."""
+        found = set(self.unindexed)
+        _walk_plan(event, self.plan, found)
+        return [self.rules[position] for position in sorted(found)]
+
+    def iter_matches(self, events: Iterable[dict]) -> Iterator[Tuple[dict, List[TOMLRule]]]:
+        """Yield each event with the rules it matches, skipping events which don't match any.
+
+        Events which a rule fails to evaluate are counted in `errors` by rule ID, with the first error of each rule
+        saved in `first_errors`.
+        """
+        for event in events:
+            self.event_count += 1
+            matches = []
+
+            for compiled in self.candidates(event):
+                try:
+                    if compiled.evaluator(event):
+                        matches.append(compiled.rule)
+                except (KqlRuntimeError, TypeError, ValueError) as exc:
+                    # values which can't be compared to the query, such as objects, are collected instead of raised
+                    self.errors[compiled.rule.id] += 1
+                    self.first_errors.setdefault(compiled.rule.id, exc)
+
+            if matches:
+                yield event, matches
+
+    def match(self, events: Iterable[dict]) -> Dict[str, List[dict]]:
+        """Get the events that each rule matches, by rule ID."""
+        matches = {}
+
+        for event, rules in self.iter_matches(events):
+            for rule in rules:
+                matches.setdefault(rule.id, []).append(event)
+
+        return matches
+
+
+def iter_event_file(path: Path) -> Iterator[dict]:
+    """Read events from a .jsonl/.ndjson file line by line, or from a .json list or dict of lists by source."""
+    path = Path(path)
+
+    if path.suffix in (".jsonl", ".ndjson"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        contents = json.loads(path.read_text(encoding="utf-8"))
+        sources = contents.values() if isinstance(contents, dict) else [contents]
+
+        for events in sources:
+            yield from events
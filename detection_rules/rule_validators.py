@@ -4,22 +4,87 @@
 # 2.0.
 
 """Validation logic for rules containing queries."""
+import contextlib
+import functools
+import time
+from collections import Counter, defaultdict
 from functools import cached_property
-from typing import List, Optional, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import eql
+from eql.errors import EqlSyntaxError
+from eql.optimizer import Optimizer
+from eql.parser import KvTree, LarkToEQL, NodeInfo, ParserConfig, keywords, lark_parser
+from eql.utils import to_unicode
+from lark.exceptions import LarkError
 
 import kql
 from . import ecs, beats
 from .rule import QueryValidator, QueryRuleData, RuleMeta
+from .utils import cached
+
+FIELD_PATH_CACHE_SIZE = 4096
+
+# number of schemas queries were checked against, and skipped because another stack version had an identical schema
+schema_validation_counts = Counter(validated=0, skipped=0)
+
+# time spent validating queries by language and by stack version, while within profile_validation()
+_profile: Optional[Dict[str, Dict[str, float]]] = None
+
+
+@contextlib.contextmanager
+def profile_validation() -> Iterator[Dict[str, Dict[str, float]]]:
+    """Record the time spent validating queries, by language and by stack version, within the context."""
+    global _profile
+
+    previous = _profile
+    _profile = {'languages': defaultdict(float), 'stack_versions': defaultdict(float),
+                'cached_validation': defaultdict(float)}
+
+    try:
+        yield _profile
+    finally:
+        _profile = previous
+
+
+def _record_time(category: str, name: str, start: float):
+    if _profile is not None:
+        _profile[category][name] += time.perf_counter() - start
+
+
+def record_cached_validation(language: str, start: float):
+    """Record the time spent reusing the saved outcome of validating a query, apart from validating queries."""
+    _record_time('cached_validation', language, start)
+
+
+def _profiled(language: str):
+    """Record the time spent in a validate method under its language, when profiling."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _record_time('languages', language, start)
+
+        return wrapped
+    return decorator
 
 
 class KQLValidator(QueryValidator):
     """Specific fields for query event types."""
 
+    language = 'kql'
+
+    @cached_property
+    def parsed(self):
+        """Parse the syntax of the query once, for both its AST and type checking it against each schema."""
+        return kql.lark_parse(self.query)
+
     @cached_property
     def ast(self) -> kql.ast.Expression:
-        return kql.parse(self.query)
+        return kql.from_lark_tree(self.query, self.parsed)
 
     @property
     def unique_fields(self) -> List[str]:
@@ -28,6 +93,7 @@ class KQLValidator(QueryValidator):
     def to_eql(self) -> eql.ast.Expression:
         return kql.to_eql(self.query)
 
+    @_profiled(language)
     def validate(self, data: QueryRuleData, meta: RuleMeta) -> None:
         """Static method to validate the query, called from the parent which contains [metadata] information."""
         ast = self.ast
@@ -36,17 +102,15 @@ class KQLValidator(QueryValidator):
             # syntax only, which is done via self.ast
             return
 
-        for stack_version, mapping in meta.get_validation_stack_versions().items():
-            beats_version = mapping['beats']
-            ecs_version = mapping['ecs']
-            err_trailer = f'stack: {stack_version}, beats: {beats_version}, ecs: {ecs_version}'
+        # only check the tree the query was parsed to against each distinct schema
+        lark_tree = self.parsed
 
-            beat_types = beats.parse_beats_from_index(data.index)
-            beat_schema = beats.get_schema_from_kql(ast, beat_types, version=beats_version) if beat_types else None
-            schema = ecs.get_kql_schema(version=ecs_version, indexes=data.index or [], beat_schema=beat_schema)
+        for schema, beat_types, stack_version, err_trailer in _get_unique_schemas(data, meta, ast):
+            start = time.perf_counter()
 
             try:
-                kql.parse(self.query, schema=schema)
+                kql.type_check(self.query, schema, lark_tree=lark_tree)
+                _record_time('stack_versions', stack_version, start)
             except kql.KqlParseError as exc:
                 message = exc.error_msg
                 trailer = err_trailer
@@ -62,15 +126,24 @@ class KQLValidator(QueryValidator):
 
 class EQLValidator(QueryValidator):
 
+    language = 'eql'
+
+    @cached_property
+    def parsed(self) -> Tuple[str, KvTree]:
+        """Parse the syntax of the query once, for both its AST and type checking it against each schema."""
+        return parse_eql_tree(self.query)
+
     @cached_property
     def ast(self) -> eql.ast.Expression:
+        text, lark_tree = self.parsed
         with eql.parser.elasticsearch_syntax, eql.parser.ignore_missing_functions:
-            return eql.parse_query(self.query)
+            return convert_eql_tree(text, lark_tree)
 
     @property
     def unique_fields(self) -> List[str]:
         return list(set(str(f) for f in self.ast if isinstance(f, eql.ast.Field)))
 
+    @_profiled(language)
     def validate(self, data: 'QueryRuleData', meta: RuleMeta) -> None:
         """Validate an EQL query while checking TOMLRule."""
         ast = self.ast
@@ -79,20 +152,18 @@ class EQLValidator(QueryValidator):
             # syntax only, which is done via self.ast
             return
 
-        for stack_version, mapping in meta.get_validation_stack_versions().items():
-            beats_version = mapping['beats']
-            ecs_version = mapping['ecs']
-            err_trailer = f'stack: {stack_version}, beats: {beats_version}, ecs: {ecs_version}'
+        # only check the tree the query was parsed to against each distinct schema
+        text, lark_tree = self.parsed
 
-            beat_types = beats.parse_beats_from_index(data.index)
-            beat_schema = beats.get_schema_from_kql(ast, beat_types, version=beats_version) if beat_types else None
-            schema = ecs.get_kql_schema(version=ecs_version, indexes=data.index or [], beat_schema=beat_schema)
-            eql_schema = ecs.KqlSchema2Eql(schema)
+        for schema, beat_types, stack_version, err_trailer in _get_unique_schemas(data, meta, ast):
+            start = time.perf_counter()
+            eql_schema = ecs.get_kql_schema2eql(schema)
 
             try:
                 # TODO: switch to custom cidrmatch that allows ipv6
                 with eql_schema, eql.parser.elasticsearch_syntax, eql.parser.ignore_missing_functions:
-                    eql.parse_query(self.query)
+                    type_check_eql(text, lark_tree)
+                _record_time('stack_versions', stack_version, start)
             except eql.EqlParseError as exc:
                 message = exc.error_msg
                 trailer = err_trailer
@@ -106,6 +177,125 @@ class EQLValidator(QueryValidator):
                 raise
 
 
+def get_unique_schemas(data: QueryRuleData, meta: RuleMeta, ast) -> List[Tuple[dict, list, str]]:
+    """Get each distinct schema for the stack versions a query is validated against.
+
+    Stack versions with identical schemas share a single entry, along with an error trailer naming all of them.
+    """
+    return [(schema, beat_types, err_trailer) for schema, beat_types, _, err_trailer in
+            _get_unique_schemas(data, meta, ast)]
+
+
+def _get_unique_schemas(data: QueryRuleData, meta: RuleMeta, ast) -> List[Tuple[dict, list, str, str]]:
+    """Get the entries of get_unique_schemas along with the first stack version of each, to record time against."""
+    beat_types = beats.parse_beats_from_index(data.index)
+    indexes = data.index or []
+    unique_schemas: Dict[str, Tuple[dict, str, List[str]]] = {}
+    version_fingerprints: Dict[Tuple[str, str], str] = {}
+
+    for stack_version, mapping in meta.get_validation_stack_versions().items():
+        start = time.perf_counter()
+        beats_version = mapping['beats']
+        ecs_version = mapping['ecs']
+
+        # stack versions with the same beats and ecs versions don't need their schema fingerprinted again
+        fingerprint = version_fingerprints.get((beats_version, ecs_version))
+
+        if fingerprint is None:
+            beat_schema = beats.get_schema_from_kql(ast, beat_types, version=beats_version) if beat_types else None
+            fingerprint = ecs.get_kql_schema_fingerprint(version=ecs_version, indexes=indexes, beat_schema=beat_schema)
+            version_fingerprints[beats_version, ecs_version] = fingerprint
+
+            # only the first stack version with each fingerprint builds its schema
+            if fingerprint not in unique_schemas:
+                schema = ecs.get_kql_schema(version=ecs_version, indexes=indexes, beat_schema=beat_schema)
+                unique_schemas[fingerprint] = (schema, str(stack_version), [])
+
+        trailers = unique_schemas[fingerprint][2]
+        schema_validation_counts['skipped' if trailers else 'validated'] += 1
+        trailers.append(f'stack: {stack_version}, beats: {beats_version}, ecs: {ecs_version}')
+        _record_time('stack_versions', str(stack_version), start)
+
+    return [(schema, beat_types, stack_version, '\n'.join(trailers))
+            for schema, stack_version, trailers in unique_schemas.values()]
+
+
+def parse_eql_tree(query: str) -> Tuple[str, KvTree]:
+    """Parse the syntax of an EQL query, returning the text as normalized by eql.parse_query and the lark tree."""
+    text = query if query.endswith("\n") else query + "\n"
+
+    try:
+        return text, lark_parser.parse(text, start="piped_query")
+    except LarkError as exc:
+        error = exc
+
+    # let eql raise its own syntax error, which is only worth parsing again for invalid queries
+    eql.parse_query(text)
+    raise error
+
+
+@cached(maxsize=FIELD_PATH_CACHE_SIZE)
+def split_eql_field(text: str) -> Optional[Tuple[Tuple[str, Union[str, int]], ...]]:
+    """Split an EQL field into (token type, value) parts, or None if it can't be split."""
+    parts = []
+
+    for part in lark_parser.parse(text, "field_parts").children:
+        if part["NAME"]:
+            parts.append(("NAME", to_unicode(part["NAME"])))
+        elif part["ESCAPED_NAME"]:
+            parts.append(("ESCAPED_NAME", to_unicode(part["ESCAPED_NAME"]).strip("`")))
+        elif part["UNSIGNED_INTEGER"]:
+            parts.append(("UNSIGNED_INTEGER", int(part["UNSIGNED_INTEGER"])))
+        else:
+            return
+
+    return tuple(parts)
+
+
+class FieldCachingLarkToEQL(LarkToEQL):
+    """Convert a lark tree to EQL, only splitting each distinct field into its path once.
+
+    eql parses each field again to split it into its path, which is most of the time spent type checking fields.
+    """
+
+    def field(self, node):
+        # mirrors eql.parser.LarkToEQL.field, for the eql version pinned in requirements.txt
+        parts = split_eql_field(str(node.children[0]))
+        if parts is None:
+            raise self._error(node, "Unable to parser field", cls=EqlSyntaxError)
+
+        for token_type, value in parts:
+            if token_type == "NAME" and value in keywords:
+                raise self._error(node, "Invalid use of keyword", cls=EqlSyntaxError)
+
+        full_path = [value for _, value in parts]
+        field = eql.ast.Field(full_path[0], full_path[1:])
+        return self._update_field_info(NodeInfo(field, source=node))
+
+
+def convert_eql_tree(text: str, lark_tree: KvTree, converter=FieldCachingLarkToEQL,
+                     optimize: bool = True) -> eql.ast.EqlNode:
+    """Convert a tree from parse_eql_tree to EQL under the active schema, as eql.parse_query does without parsing."""
+    # mirrors eql.parser._parse after the lark parse, for the eql version pinned in requirements.txt
+    with ParserConfig(implied_any=False, implied_base=False, allow_subqueries=True, preprocessor=None,
+                      allow_pipes=True) as config:
+        eql.load_extensions(force=False)
+        node = converter(text).visit(lark_tree)
+        if isinstance(node, NodeInfo):
+            node = node.node
+
+        if optimize and config.read_stack("optimized", True):
+            node = Optimizer(recursive=True).walk(node)
+
+        return node
+
+
+def type_check_eql(text: str, lark_tree: KvTree, converter=FieldCachingLarkToEQL) -> None:
+    """Check a tree from parse_eql_tree against the active schema, as eql.parse_query does without parsing it again."""
+    # the optimizer doesn't depend on the schema
+    convert_eql_tree(text, lark_tree, converter=converter, optimize=False)
+
+
 def extract_error_field(exc: Union[eql.EqlParseError, kql.KqlParseError]) -> Optional[str]:
     line = exc.source.splitlines()[exc.line]
     start = exc.column
@@ -0,0 +1,224 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Precompiled field tables, which are memory-mapped instead of decompressing and parsing JSON schemas.
+
+An artifact is a single file with one or more named sections, each a table of fields sorted by their UTF-8 bytes, along
+with a shared table of type names:
+
+    header          magic, format version, section count, type count, SHA-256 of the source files
+    types           (u8 length, name) for each type
+    sections        (u16 length, name, u32 field count, u32 offset, SHA-256 of the fields) for each section
+    field tables    (count + 1) u32 offsets into the names, a u8 type ID per field, then the concatenated names
+
+Artifacts are only used when the hash of their source files matches, otherwise callers fall back to the JSON schemas.
+The hash of each section's fields is saved too, so that schemas can be compared by contents without reading them.
+"""
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from .utils import dict_hash, get_cache_path
+
+SCHEMA_ARTIFACTS_DIR = Path(get_cache_path("schemas"))
+MAGIC = b"DRSCHEMA"
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct("<8sHHH32s")
+SECTION = struct.Struct("<II32s")
+OFFSET_PAIR = struct.Struct("<II")
+
+
+def artifacts_enabled() -> bool:
+    """Check if schema artifacts are used, from DR_SCHEMA_ARTIFACTS or the config file (default: enabled)."""
+    from .misc import getdefault
+
+    value = getdefault("schema_artifacts")()
+    return value is None or str(value).lower() not in ("0", "false", "no", "off")
+
+
+class FieldTable(Mapping):
+    """Read-only mapping of field names to types, which binary searches a memory-mapped field table."""
+
+    def __init__(self, buffer, offset: int, count: int, types: tuple, fields_hash: str):
+        self.fields_hash = fields_hash
+        self._buffer = buffer
+        self._count = count
+        self._types = types
+        self._offsets = offset
+        self._type_ids = offset + 4 * (count + 1)
+        self._names = self._type_ids + count
+        self._found: Dict[str, int] = {}
+
+    def _get_name(self, index: int) -> bytes:
+        start, end = OFFSET_PAIR.unpack_from(self._buffer, self._offsets + 4 * index)
+        return self._buffer[self._names + start:self._names + end]
+
+    def _find(self, name: str) -> int:
+        # queries look up the same few fields many times, so each name is only searched for once
+        index = self._found.get(name)
+        if index is None:
+            index = self._found[name] = self._search(name)
+        return index
+
+    def _search(self, name: str) -> int:
+        encoded = name.encode("utf-8")
+        low, high = 0, self._count
+
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_name(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low if low < self._count and self._get_name(low) == encoded else -1
+
+    def __getitem__(self, name: str) -> str:
+        index = self._find(name) if isinstance(name, str) else -1
+        if index < 0:
+            raise KeyError(name)
+
+        return self._types[self._buffer[self._type_ids + index]]
+
+    def __contains__(self, name) -> bool:
+        return isinstance(name, str) and self._find(name) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self._count):
+            yield self._get_name(index).decode("utf-8")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def to_dict(self) -> Dict[str, str]:
+        """Read the entire table into a dictionary, in a single pass."""
+        return {self._get_name(i).decode("utf-8"): self._types[self._buffer[self._type_ids + i]]
+                for i in range(self._count)}
+
+
+class SchemaArtifact:
+    """A memory-mapped artifact of named field tables."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+        with open(self.path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, section_count, type_count, digest = HEADER.unpack_from(self._buffer, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"{self.path} is not a version {FORMAT_VERSION} schema artifact")
+
+            self.source_hash = digest.hex()
+            position = HEADER.size
+            types = []
+
+            for _ in range(type_count):
+                length = self._buffer[position]
+                types.append(self._buffer[position + 1:position + 1 + length].decode("utf-8"))
+                position += 1 + length
+
+            self.sections: Dict[str, FieldTable] = {}
+            for _ in range(section_count):
+                length, = struct.unpack_from("<H", self._buffer, position)
+                name = self._buffer[position + 2:position + 2 + length].decode("utf-8")
+                count, offset, fields_hash = SECTION.unpack_from(self._buffer, position + 2 + length)
+                table = FieldTable(self._buffer, offset, count, tuple(types), fields_hash.hex())
+
+                # check that the whole table is within the file, so that lookups can't run past the end
+                names_size, = struct.unpack_from("<I", self._buffer, offset + 4 * count)
+                if table._names + names_size > len(self._buffer):
+                    raise IndexError(name)
+
+                self.sections[name] = table
+                position += 2 + length + SECTION.size
+        except (struct.error, IndexError, UnicodeDecodeError):
+            self.close()
+            raise ValueError(f"{self.path} is a truncated or corrupted schema artifact")
+        except ValueError:
+            self.close()
+            raise
+
+    def get(self, section: str) -> Optional[FieldTable]:
+        return self.sections.get(section)
+
+    def close(self):
+        self._buffer.close()
+
+
+def write_artifact(path: Path, sections: Dict[str, Dict[str, str]], source_hash: str):
+    """Write field tables for each section to an artifact file."""
+    types = sorted({field_type for fields in sections.values() for field_type in fields.values()})
+    type_ids = {field_type: i for i, field_type in enumerate(types)}
+    if len(types) > 255:
+        raise ValueError(f"Too many distinct field types for a schema artifact: {len(types)}")
+
+    header = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), len(types), bytes.fromhex(source_hash)))
+    for field_type in types:
+        encoded = field_type.encode("utf-8")
+        header += bytes([len(encoded)]) + encoded
+
+    directory_size = sum(2 + len(name.encode("utf-8")) + SECTION.size for name in sections)
+    offset = len(header) + directory_size
+    tables = bytearray()
+
+    for name, fields in sections.items():
+        encoded_name = name.encode("utf-8")
+        header += struct.pack("<H", len(encoded_name)) + encoded_name
+        header += SECTION.pack(len(fields), offset + len(tables), bytes.fromhex(hash_fields(fields)))
+
+        # sort by the encoded bytes, since that's what lookups compare
+        encoded_fields = sorted((field.encode("utf-8"), field_type) for field, field_type in fields.items())
+        names = bytearray()
+        offsets = [0]
+
+        for field, _ in encoded_fields:
+            names += field
+            offsets.append(len(names))
+
+        tables += struct.pack(f"<{len(offsets)}I", *offsets)
+        tables += bytes(type_ids[field_type] for _, field_type in encoded_fields)
+        tables += names
+
+    # write to a temp file and rename, so that an artifact which is memory-mapped elsewhere is never modified in place
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(tables)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def hash_fields(fields: Dict[str, str]) -> str:
+    """Hash the contents of a field table, which is the same for a dict and the table it was written to."""
+    return dict_hash(dict(fields))
+
+
+def load_artifact(path: Path, source_hash: str) -> Optional[SchemaArtifact]:
+    """Open an artifact, unless it is missing, corrupted, or was built from different source files."""
+    if not artifacts_enabled() or not Path(path).is_file():
+        return
+
+    try:
+        artifact = SchemaArtifact(path)
+    except (OSError, ValueError):
+        return
+
+    if artifact.source_hash != source_hash:
+        artifact.close()
+        return
+
+    return artifact
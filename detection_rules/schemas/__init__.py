@@ -24,6 +24,8 @@ __all__ = (
 )
 
 SCHEMA_DIR = Path(get_etc_path("api_schemas"))
+API_SCHEMA_CACHE_SIZE = 64
+STACK_SCHEMA_CACHE_SIZE = 8
 migrations = {}
 
 
@@ -44,7 +46,7 @@ def migrate(version: str):
     return wrapper
 
 
-@cached
+@cached(maxsize=API_SCHEMA_CACHE_SIZE)
 def get_schema_file(version: Version, rule_type: str) -> dict:
     path = Path(SCHEMA_DIR) / str(version) / f"{version}.{rule_type}.json"
 
@@ -214,7 +216,7 @@ def downgrade(api_contents: dict, target_version: str, current_version: Optional
     return api_contents
 
 
-@cached
+@cached(maxsize=STACK_SCHEMA_CACHE_SIZE)
 def get_stack_schemas(stack_version: str) -> Dict[str, dict]:
     """Return all ECS + beats to stack versions for a every stack version >= specified stack version and <= package."""
     from ..packaging import load_current_package_version
@@ -16,12 +16,15 @@ import json
 import os
 import shutil
 import subprocess
+import sys
+import threading
 import time
 import zipfile
-from dataclasses import is_dataclass, astuple
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass, astuple
 from datetime import datetime, date
 from pathlib import Path
-from typing import Dict, Union, Optional, Callable
+from typing import Any, Container, Dict, Hashable, Iterable, Iterator, List, Union, Optional, Callable, Tuple
 
 import click
 import pytoml
@@ -33,6 +36,7 @@ import kql
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(CURR_DIR)
 ETC_DIR = os.path.join(ROOT_DIR, "etc")
+CACHE_DIR = os.getenv("DR_CACHE_DIR") or os.path.join(ROOT_DIR, ".cache")
 
 
 class NonelessDict(dict):
@@ -94,6 +98,53 @@ def get_etc_path(*paths):
     return os.path.join(ETC_DIR, *paths)
 
 
+def get_cache_path(*paths) -> str:
+    """Get a file from the local cache folder, which can be moved with DR_CACHE_DIR."""
+    return os.path.join(CACHE_DIR, *paths)
+
+
+def hash_files(paths) -> str:
+    """Hash the names and contents of files deterministically."""
+    digest = hashlib.sha256()
+
+    for path in sorted(Path(p) for p in paths):
+        digest.update(path.name.encode("utf-8"))
+        digest.update(path.read_bytes())
+
+    return digest.hexdigest()
+
+
+def hash_files_cached(paths) -> str:
+    """Hash files like hash_files, but only read them again once their sizes or modification times change.
+
+    The hash is saved under the cache folder along with the stats of the files it was computed from.
+    """
+    paths = sorted(Path(p) for p in paths)
+    stats = [[str(path.resolve()), stat.st_size, stat.st_mtime_ns] for path, stat in ((p, p.stat()) for p in paths)]
+    names_hash = hashlib.sha256(json.dumps([s[0] for s in stats]).encode("utf-8")).hexdigest()
+    saved_path = Path(get_cache_path("file_hashes", f"{names_hash}.json"))
+
+    try:
+        saved = json.loads(saved_path.read_text())
+        if saved["stats"] == stats:
+            return saved["hash"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    digest = hash_files(paths)
+
+    try:
+        saved_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = saved_path.with_suffix(f".{os.getpid()}.tmp")
+        temp_path.write_text(json.dumps({"stats": stats, "hash": digest}))
+        os.replace(temp_path, saved_path)
+    except OSError:
+        # the files are only hashed again next time
+        pass
+
+    return digest
+
+
 def get_etc_glob_path(*patterns):
     """Load a file from the etc/ folder."""
     pattern = os.path.join(*patterns)
@@ -207,7 +258,7 @@ def combine_sources(*sources):  # type: (list[list]) -> list
 
 def evaluate(rule, events):
     """Evaluate a query against events."""
-    evaluator = kql.get_evaluator(kql.parse(rule.query))
+    evaluator = kql.get_evaluator(kql.parse(rule.query), compiled=True)
     filtered = list(filter(evaluator, events))
     return filtered
 
@@ -244,32 +295,137 @@ def freeze(obj):
         return obj
 
 
-_cache = {}
+def intern_strings(obj: Any, keys: Optional[Container[str]] = None, key: Optional[str] = None) -> Any:
+    """Intern the strings within nested dataclasses, dicts and lists, so repeated values share a single object.
+
+    Only the values of dataclass fields or dict keys found in `keys` are interned, or every string if not specified.
+    Dataclasses and lists are updated in place, including frozen dataclasses, while dicts are rebuilt.
+    """
+    if isinstance(obj, str):
+        return sys.intern(obj) if keys is None or key in keys else obj
+    elif isinstance(obj, list):
+        obj[:] = [intern_strings(o, keys, key) for o in obj]
+    elif isinstance(obj, dict):
+        return {sys.intern(k) if isinstance(k, str) else k: intern_strings(v, keys, k) for k, v in obj.items()}
+    elif not isinstance(obj, type) and is_dataclass(obj):
+        for f in fields(obj):
+            value = getattr(obj, f.name)
+            interned = intern_strings(value, keys, f.name)
+
+            if interned is not value:
+                # circumvent frozen dataclasses, which are only ever changed to an equal value
+                object.__setattr__(obj, f.name, interned)
+
+    return obj
+
+
+class Identity:
+    """Wrap an object to be hashed and compared by identity in a cache key, which also keeps it alive while cached."""
+
+    __slots__ = ("obj", )
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, Identity) and other.obj is self.obj
+
+
+def freeze_key(*args, **kwargs) -> Hashable:
+    """Key a call by the frozen values of its arguments, so that equal arguments share a result."""
+    return freeze(args), freeze(kwargs)
+
+
+def identity_key(*args, **kwargs) -> Hashable:
+    """Key a call by the identity of its arguments, for arguments which are expensive to freeze or hash."""
+    return tuple(Identity(a) for a in args), tuple((k, Identity(v)) for k, v in sorted(kwargs.items()))
+
+
+class LRUCache:
+    """Results of a memoized function, optionally bounded to the `maxsize` most recently used."""
 
+    def __init__(self, name: str, maxsize: Optional[int] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable, default=None):
+        if key in self.entries:
+            self.hits += 1
+            if self.maxsize is not None:
+                self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        return default
+
+    def put(self, key: Hashable, value):
+        self.entries[key] = value
+
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"name": self.name, "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.entries), "maxsize": self.maxsize}
+
+
+_cache: Dict[int, LRUCache] = {}
+_missing = object()
+
+
+def cached(f=None, *, maxsize: Optional[int] = None, key: Callable[..., Hashable] = freeze_key):
+    """Helper function to memoize functions.
+
+    :param maxsize: Keep only the most recently used results (default: unbounded)
+    :param key: Get the cache key from the arguments of a call, such as freeze_key, identity_key or a fingerprint
+    """
+    if f is None:
+        return functools.partial(cached, maxsize=maxsize, key=key)
 
-def cached(f):
-    """Helper function to memoize functions."""
     func_key = id(f)
+    cache = _cache[func_key] = LRUCache(f"{f.__module__}.{f.__qualname__}", maxsize)
 
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
-        _cache.setdefault(func_key, {})
-        cache_key = freeze(args), freeze(kwargs)
+        cache_key = key(*args, **kwargs)
+        value = cache.get(cache_key, _missing)
 
-        if cache_key not in _cache[func_key]:
-            _cache[func_key][cache_key] = f(*args, **kwargs)
+        if value is _missing:
+            value = f(*args, **kwargs)
+            cache.put(cache_key, value)
 
-        return _cache[func_key][cache_key]
+        return value
 
-    def clear():
-        _cache.pop(func_key, None)
-
-    wrapped.clear = clear
+    wrapped.clear = cache.clear
+    wrapped.cache = cache
     return wrapped
 
 
 def clear_caches():
-    _cache.clear()
+    for cache in _cache.values():
+        cache.clear()
+
+    kql.clear_caches()
+
+
+def get_cache_stats() -> List[dict]:
+    """Get the hits, misses, evictions and size of every memoized function which was used, including kql's."""
+    stats = [c.stats() for c in _cache.values() if c.hits or c.misses] + kql.get_cache_stats()
+    return sorted(stats, key=lambda s: s["name"])
 
 
 def load_rule_contents(rule_file: Path, single_only=False) -> list:
@@ -353,6 +509,67 @@ def git(*args, **kwargs):
     return make_git()(*args, **kwargs)
 
 
+def git_ls_blobs(ref: str, path: str) -> Dict[str, str]:
+    """Get the blob object IDs for every file under a path within a git ref."""
+    listing = git("ls-tree", "-r", "-z", ref, "--", path)
+    blobs = {}
+
+    for entry in filter(None, listing.split("\0")):
+        info, file_path = entry.split("\t", 1)
+        _, object_type, object_id = info.split()
+
+        if object_type == "blob":
+            blobs[file_path] = object_id
+
+    return blobs
+
+
+def git_blob_id(contents: bytes) -> str:
+    """Compute the git object ID of a blob without calling git."""
+    return hashlib.sha1(b"blob %d\0" % len(contents) + contents).hexdigest()
+
+
+def read_git_blobs(object_ids: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    """Read many git objects through a single `git cat-file --batch` process, rather than one process per object."""
+    git_exe = shutil.which("git")
+    object_ids = list(object_ids)
+    process = subprocess.Popen([git_exe, "-C", get_path(), "cat-file", "--batch"],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def write_requests():
+        # feed stdin from a thread, so that a full stdout pipe can't deadlock the two processes
+        try:
+            process.stdin.write("".join(f"{object_id}\n" for object_id in object_ids).encode("utf-8"))
+        except BrokenPipeError:
+            # git was stopped because the reader stopped early
+            pass
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+
+    writer = threading.Thread(target=write_requests, daemon=True)
+    writer.start()
+
+    try:
+        for object_id in object_ids:
+            header = process.stdout.readline().decode("utf-8").split()
+
+            if len(header) != 3:
+                raise ValueError(f"Unable to read git object {object_id}: {' '.join(header)}")
+
+            _, _, size = header
+            contents = process.stdout.read(int(size))
+            process.stdout.read(1)  # trailing newline
+            yield object_id, contents
+    finally:
+        # stop git before waiting on the writer, which is blocked for as long as git is blocked on a full stdout
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        writer.join()
+        process.wait()
+
+
 def add_params(*params):
     """Add parameters to a click command."""
 
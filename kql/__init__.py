@@ -6,27 +6,38 @@
 import eql
 
 from . import ast
+from .cache import cached_query, clear_caches, get_cache_stats
+from .columnar import ColumnarEvaluator, EventTable
 from .dsl import ToDsl
 from .eql2kql import Eql2Kql
 from .errors import KqlParseError, KqlCompileError
-from .evaluator import FilterGenerator
+from .evaluator import CompiledFilterGenerator, FilterGenerator
 from .kql2eql import KqlToEQL
 from .parser import lark_parse, KqlParser
+from .schema import KqlSchema
 
 __version__ = '0.1.6'
 __all__ = (
     "ast",
+    "EventTable",
     "from_eql",
+    "from_lark_tree",
+    "get_batch_evaluator",
     "get_evaluator",
     "KqlParseError",
     "KqlCompileError",
+    "KqlSchema",
+    "clear_caches",
+    "get_cache_stats",
     "lint",
     "parse",
     "to_dsl",
     "to_eql",
+    "type_check",
 )
 
 
+@cached_query
 def to_dsl(parsed, optimize=True, schema=None):
     """Convert KQL to Elasticsearch Query DSL."""
     if not isinstance(parsed, ast.KqlNode):
@@ -35,6 +46,7 @@ def to_dsl(parsed, optimize=True, schema=None):
     return ToDsl.convert(parsed)
 
 
+@cached_query
 def to_eql(text, optimize=True, schema=None):
     if isinstance(text, bytes):
         text = text.decode("utf-8")
@@ -45,16 +57,32 @@ def to_eql(text, optimize=True, schema=None):
     return converted.optimize(recursive=True) if optimize else converted
 
 
+@cached_query
 def parse(text, optimize=True, schema=None):
     if isinstance(text, bytes):
         text = text.decode("utf-8")
 
-    lark_parsed = lark_parse(text)
-    converted = KqlParser(text, schema=schema).visit(lark_parsed)
+    return from_lark_tree(text, lark_parse(text), optimize, schema)
+
 
+def from_lark_tree(text, lark_tree, optimize=True, schema=None):
+    """Convert a tree from lark_parse to KQL, as parse does without parsing the text again."""
+    converted = KqlParser(text, schema=schema).visit(lark_tree)
     return converted.optimize(recursive=True) if optimize else converted
 
 
+def type_check(text, schema, lark_tree=None):
+    """Check the fields and values in a query against a schema, reusing the tree from lark_parse if provided."""
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+
+    if lark_tree is None:
+        lark_tree = lark_parse(text)
+
+    KqlParser(text, schema=schema).visit(lark_tree)
+
+
+@cached_query
 def lint(text):
     if isinstance(text, bytes):
         text = text.decode("utf-8")
@@ -73,8 +101,20 @@ def from_eql(tree, optimize=True):
     return converted.optimize(recursive=True) if optimize else converted
 
 
-def get_evaluator(tree, optimize=False):
+def get_evaluator(tree, optimize=False, compiled=False):
+    """Get a callable which checks if a document matches a query, compiled to closures over precomputed paths if set."""
     if not isinstance(tree, ast.KqlNode):
         tree = parse(tree, optimize=optimize)
 
+    if compiled:
+        return CompiledFilterGenerator.filter(tree)
+
     return FilterGenerator().filter(tree)
+
+
+def get_batch_evaluator(tree, optimize=False):
+    """Get a callable which checks which documents of a list or EventTable match a query, as a numpy boolean array."""
+    if not isinstance(tree, ast.KqlNode):
+        tree = parse(tree, optimize=optimize)
+
+    return ColumnarEvaluator(tree)
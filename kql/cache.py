@@ -0,0 +1,141 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Bounded caches of parsed and converted queries.
+
+Results are saved pickled and a new copy is returned for every call, so that callers which change the trees or
+dictionaries they get can't change what later calls return. Unpickling is two orders of magnitude faster than parsing.
+"""
+import functools
+import inspect
+import pickle
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from .schema import KqlSchema
+
+# queries kept by each cached function, which is enough for every rule in a few stack versions
+PARSE_CACHE_SIZE = 2048
+
+
+class ParseCache:
+    """Pickled results of a function, keeping only the most recently used."""
+
+    def __init__(self, name: str, maxsize: Optional[int] = PARSE_CACHE_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries: Dict[tuple, bytes] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: tuple):
+        pickled = self.entries.get(key)
+
+        if pickled is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def put(self, key: tuple, value):
+        if self.maxsize == 0:
+            return
+
+        self.entries[key] = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"name": self.name, "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.entries), "maxsize": self.maxsize}
+
+
+_caches: List[ParseCache] = []
+
+# fingerprints of plain dict schemas by identity, holding each schema so that its id isn't reused while it's here
+SCHEMA_KEY_CACHE_SIZE = 256
+_schema_keys: Dict[int, Tuple[Mapping, str]] = OrderedDict()
+
+
+def get_schema_key(schema) -> Optional[str]:
+    """Key a schema by its contents, which are only hashed once for each KqlSchema or dict.
+
+    Dicts are remembered by identity, so a dict schema shouldn't be changed once it was used.
+    """
+    if schema is None:
+        return None
+    elif isinstance(schema, KqlSchema):
+        return schema.fingerprint
+
+    entry = _schema_keys.get(id(schema))
+    if entry is not None and entry[0] is schema:
+        _schema_keys.move_to_end(id(schema))
+        return entry[1]
+
+    fingerprint = KqlSchema(schema).fingerprint
+    _schema_keys[id(schema)] = (schema, fingerprint)
+
+    if len(_schema_keys) > SCHEMA_KEY_CACHE_SIZE:
+        _schema_keys.popitem(last=False)
+
+    return fingerprint
+
+
+def cached_query(f):
+    """Cache a function of query text, keyed by the text and its other arguments, with schemas keyed by contents.
+
+    Calls with anything besides a string or bytes for the query, such as a parsed tree, aren't cached.
+    """
+    signature = inspect.signature(f)
+    text_argument = next(iter(signature.parameters))
+    cache = ParseCache(f"{f.__module__}.{f.__qualname__}")
+    _caches.append(cache)
+
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        text = arguments.arguments[text_argument]
+
+        if isinstance(text, bytes):
+            text = arguments.arguments[text_argument] = text.decode("utf-8")
+        elif not isinstance(text, str):
+            return f(*args, **kwargs)
+
+        key = tuple(get_schema_key(value) if name == "schema" else value
+                    for name, value in arguments.arguments.items())
+        result = cache.get(key)
+
+        if result is None:
+            result = f(*arguments.args, **arguments.kwargs)
+            cache.put(key, result)
+
+        return result
+
+    wrapped.cache = cache
+    return wrapped
+
+
+def get_cache_stats() -> List[dict]:
+    """Get the hits, misses, evictions and size of the cache of each function which was used."""
+    return sorted((c.stats() for c in _caches if c.hits or c.misses), key=lambda s: s["name"])
+
+
+def clear_caches():
+    for cache in _caches:
+        cache.clear()
+
+    _schema_keys.clear()
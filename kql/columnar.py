@@ -0,0 +1,360 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Evaluate KQL against batches of documents at once, over columns of the values of each field.
+
+The values of each field are flattened into columns the first time a query uses the field: strings are interned into
+codes of a per-field vocabulary, and integers and floats are kept in numeric arrays, each with the row of every value.
+Queries are evaluated to boolean masks of the rows, with the same results as FilterGenerator:
+
+* each distinct string or number is checked once, with the checks of CompiledFilterGenerator, and the results are
+  gathered for every value, except for equality and numeric ranges, which are compared directly
+* a row matches a value if any of its values for the field do, so lists and missing fields behave as they do there
+* rows with values that can't be represented in columns (such as objects or nested lists) and rows where a check
+  raised an error are evaluated again on their own, which raises the error if it's reached for the first such row
+"""
+import importlib.util
+import operator
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from eql import Walker, utils
+from eql.functions import CidrMatch
+
+from .ast import Boolean, Exists, Number, OrValues, String
+from .errors import KqlCompileError
+from .evaluator import RANGE_OPERATORS, CompiledFilterGenerator, FilterGenerator
+
+# imported when first used, since importing numpy takes longer than the rest of kql
+np = None
+
+
+def numpy_installed() -> bool:
+    return importlib.util.find_spec("numpy") is not None
+
+
+def _import_numpy():
+    global np
+
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ModuleNotFoundError('Missing numpy - try running `pip install -r requirements-dev.txt`')
+        np = numpy
+
+    return np
+
+
+# integers beyond this can't be compared exactly with floats in numpy
+MAX_EXACT_INTEGER = 2 ** 53
+
+Mask = Tuple["np.ndarray", "np.ndarray"]
+
+
+class Column:
+    """The values of a field in a batch of documents, grouped by type, each with the row it belongs to."""
+
+    def __init__(self, row_count: int):
+        self.row_count = row_count
+        self.vocabulary: List[str] = []
+        self.codes: Dict[str, int] = {}
+        self.string_rows = []
+        self.string_codes = []
+        self.integer_rows = []
+        self.integers = []
+        self.float_rows = []
+        self.floats = []
+        # rows with values which aren't strings, numbers, or missing
+        self.irregular = np.zeros(row_count, dtype=bool)
+        self._addresses = None
+
+    def add_string(self, row: int, term: str):
+        code = self.codes.get(term)
+        if code is None:
+            code = self.codes[term] = len(self.vocabulary)
+            self.vocabulary.append(term)
+        self.string_rows.append(row)
+        self.string_codes.append(code)
+
+    def add(self, row: int, term):
+        if term is None:
+            return
+        elif utils.is_string(term):
+            self.add_string(row, term)
+        elif isinstance(term, int) and -MAX_EXACT_INTEGER <= term <= MAX_EXACT_INTEGER:
+            # booleans are compared exactly as 0 and 1 are
+            self.integer_rows.append(row)
+            self.integers.append(int(term))
+        elif isinstance(term, float):
+            self.float_rows.append(row)
+            self.floats.append(term)
+        else:
+            self.irregular[row] = True
+
+    def freeze(self):
+        self.string_rows = np.array(self.string_rows, dtype=np.intp)
+        self.string_codes = np.array(self.string_codes, dtype=np.intp)
+        self.integer_rows = np.array(self.integer_rows, dtype=np.intp)
+        self.integers = np.array(self.integers, dtype=np.int64)
+        self.float_rows = np.array(self.float_rows, dtype=np.intp)
+        self.floats = np.array(self.floats, dtype=np.float64)
+        return self
+
+    @property
+    def addresses(self) -> Tuple["np.ndarray", "np.ndarray"]:
+        """Get the strings of the vocabulary which are IPv4 addresses, and their integer values."""
+        if self._addresses is None:
+            is_address = np.array([CidrMatch.ip_compiled.match(s) is not None for s in self.vocabulary], dtype=bool)
+            addresses = np.zeros(len(self.vocabulary), dtype=np.uint32)
+            for code in np.flatnonzero(is_address):
+                addresses[code] = CidrMatch.to_mask(self.vocabulary[code] + "/32")[0]
+            self._addresses = is_address, addresses
+
+        return self._addresses
+
+
+def _add_objects(rows: list, objects: list, row: int, value):
+    """Add the objects in a value, descending into lists as FilterGenerator.get_terms does."""
+    if isinstance(value, dict):
+        rows.append(row)
+        objects.append(value)
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            _add_objects(rows, objects, row, v)
+
+
+class EventTable:
+    """A batch of documents, with columns for each field flattened when first needed and shared between queries."""
+
+    def __init__(self, documents: Sequence):
+        _import_numpy()
+        self.documents = documents if isinstance(documents, (list, tuple)) else list(documents)
+        self._columns: Dict[Tuple[str, ...], Column] = {}
+        self._objects: Dict[Tuple[str, ...], Tuple[list, list]] = {}
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def _get_objects(self, prefix: Tuple[str, ...]) -> Tuple[list, list]:
+        """Get the objects at a path and their rows, so that fields with the same parent only look it up once."""
+        found = self._objects.get(prefix)
+
+        if found is None:
+            rows, objects = [], []
+            if prefix:
+                for row, parent in zip(*self._get_objects(prefix[:-1])):
+                    _add_objects(rows, objects, row, parent.get(prefix[-1]))
+            else:
+                for row, document in enumerate(self.documents):
+                    _add_objects(rows, objects, row, document)
+
+            found = self._objects[prefix] = rows, objects
+
+        return found
+
+    def column(self, path: Tuple[str, ...]) -> Column:
+        """Get the values of a field, as FilterGenerator.get_terms finds them in each document."""
+        column = self._columns.get(path)
+
+        if column is None:
+            column = Column(len(self.documents))
+            *prefix, key = path
+
+            add_string = column.add_string
+
+            for row, parent in zip(*self._get_objects(tuple(prefix))):
+                value = parent.get(key)
+
+                if value is None:
+                    continue
+                elif type(value) is str:
+                    add_string(row, value)
+                elif isinstance(value, (tuple, list)):
+                    for term in value:
+                        if isinstance(term, (tuple, list, dict)):
+                            column.irregular[row] = True
+                        else:
+                            column.add(row, term)
+                elif isinstance(value, dict):
+                    column.irregular[row] = True
+                else:
+                    column.add(row, value)
+
+            column = self._columns[path] = column.freeze()
+
+        return column
+
+
+def _check_each(values: Sequence, check: Callable) -> Mask:
+    """Check each value, recording the values which raised an error instead of raising it."""
+    matches = np.zeros(len(values), dtype=bool)
+    errors = np.zeros(len(values), dtype=bool)
+
+    for i, value in enumerate(values):
+        try:
+            matches[i] = bool(check(value))
+        except Exception:
+            errors[i] = True
+
+    return matches, errors
+
+
+def _check_numbers(values: "np.ndarray", check: Callable, value, compare: Optional[Callable]) -> Mask:
+    """Check an array of integers or floats, comparing them directly to numbers and by distinct value otherwise."""
+    if not len(values):
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+
+    if value is not None and abs(value) <= MAX_EXACT_INTEGER:
+        return (compare or operator.eq)(values, value), np.zeros(len(values), dtype=bool)
+
+    unique, inverse = np.unique(values, return_inverse=True)
+    matches, errors = _check_each(unique.tolist(), check)
+    return matches[inverse], errors[inverse]
+
+
+class ColumnarFilterGenerator(Walker):
+    """Evaluate a KQL tree over an EventTable, to masks of the matching rows and of the rows which need a fallback."""
+
+    def __init__(self, table: EventTable):
+        self.table = table
+        self.row_count = len(table)
+        self.scalar = CompiledFilterGenerator()
+        super().__init__()
+
+    def _walk_default(self, node, *args, **kwargs):
+        raise KqlCompileError("Unable to convert {}".format(node))
+
+    @staticmethod
+    def _gather(rows: "np.ndarray", matches: "np.ndarray", errors: Optional["np.ndarray"], mask: Mask):
+        """Mark the rows of the values which matched, or raised errors, in a pair of row masks."""
+        mask[0][rows[matches]] = True
+        if errors is not None:
+            mask[1][rows[errors]] = True
+
+    def _compile_term(self, tree, path: Tuple[str, ...], compare: Optional[Callable]) -> Mask:
+        """Evaluate a check of single values, which matches rows with any value that passes it."""
+        column = self.table.column(path)
+        mask = np.zeros(self.row_count, dtype=bool), column.irregular.copy()
+        check = self.scalar._term_check(tree, compare)
+
+        if isinstance(tree, Exists):
+            for rows in (column.string_rows, column.integer_rows, column.float_rows):
+                mask[0][rows] = True
+            return mask
+
+        strings = self._get_strings(tree, compare)
+        if strings is not None:
+            matches = self._match_strings(column, strings)
+            self._gather(column.string_rows, matches[column.string_codes], None, mask)
+        elif column.vocabulary:
+            matches, errors = _check_each(column.vocabulary, check)
+            self._gather(column.string_rows, matches[column.string_codes], errors[column.string_codes], mask)
+
+        # numbers are compared directly to number and boolean values, and by their distinct values otherwise
+        value = tree.value if isinstance(tree, (Number, Boolean)) else None
+        for rows, values in ((column.integer_rows, column.integers), (column.float_rows, column.floats)):
+            matches, errors = _check_numbers(values, check, value, compare)
+            self._gather(rows, matches, errors, mask)
+
+        return mask
+
+    @staticmethod
+    def _get_strings(tree, compare: Optional[Callable]) -> Optional[List[str]]:
+        """Get the strings a check compares values to for equality, unless it checks anything else."""
+        if compare is not None:
+            return
+
+        items = tree.items if isinstance(tree, OrValues) else [tree]
+        if all(type(item) is String for item in items):
+            return [item.value for item in items]
+
+    @staticmethod
+    def _match_strings(column: Column, strings: List[str]) -> "np.ndarray":
+        """Check which strings of the vocabulary equal any of the strings, or are addresses in any cidr blocks."""
+        matches = np.zeros(len(column.vocabulary), dtype=bool)
+
+        for value in strings:
+            code = column.codes.get(value)
+            if code is not None:
+                matches[code] = True
+
+            if CidrMatch.cidr_compiled.match(value):
+                is_address, addresses = column.addresses
+                subnet, netmask = CidrMatch.to_mask(value)
+                matches |= is_address & ((addresses & np.uint32(netmask)) == subnet)
+
+        return matches
+
+    def _compile_values(self, tree, path: Tuple[str, ...], compare: Optional[Callable] = None) -> Mask:
+        if self.scalar._term_check(tree, compare) is not None:
+            return self._compile_term(tree, path, compare)
+
+        return self.walk(tree, path, compare)
+
+    @staticmethod
+    def _all(masks: List[Mask]) -> Mask:
+        matches, errors = masks[0][0].copy(), masks[0][1].copy()
+        for mask in masks[1:]:
+            matches &= mask[0]
+            errors |= mask[1]
+        return matches, errors
+
+    @staticmethod
+    def _any(masks: List[Mask]) -> Mask:
+        matches, errors = masks[0][0].copy(), masks[0][1].copy()
+        for mask in masks[1:]:
+            matches |= mask[0]
+            errors |= mask[1]
+        return matches, errors
+
+    def _walk_and_values(self, tree, path, compare=None):
+        return self._all([self._compile_values(item, path, compare) for item in tree.items])
+
+    def _walk_or_values(self, tree, path, compare=None):
+        return self._any([self._compile_values(item, path, compare) for item in tree.items])
+
+    def _walk_not_value(self, tree, path, compare=None):
+        matches, errors = self._compile_values(tree.value, path, compare)
+        return ~matches, errors
+
+    def _walk_field_comparison(self, tree):
+        return self._compile_values(tree.value, tuple(tree.field.name.split(".")))
+
+    def _walk_field_range(self, tree):
+        return self._compile_values(tree.value, tuple(tree.field.name.split(".")), RANGE_OPERATORS[tree.operator])
+
+    def _walk_nested_query(self, tree):
+        # nested documents don't share the columns of the batch, so these are checked one document at a time
+        check = self.scalar.walk(tree)
+        return _check_each(self.table.documents, check)
+
+    def _walk_not_expr(self, tree):
+        matches, errors = self.walk(tree.expr)
+        return ~matches, errors
+
+    def _walk_and_expr(self, tree):
+        return self._all([self.walk(item) for item in tree.items])
+
+    def _walk_or_expr(self, tree):
+        return self._any([self.walk(item) for item in tree.items])
+
+
+class ColumnarEvaluator:
+    """Check which documents of a batch match a query, as a boolean array with one entry per document."""
+
+    def __init__(self, tree):
+        _import_numpy()
+        self.tree = tree
+        # rows with errors are checked as FilterGenerator does, since it can stop before an error elsewhere
+        self.fallback = FilterGenerator().filter(tree)
+
+    def __call__(self, documents: Union[EventTable, Sequence]) -> "np.ndarray":
+        table = documents if isinstance(documents, EventTable) else EventTable(documents)
+        matches, errors = ColumnarFilterGenerator(table).walk(self.tree)
+
+        for row in np.flatnonzero(errors):
+            matches[row] = bool(self.fallback(table.documents[row]))
+
+        return matches
@@ -5,12 +5,16 @@
 
 import operator
 import re
+from typing import Callable, Optional, Tuple
 
 import eql.ast
 from eql import Walker, EqlCompileError, utils
 from eql.functions import CidrMatch
+from .ast import Exists, OrValues, Value, Wildcard
 from .errors import KqlRuntimeError, KqlCompileError
 
+RANGE_OPERATORS = {"<": operator.lt, "<=": operator.le, ">=": operator.ge, ">": operator.gt}
+
 
 class FilterGenerator(Walker):
     __cidr_cache = {}
@@ -153,3 +157,201 @@ class FilterGenerator(Walker):
     @classmethod
     def filter(cls, expression):
         return cls().walk(expression)
+
+
+def _compile_any_term(path: Tuple[str, ...], check: Callable) -> Callable:
+    """Compile a predicate which checks if any value at a path of a document passes a check, in document order."""
+    key, rest = path[0], path[1:]
+
+    if rest:
+        match_rest = _compile_any_term(rest, check)
+
+        def match(document):
+            if isinstance(document, dict):
+                return match_rest(document.get(key))
+            elif isinstance(document, (tuple, list)):
+                for d in document:
+                    if match(d):
+                        return True
+            return False
+
+    else:
+        def match(document):
+            if isinstance(document, dict):
+                value = document.get(key)
+
+                if value is None:
+                    return False
+                elif isinstance(value, (tuple, list)):
+                    for term in value:
+                        if check(term):
+                            return True
+                    return False
+                return check(value)
+
+            elif isinstance(document, (tuple, list)):
+                for d in document:
+                    if match(d):
+                        return True
+            return False
+
+    return match
+
+
+def _compile_all(predicates: list) -> Callable:
+    if len(predicates) == 1:
+        return predicates[0]
+    elif len(predicates) == 2:
+        first, second = predicates
+        return lambda x: first(x) and second(x)
+
+    predicates = tuple(predicates)
+
+    def check_all(x):
+        for p in predicates:
+            if not p(x):
+                return False
+        return True
+
+    return check_all
+
+
+def _compile_any(predicates: list) -> Callable:
+    if len(predicates) == 1:
+        return predicates[0]
+    elif len(predicates) == 2:
+        first, second = predicates
+        return lambda x: first(x) or second(x)
+
+    predicates = tuple(predicates)
+
+    def check_any(x):
+        for p in predicates:
+            if p(x):
+                return True
+        return False
+
+    return check_any
+
+
+class CompiledFilterGenerator(Walker):
+    """Compile a KQL tree to a predicate over documents, with the same results as FilterGenerator.
+
+    Fields are resolved with precomputed paths, without collecting their values into lists, and values are coerced
+    to the possible types of the terms they are compared to when compiled, instead of on every comparison. Checks
+    of values against the same field are combined into a single pass over the field's values where possible.
+    """
+
+    def _walk_default(self, node, *args, **kwargs):
+        raise KqlCompileError("Unable to convert {}".format(node))
+
+    @staticmethod
+    def _compile_equals(value) -> Callable:
+        """Compile FilterGenerator.equals for a string value."""
+        if CidrMatch.cidr_compiled.match(value):
+            cidr_match = CidrMatch.get_callback(None, eql.ast.String(value))
+            ip_match = CidrMatch.ip_compiled.match
+            return lambda term: cidr_match(term) if ip_match(term) else term == value
+
+        return lambda term: term == value
+
+    def _compile_value_check(self, value, compare: Optional[Callable]) -> Callable:
+        """Compile the check of a single term against a value, as in FilterGenerator._walk_value."""
+        if utils.is_string(value):
+            # only integer terms are compared to the integer value, so failing to convert is only raised for these
+            try:
+                int_value = int(value)
+            except ValueError:
+                int_value = None
+
+            def compare_integer(term):
+                return compare_number(term, int_value if int_value is not None else int(value))
+
+            compare_string = self._compile_equals(value) if compare is None else lambda term: compare(term, value)
+            compare_number = operator.eq if compare is None else compare
+            compare_float = (lambda term: term == value) if compare is None else lambda term: compare(term, value)
+
+            def compare_numeric(term):
+                return compare_integer(term) if isinstance(term, int) else compare_float(term)
+
+        else:
+            string_value = utils.to_unicode(value) if isinstance(value, (bool, int, float)) else value
+            if compare is None:
+                compare_string = self._compile_equals(string_value) if utils.is_string(string_value) else \
+                    lambda term: term == string_value
+            else:
+                compare_string = lambda term: compare(term, string_value)  # noqa: E731
+
+            compare_numeric = (lambda term: term == value) if compare is None else lambda term: compare(term, value)
+
+        def check(term):
+            if term is None:
+                return False
+            elif utils.is_string(term):
+                return compare_string(term)
+            elif isinstance(term, (bool, float, int)):
+                return compare_numeric(term)
+            elif isinstance(term, list):
+                for t in term:
+                    if check(t):
+                        return True
+                return False
+
+            raise KqlRuntimeError("Cannot compare value {}".format(term))
+
+        return check
+
+    def _term_check(self, tree, compare: Optional[Callable]) -> Optional[Callable]:
+        """Get the check of a single term for values which match if any term does, otherwise None."""
+        if isinstance(tree, Wildcard):
+            pattern = tree.value
+            fullmatch = re.compile(".*?".join(map(re.escape, pattern.split("*"))), re.UNICODE | re.DOTALL).fullmatch
+            return lambda term: term is not None and fullmatch(term) is not None
+        elif isinstance(tree, Exists):
+            return lambda term: term is not None
+        elif isinstance(tree, Value):
+            return self._compile_value_check(tree.value, compare)
+        elif isinstance(tree, OrValues):
+            checks = [self._term_check(item, compare) for item in tree.items]
+            if all(check is not None for check in checks):
+                return _compile_any(checks)
+
+    def _compile_values(self, tree, path: Tuple[str, ...], compare: Optional[Callable] = None) -> Callable:
+        check = self._term_check(tree, compare)
+        if check is not None:
+            return _compile_any_term(path, check)
+
+        return self.walk(tree, path, compare)
+
+    def _walk_and_values(self, tree, path, compare=None):
+        return _compile_all([self._compile_values(item, path, compare) for item in tree.items])
+
+    def _walk_or_values(self, tree, path, compare=None):
+        return _compile_any([self._compile_values(item, path, compare) for item in tree.items])
+
+    def _walk_not_value(self, tree, path, compare=None):
+        expr = self._compile_values(tree.value, path, compare)
+        return lambda doc: not expr(doc)
+
+    def _walk_field_comparison(self, tree):
+        return self._compile_values(tree.value, tuple(tree.field.name.split(".")))
+
+    def _walk_field_range(self, tree):
+        return self._compile_values(tree.value, tuple(tree.field.name.split(".")), RANGE_OPERATORS[tree.operator])
+
+    def _walk_nested_query(self, tree):
+        return _compile_any_term(tuple(tree.field.name.split(".")), self.walk(tree.expr))
+
+    def _walk_not_expr(self, tree):
+        expr = self.walk(tree.expr)
+        return lambda doc: not expr(doc)
+
+    def _walk_and_expr(self, tree):
+        return _compile_all([self.walk(item) for item in tree.items])
+
+    def _walk_or_expr(self, tree):
+        return _compile_any([self.walk(item) for item in tree.items])
+
+    @classmethod
+    def filter(cls, expression):
+        return cls().walk(expression)
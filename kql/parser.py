@@ -6,6 +6,7 @@
 import contextlib
 import os
 import re
+import sys
 from typing import Optional, Set
 
 import eql
@@ -16,6 +17,7 @@ from lark.visitors import Interpreter
 
 from kql.errors import KqlParseError
 from .ast import *  # noqa: F403
+from .schema import KqlSchema, wildcard2regex  # noqa: F401
 
 
 STRING_FIELDS = ("keyword", "text")
@@ -37,12 +39,29 @@ grammar_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kql.g")
 with open(grammar_file, "rt") as f:
     grammar = f.read()
 
-lark_parser = Lark(grammar, propagate_positions=True, tree_class=KvTree, start=['query'], parser='lalr')
+# the same folder as the detection_rules caches, which DR_CACHE_DIR also moves
+PARSER_CACHE_DIR = os.getenv("DR_CACHE_DIR") or os.path.join(os.path.dirname(os.path.dirname(grammar_file)), ".cache")
 
 
-def wildcard2regex(wc: str) -> re.Pattern:
-    parts = wc.split("*")
-    return re.compile("^{regex}$".format(regex=".*?".join(re.escape(w) for w in parts)))
+def build_lark_parser(cache_dir: Optional[str] = PARSER_CACHE_DIR) -> Lark:
+    """Build the parser, loading its LALR tables from a cache file if one was saved for the same grammar and lark."""
+    options = dict(propagate_positions=True, tree_class=KvTree, start=['query'], parser='lalr')
+
+    if cache_dir:
+        # lark checks a hash of the grammar, options and lark version in the file, and rebuilds it if any changed
+        cache_file = os.path.join(cache_dir, "kql", "parser-py{}{}.lark".format(*sys.version_info[:2]))
+
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            return Lark(grammar, cache=cache_file, **options)
+        except OSError:
+            # read-only folders only lose the speedup
+            pass
+
+    return Lark(grammar, **options)
+
+
+lark_parser = build_lark_parser()
 
 
 def elasticsearch_type_family(mapping_type: str) -> str:
@@ -101,13 +120,7 @@ class BaseKqlParser(Interpreter):
         self.text = text
         self.lines = [t.rstrip("\r\n") for t in self.text.splitlines(True)]
         self.scoped_field = None
-        self.mapping_schema = schema
-        self.star_fields = []
-
-        if schema:
-            for field, field_type in schema.items():
-                if "*" in field:
-                    self.star_fields.append(wildcard2regex(field))
+        self.mapping_schema = KqlSchema.wrap(schema)
 
     def assert_lower_token(self, *tokens):
         for token in tokens:
@@ -158,10 +171,8 @@ class BaseKqlParser(Interpreter):
         self.scoped_field = None
 
     def get_field_type(self, dotted_path, lark_tree=None):
-        matches_pattern = any(regex.match(dotted_path) for regex in self.star_fields)
-
         if self.mapping_schema is not None:
-            if lark_tree is not None and dotted_path not in self.mapping_schema and not matches_pattern:
+            if lark_tree is not None and not self.mapping_schema.is_known(dotted_path):
                 raise self.error(lark_tree, "Unknown field")
 
             return self.mapping_schema.get(dotted_path)
@@ -172,17 +183,12 @@ class BaseKqlParser(Interpreter):
             return {field_type} if field_type is not None else None
 
         if self.mapping_schema is not None:
-            regex = wildcard2regex(wildcard_dotted_path)
-            field_types = set()
-
-            for field, field_type in self.mapping_schema.items():
-                if regex.fullmatch(field) is not None:
-                    field_types.add(field_type)
+            field_types = self.mapping_schema.get_wildcard_types(wildcard_dotted_path)
 
             if len(field_types) == 0:
                 raise self.error(lark_tree, "Unknown field")
 
-            return field_types
+            return set(field_types)
 
     @staticmethod
     def get_literal_type(literal_value):
@@ -284,7 +290,7 @@ class KqlParser(BaseKqlParser):
             raise self.error(lark_tree, "Expected a nested field")
 
         try:
-            self.mapping_schema = self.mapping_schema[dotted_path]
+            self.mapping_schema = KqlSchema.wrap(self.mapping_schema[dotted_path])
             yield
         finally:
             self.mapping_schema = schema
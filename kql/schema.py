@@ -0,0 +1,113 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Indexed field schemas, which resolve wildcard and unknown fields without scanning every field."""
+import bisect
+import hashlib
+import json
+import re
+from collections.abc import Mapping
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+
+def wildcard2regex(wc: str) -> re.Pattern:
+    parts = wc.split("*")
+    return re.compile("^{regex}$".format(regex=".*?".join(re.escape(w) for w in parts)))
+
+
+class KqlSchema(Mapping):
+    """Read-only mapping of dotted field names to Elasticsearch types, which can be used wherever a dict schema is.
+
+    The sorted field names and the fields which are patterns themselves (such as `labels.*`) are only indexed when first
+    needed, so that wrapping a schema is free and every parser sharing the same KqlSchema reuses the indexes.
+    """
+
+    def __init__(self, fields: Mapping, fingerprint: Optional[str] = None):
+        self.fields = fields
+        self._sorted_fields: Optional[List[str]] = None
+        self._star_fields: Optional[List[Tuple[str, re.Pattern]]] = None
+        self._wildcard_types: Dict[str, FrozenSet[str]] = {}
+        self._fingerprint = fingerprint
+
+    @classmethod
+    def wrap(cls, schema: Optional[Mapping]) -> Optional['KqlSchema']:
+        """Get a KqlSchema for a mapping, unless it already is one."""
+        if schema is None or isinstance(schema, KqlSchema):
+            return schema
+
+        return cls(schema)
+
+    def __getitem__(self, field: str):
+        return self.fields[field]
+
+    def __contains__(self, field) -> bool:
+        return field in self.fields
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def get(self, field: str, default=None):
+        return self.fields.get(field, default)
+
+    @property
+    def sorted_fields(self) -> List[str]:
+        if self._sorted_fields is None:
+            self._sorted_fields = sorted(self.fields)
+        return self._sorted_fields
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the fields and their types, to key caches by the contents of the schema.
+
+        Schemas built from known sources can be given a cheaper fingerprint of those sources instead.
+        """
+        if self._fingerprint is None:
+            encoded = json.dumps(sorted(self.fields.items()), default=str).encode("utf-8")
+            self._fingerprint = hashlib.sha256(encoded).hexdigest()
+        return self._fingerprint
+
+    @property
+    def star_fields(self) -> List[Tuple[str, re.Pattern]]:
+        """Fields with a `*`, as the literal text before the first `*` and a compiled pattern."""
+        if self._star_fields is None:
+            self._star_fields = [(field.split("*", 1)[0], wildcard2regex(field))
+                                 for field in self.fields if "*" in field]
+        return self._star_fields
+
+    def _prefixed(self, prefix: str) -> List[str]:
+        """Get the fields which start with a prefix, with a binary search of the sorted fields."""
+        fields = self.sorted_fields
+        if not prefix:
+            return fields
+
+        start = bisect.bisect_left(fields, prefix)
+        end = start
+        while end < len(fields) and fields[end].startswith(prefix):
+            end += 1
+
+        return fields[start:end]
+
+    def is_known(self, field: str) -> bool:
+        """Check if a field is in the schema, or matches one of its fields with a `*`."""
+        if field in self.fields:
+            return True
+
+        return any(field.startswith(prefix) and regex.match(field) for prefix, regex in self.star_fields)
+
+    def get_wildcard_types(self, wildcard: str) -> FrozenSet[str]:
+        """Get the types of every field which matches a field name with `*` wildcards."""
+        field_types = self._wildcard_types.get(wildcard)
+
+        if field_types is None:
+            # only the fields which share the literal prefix of the wildcard can match it
+            regex = wildcard2regex(wildcard)
+            candidates = self._prefixed(wildcard.split("*", 1)[0])
+            field_types = frozenset(self.fields[field] for field in candidates if regex.fullmatch(field) is not None)
+            self._wildcard_types[wildcard] = field_types
+
+        return field_types
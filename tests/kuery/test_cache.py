@@ -0,0 +1,84 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+import unittest
+from unittest import mock
+
+import kql
+from kql.cache import ParseCache, get_schema_key
+from kql.schema import KqlSchema
+
+
+class ParseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        kql.clear_caches()
+
+    def get_stats(self, name):
+        return next((s for s in kql.get_cache_stats() if s["name"] == name), {"hits": 0, "misses": 0})
+
+    def test_hits(self):
+        before = self.get_stats("kql.parse")
+        first = kql.parse("process.name:cmd.exe and not user.name:root")
+        second = kql.parse(b"process.name:cmd.exe and not user.name:root")
+        after = self.get_stats("kql.parse")
+
+        self.assertEqual(first, second)
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 1)
+
+        kql.parse("process.name:cmd.exe and not user.name:root", optimize=False)
+        self.assertEqual(self.get_stats("kql.parse")["misses"] - before["misses"], 2)
+
+    def test_copies(self):
+        """Ensure that changing a returned result doesn't change what later calls return."""
+        tree = kql.parse("process.name:cmd.exe")
+        tree.field.name = "changed"
+        self.assertEqual(kql.parse("process.name:cmd.exe").field.name, "process.name")
+
+        dsl = kql.to_dsl("process.name:cmd.exe")
+        dsl["bool"].clear()
+        self.assertEqual(kql.to_dsl("process.name:cmd.exe"),
+                         {"bool": {"filter": [{"match": {"process.name": "cmd.exe"}}]}})
+
+        self.assertEqual(str(kql.to_eql("process.name:cmd.exe")), str(kql.to_eql("process.name:cmd.exe")))
+        self.assertEqual(kql.lint("a:1 and a:2"), kql.lint("a:1 and a:2"))
+
+    def test_schemas(self):
+        """Ensure that schemas are keyed by their contents."""
+        self.assertIsInstance(kql.parse("a:1", schema={"a": "long"}).value, kql.ast.Number)
+        self.assertIsInstance(kql.parse("a:1", schema={"a": "keyword"}).value, kql.ast.String)
+        self.assertIsInstance(kql.parse("a:1", schema=kql.KqlSchema({"a": "keyword"})).value, kql.ast.String)
+
+        with self.assertRaises(kql.KqlParseError):
+            kql.parse("a:1", schema={"b": "keyword"})
+
+    def test_schema_keys(self):
+        """Ensure that dict schemas are only hashed the first time they're used."""
+        schema = {"a": "keyword"}
+
+        with mock.patch.object(KqlSchema, "fingerprint", new_callable=mock.PropertyMock, return_value="0") as hashed:
+            self.assertEqual(get_schema_key(schema), get_schema_key(schema))
+            self.assertEqual(hashed.call_count, 1)
+
+            get_schema_key(dict(schema))
+            self.assertEqual(hashed.call_count, 2)
+
+    def test_errors(self):
+        """Ensure that errors are raised again rather than cached."""
+        for _ in range(2):
+            with self.assertRaises(kql.KqlParseError):
+                kql.parse("a:")
+
+    def test_eviction(self):
+        cache = ParseCache("test", maxsize=2)
+        cache.put(("a", ), 1)
+        cache.put(("b", ), 2)
+        self.assertEqual(cache.get(("a", )), 1)
+
+        cache.put(("c", ), 3)
+        self.assertIsNone(cache.get(("b", )))
+        self.assertEqual(cache.get(("a", )), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
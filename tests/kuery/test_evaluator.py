@@ -4,6 +4,7 @@
 # 2.0.
 
 import unittest
+from random import Random
 
 import kql
 
@@ -121,3 +122,100 @@ class EvaluatorTests(unittest.TestCase):
         self.assertTrue(self.evaluate("structured.a.b:*"))
         self.assertTrue(self.evaluate("structured.a.b:1"))
         self.assertFalse(self.evaluate("structured.a.b:2"))
+
+
+class CompiledEvaluatorTests(EvaluatorTests):
+
+    def evaluate(self, source_text, document=None):
+        if document is None:
+            document = self.document
+
+        evaluator = kql.get_evaluator(source_text, optimize=False, compiled=True)
+        return evaluator(document)
+
+    def test_matches_filter_generator(self):
+        documents = [
+            self.document,
+            {"number": 2.0, "string": "192.168.1.1", "structured": {"a": [None, {"b": [3, "4"]}]}},
+            {"number": "1", "boolean": "true", "string_list": [["nested", "example"]], "ip": ["10.1.2.3", None]},
+            [{"number": 1}, {"number": 5}],
+            "not a document",
+        ]
+        queries = [
+            'number:1', 'number:"1"', 'number:(1 or 2)', 'number >= 1.5', 'string:192.168.0.0/16', 'ip:10.0.0.0/8',
+            'structured.a.b:(3 and "4")', 'structured.a.b:(not 1)', 'string_list:(nested or hello*)', 'ip:*',
+            'boolean:true', 'boolean:(true or "true")', 'not number:*', 'number:1 or (string:* and not ip:*)',
+            # nested queries can't be parsed yet
+            kql.ast.NestedQuery(kql.ast.Field("structured.a"), kql.parse("b:3")),
+        ]
+
+        for query in queries:
+            expected_evaluator = kql.get_evaluator(query)
+            evaluator = kql.get_evaluator(query, compiled=True)
+
+            for document in documents:
+                try:
+                    expected = expected_evaluator(document)
+                except Exception as exc:
+                    with self.assertRaises(type(exc), msg=query):
+                        evaluator(document)
+                else:
+                    self.assertEqual(evaluator(document), expected, (query, document))
+
+
+@unittest.skipIf(not kql.columnar.numpy_installed(), "numpy is not installed")
+class ColumnarEvaluatorTests(EvaluatorTests):
+
+    def evaluate(self, source_text, document=None):
+        if document is None:
+            document = self.document
+
+        evaluator = kql.get_batch_evaluator(source_text, optimize=False)
+        return bool(evaluator([document])[0])
+
+    def test_matches_filter_generator(self):
+        random = Random(7)
+        strings = ["hello world", "example", "192.168.1.1", "10.1.2.3", "1", "true", "Example", "hello"]
+        values = strings + [0, 1, 2, 1.5, 2.0, -3, True, False, None, 2 ** 60]
+
+        def random_value(depth=0):
+            roll = random.random()
+            if roll < 0.15 and depth < 2:
+                return [random_value(depth + 1) for _ in range(random.randint(0, 3))]
+            elif roll < 0.2 and depth < 2:
+                return {"b": random_value(depth + 1)}
+            return random.choice(values)
+
+        fields = ["number", "string", "ip", "structured"]
+        documents = [{field: random_value() for field in fields if random.random() < 0.8} for _ in range(500)]
+        documents.extend([[{"number": 1}, {"number": 5}], "not a document", {"structured": [None, {"b": [3, "4"]}]}])
+
+        queries = [
+            'number:1', 'number:"1"', 'number:(1 or 2)', 'number >= 1.5', 'number < 2', 'string:192.168.0.0/16',
+            'ip:10.0.0.0/8', 'structured.b:(3 and "4")', 'structured.b:(not 1)', 'string:(example or hello*)',
+            'ip:*', 'number:true', 'number:(true or "true")', 'not number:*', 'number:1 or (string:* and not ip:*)',
+            'string:(hello or "hello world")', 'string >= "hello"', 'number:null', 'string:*ample',
+            'ip:(10.0.0.0/8 or example or 192.168.1.1)', 'string:(192.168.1.0/24 and not "192.168.1.1")',
+            kql.ast.NestedQuery(kql.ast.Field("structured"), kql.parse("b:1")),
+        ]
+
+        for query in queries:
+            expected_evaluator = kql.get_evaluator(query)
+            evaluator = kql.get_batch_evaluator(query)
+            expected, first_error = [], None
+
+            for document in documents:
+                try:
+                    expected.append((document, expected_evaluator(document)))
+                except Exception as exc:
+                    first_error = first_error or exc
+
+            # documents which don't raise errors are evaluated the same way, and the first error is raised otherwise
+            table = kql.EventTable([document for document, _ in expected])
+            self.assertEqual(evaluator(table).tolist(), [bool(e) for _, e in expected], query)
+
+            if first_error is not None:
+                with self.assertRaises(type(first_error), msg=query):
+                    evaluator(documents)
+            else:
+                self.assertEqual(evaluator(documents).tolist(), [bool(e) for _, e in expected], query)
@@ -85,3 +85,56 @@ class ParserTests(unittest.TestCase):
 
         with self.assertRaises(kql.KqlParseError):
             kql.parse("@time > 5", schema=schema)
+
+    def test_type_check(self):
+        source = "num:1 and text:hello"
+        lark_tree = kql.lark_parse(source)
+
+        kql.type_check(source, {"num": "long", "text": "text"}, lark_tree=lark_tree)
+        kql.type_check(source, {"num": "keyword", "text": "keyword"}, lark_tree=lark_tree)
+
+        with self.assertRaisesRegex(kql.KqlParseError, "Unknown field"):
+            kql.type_check(source, {"num": "long"}, lark_tree=lark_tree)
+
+        with self.assertRaisesRegex(kql.KqlParseError, "Value doesn't match text's type: long"):
+            kql.type_check(source, {"num": "long", "text": "long"}, lark_tree=lark_tree)
+
+    def test_indexed_schema(self):
+        schema = {"process.name": "keyword", "process.pid": "long", "processes": "keyword", "labels.*": "keyword",
+                  "proc.name": "text", "user.name": "keyword"}
+        indexed = kql.KqlSchema(schema)
+
+        for wildcard in ("process.*", "proc*", "*.name", "process.p*d", "*", "labels.*", "missing.*"):
+            regex = kql.parser.wildcard2regex(wildcard)
+            expected = {field_type for field, field_type in schema.items() if regex.fullmatch(field)}
+            self.assertEqual(indexed.get_wildcard_types(wildcard), expected, wildcard)
+
+        self.assertTrue(indexed.is_known("labels.env"))
+        self.assertFalse(indexed.is_known("label"))
+
+        # the same schema object can be shared across parsers in place of a dict
+        self.assertEqual(kql.parse("labels.env:prod", schema=indexed), kql.parse("labels.env:prod", schema=schema))
+        self.validate("user.*:1", FieldComparison(Field("user.*"), String("1")), schema=indexed)
+
+        with self.assertRaisesRegex(kql.KqlParseError, "Unknown field"):
+            kql.parse("missing.*:1", schema=indexed)
+
+    def test_parser_cache(self):
+        """Ensure that parsers loaded from cached tables parse like new ones, even if the cache is corrupted."""
+        import os
+        import tempfile
+        from kql.parser import build_lark_parser
+
+        queries = ['process.name:cmd.exe and not user.name:(root or "admin")', 'a.b:* or c >= 1']
+        expected = [build_lark_parser(None).parse(query) for query in queries]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            build_lark_parser(cache_dir)
+            cache_file, = [os.path.join(d, f) for d, _, files in os.walk(cache_dir) for f in files]
+
+            self.assertEqual([build_lark_parser(cache_dir).parse(query) for query in queries], expected)
+
+            with open(cache_file, "wb") as f:
+                f.write(b"corrupted")
+
+            self.assertEqual([build_lark_parser(cache_dir).parse(query) for query in queries], expected)
@@ -24,6 +24,11 @@ from rta import get_ttp_names
 from .base import BaseRuleTest
 
 
+def swap_types(schema) -> dict:
+    """Swap the string and numeric field types of a KQL schema, so that most queries no longer type check."""
+    return {field: "long" if es_type == "keyword" else "keyword" for field, es_type in schema.items()}
+
+
 class TestValidRules(BaseRuleTest):
     """Test that all detection rules load properly without duplicates."""
 
@@ -55,6 +60,47 @@ class TestValidRules(BaseRuleTest):
                               f'Expected: {optimized}\nActual: {source}'
                 self.assertEqual(tree, optimized, err_message)
 
+    def test_queries_parsed_once(self):
+        """Ensure that queries parsed once convert and type check as eql and kql do when parsing them every time."""
+        from detection_rules import ecs
+        from detection_rules.rule_validators import EQLValidator, KQLValidator, get_unique_schemas, type_check_eql
+
+        swapped_schemas = {}
+
+        for rule in self.production_rules:
+            data = rule.contents.data
+            if not isinstance(data, QueryRuleData):
+                continue
+
+            if data.language == "kuery":
+                self.assertEqual(KQLValidator(data.query).ast, kql.parse(data.query), self.rule_str(rule))
+                continue
+            elif data.language != "eql":
+                continue
+
+            validator = EQLValidator(data.query)
+            with eql.parser.elasticsearch_syntax, eql.parser.ignore_missing_functions:
+                self.assertEqual(validator.ast, eql.parse_query(data.query), self.rule_str(rule))
+
+            # one schema is enough to compare the conversion with, along with one that the query doesn't match
+            schema, _, _ = get_unique_schemas(data, rule.contents.metadata, validator.ast)[0]
+
+            if schema.fingerprint not in swapped_schemas:
+                swapped_schemas[schema.fingerprint] = ecs.KqlSchema2Eql(swap_types(schema))
+
+            for eql_schema in (ecs.get_kql_schema2eql(schema), swapped_schemas[schema.fingerprint]):
+                outcomes = []
+
+                for check in (lambda: type_check_eql(*validator.parsed), lambda: eql.parse_query(data.query)):
+                    try:
+                        with eql_schema, eql.parser.elasticsearch_syntax, eql.parser.ignore_missing_functions:
+                            check()
+                        outcomes.append(None)
+                    except eql.EqlError as exc:
+                        outcomes.append((type(exc), str(exc)))
+
+                self.assertEqual(outcomes[0], outcomes[1], self.rule_str(rule))
+
     def test_production_rules_have_rta(self):
         """Ensure that all production rules have RTAs."""
         mappings = load_etc_dump('rule-mapping.yml')
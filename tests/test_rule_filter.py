@@ -0,0 +1,74 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Test compiled rule filters."""
+import unittest
+
+from detection_rules.rule_filter import compile_filter
+from detection_rules.rule_loader import dict_filter
+
+from .base import BaseRuleTest
+
+
+class TestRuleFilter(unittest.TestCase):
+    """Test compiling and evaluating filters."""
+
+    rule = {
+        "metadata": {"maturity": "production"},
+        "rule": {
+            "name": "Suspicious PowerShell Execution",
+            "risk_score": 47,
+            "tags": ["Elastic", "Windows"],
+            "threat": [{"tactic": {"id": "TA0002"}}, {"tactic": {"id": "TA0005"}}],
+            "type": "eql",
+        }
+    }
+
+    def assert_matches(self, spec, expected=True, **kwargs):
+        self.assertEqual(compile_filter(spec, **kwargs)(self.rule), expected, spec)
+
+    def test_values(self):
+        """Test equality and membership, including values in lists."""
+        self.assert_matches({"metadata.maturity": "production"})
+        self.assert_matches({"rule__type": ["query", "eql"]})
+        self.assert_matches({"rule.tags": "Windows"})
+        self.assert_matches({"rule.tags": "windows"}, False)
+        self.assert_matches({"rule.tags": "windows"}, case_sensitive=False)
+        self.assert_matches({"rule.threat.tactic.id": "TA0005"})
+        self.assert_matches({"rule.missing": "value"}, False)
+        self.assert_matches({"rule.missing": {"exists": False}})
+
+    def test_all_criteria(self):
+        """Ensure that every criteria is checked, not only the first one."""
+        self.assert_matches({"metadata.maturity": "production", "rule.type": "query"}, False)
+        self.assertFalse(dict_filter(metadata__maturity="production", rule__type="query")(self.rule))
+        self.assertTrue(dict_filter(metadata__maturity="production", rule__type="eql")(self.rule))
+
+    def test_operators(self):
+        """Test pattern and range operators and logical combinations."""
+        self.assert_matches({"rule.name": {"glob": "*PowerShell*"}})
+        self.assert_matches({"rule.name": {"glob": "*powershell*"}}, False)
+        self.assert_matches({"rule.name": {"regex": "^Suspicious"}})
+        self.assert_matches({"rule.risk_score": {"gte": 47, "lt": 73}})
+        self.assert_matches({"rule.risk_score": {"gt": 47}}, False)
+        self.assert_matches({"rule.name": {"gt": 47}}, False)
+        self.assert_matches({"or": [{"rule.type": "query"}, {"rule.tags": "Windows"}]})
+        self.assert_matches({"not": {"rule.type": "eql"}}, False)
+        self.assert_matches([{"rule.type": "eql"}, {"and": {"rule.tags": "Elastic"}}])
+
+        with self.assertRaises(ValueError):
+            compile_filter({"rule.name": {"like": "*"}})
+
+
+class TestPackageFilter(BaseRuleTest):
+    """Test filtering rules for packages."""
+
+    def test_filter_rule(self):
+        """Ensure that package filters are case-insensitive and check the flattened rule."""
+        from detection_rules.packaging import filter_rule
+
+        rule = self.production_rules.rules[0]
+        self.assertTrue(filter_rule(rule, {"maturity": ["Production"], "rule_id": [rule.id]}))
+        self.assertFalse(filter_rule(rule, {"maturity": ["production"], "rule_id": ["missing"]}))
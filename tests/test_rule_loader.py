@@ -0,0 +1,346 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Test rule collection loading."""
+import re
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import kql
+
+from detection_rules.rule import LazyTOMLRule, TOMLRule
+from detection_rules.rule_cache import RuleCache
+from detection_rules.rule_index import RuleIndex
+from detection_rules.rule_loader import DEFAULT_DEPRECATED_DIR, DEFAULT_RULES_DIR, RuleCollection, RuleStore
+from detection_rules.utils import git, git_blob_id
+
+
+class TestRuleLoading(unittest.TestCase):
+    """Test the different ways of loading a rule collection."""
+
+    @classmethod
+    def setUpClass(cls):
+        # copy a handful of rules so they are never shared with the default collection
+        cls.temp_dir = Path(tempfile.mkdtemp())
+        sources = sorted((DEFAULT_RULES_DIR / 'network').glob('*.toml'))[:6]
+        sources += sorted(DEFAULT_DEPRECATED_DIR.glob('*.toml'))[:2]
+
+        for source in sources:
+            shutil.copy(source, cls.temp_dir / source.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+
+    def test_parallel_matches_serial(self):
+        """Ensure that loading rules across processes matches loading them serially."""
+        serial = RuleCollection()
+        serial.load_directory(self.temp_dir)
+
+        parallel = RuleCollection()
+        parallel.load_directory(self.temp_dir, processes=2)
+
+        self.assertEqual([r.path for r in serial], [r.path for r in parallel])
+        self.assertEqual([r.contents for r in serial], [r.contents for r in parallel])
+        self.assertEqual(sorted(serial.deprecated.id_map), sorted(parallel.deprecated.id_map))
+        self.assertEqual(parallel.errors, {})
+
+    def test_parallel_errors(self):
+        """Ensure that errors from worker processes are collected and raised."""
+        broken = self.temp_dir / 'broken' / 'broken_rule.toml'
+        broken.parent.mkdir(exist_ok=True)
+        broken.write_text('[metadata]\nmaturity = "production"\n\n[rule]\nname = "broken"\n')
+
+        try:
+            rules = RuleCollection()
+            with self.assertRaises(Exception):
+                rules.load_directory(self.temp_dir, processes=2)
+
+            self.assertIn(broken.resolve(), rules.errors)
+            self.assertEqual(len(rules.errors), 1)
+        finally:
+            shutil.rmtree(broken.parent)
+
+    def test_parallel_query_errors(self):
+        """Ensure that errors are sent back from worker processes, rather than loading the files again."""
+        source = self.temp_dir / 'command_and_control_dns_directly_to_the_internet.toml'
+        broken = self.temp_dir / 'broken' / 'broken_query.toml'
+        broken.parent.mkdir(exist_ok=True)
+        broken.write_text(re.sub(r"(?s)query = '{3}.*?'{3}", "query = 'process.name:'", source.read_text()))
+
+        try:
+            rules = RuleCollection()
+            with mock.patch.object(RuleCollection, 'load_file', side_effect=AssertionError), \
+                    self.assertRaises(kql.KqlParseError):
+                rules.load_directory(broken.parent, processes=2)
+
+            timed = RuleCollection()
+            with mock.patch.object(RuleCollection, 'load_file', side_effect=AssertionError):
+                timings = timed.load_directory_timed(broken.parent, processes=2)
+
+            self.assertIsInstance(timed.errors[broken.resolve()], kql.KqlParseError)
+            self.assertEqual(timings[0].error, f'KqlParseError: {timed.errors[broken.resolve()]}')
+        finally:
+            shutil.rmtree(broken.parent)
+
+    def test_timed_loading(self):
+        """Ensure that timed loading collects every error along with the time spent on each rule."""
+        broken = self.temp_dir / 'broken' / 'broken_rule.toml'
+        broken.parent.mkdir(exist_ok=True)
+        broken.write_text('[metadata]\nmaturity = "production"\n\n[rule]\nname = "broken"\n')
+
+        try:
+            rules = RuleCollection()
+            timings = rules.load_directory_timed(self.temp_dir, processes=2)
+
+            self.assertEqual([t.path for t in timings], sorted(t.path for t in timings))
+            self.assertEqual(len(timings), len(rules) + len(rules.deprecated) + 1)
+            self.assertEqual([t.path for t in timings if t.error], [broken.resolve()])
+            self.assertEqual(list(rules.errors), [broken.resolve()])
+
+            for timing in timings:
+                self.assertGreaterEqual(timing.elapsed,
+                                        sum(timing.languages.values()) + sum(timing.cached_validation.values()))
+                self.assertLessEqual(set(timing.languages) | set(timing.cached_validation), {'eql', 'kql'})
+        finally:
+            shutil.rmtree(broken.parent)
+
+    def test_rule_cache(self):
+        """Ensure that cached rules are reused until the rule or fingerprint changes."""
+        cache_dir = self.temp_dir / 'cache'
+
+        try:
+            cold = RuleCollection(cache=RuleCache(cache_dir))
+            cold.load_directory(self.temp_dir)
+            self.assertEqual(cold.cache.hits, 0)
+
+            warm = RuleCollection(cache=RuleCache(cache_dir))
+            warm.load_directory(self.temp_dir)
+            self.assertEqual(warm.cache.misses, 0)
+            self.assertEqual([r.contents for r in cold], [r.contents for r in warm])
+
+            parallel = RuleCollection(cache=RuleCache(cache_dir))
+            parallel.load_directory(self.temp_dir, processes=2)
+            self.assertEqual(parallel.cache.misses, 0)
+
+            changed_fingerprint = RuleCollection(cache=RuleCache(cache_dir, fingerprint='0' * 64))
+            changed_fingerprint.load_directory(self.temp_dir)
+            self.assertEqual(changed_fingerprint.cache.hits, 0)
+            self.assertEqual([r.contents for r in cold], [r.contents for r in changed_fingerprint])
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_unwritable_rule_cache(self):
+        """Ensure that rules are still loaded when the cache folder can't be created."""
+        blocker = self.temp_dir / 'blocker'
+        blocker.write_text('')
+
+        try:
+            rules = RuleCollection(cache=RuleCache(blocker / 'cache'))
+            rules.load_directory(self.temp_dir)
+            self.assertEqual(rules.cache.hits, 0)
+            self.assertEqual(rules.errors, {})
+            self.assertTrue(len(rules))
+        finally:
+            blocker.unlink()
+
+    def test_reload_changes(self):
+        """Ensure that only added, modified and deleted files are reloaded while watching a directory."""
+        watch_dir = self.temp_dir / 'watch'
+        watch_dir.mkdir()
+        first, second = sorted(self.temp_dir.glob('*.toml'))[:2]
+        shutil.copy(first, watch_dir / first.name)
+
+        try:
+            rules = RuleCollection()
+            rules.watch_directory(watch_dir)
+            self.assertEqual(len(rules), 1)
+            self.assertEqual(rules.reload_changes(), [])
+
+            shutil.copy(second, watch_dir / second.name)
+            changes = rules.reload_changes()
+            self.assertEqual([(c.status, c.path.name) for c in changes], [('added', second.name)])
+            self.assertEqual(len(rules), 2)
+
+            modified = watch_dir / second.name
+            modified.write_text(modified.read_text().replace('maturity = "production"', 'maturity = "development"'))
+            changes = rules.reload_changes()
+            self.assertEqual([(c.status, c.path.name) for c in changes], [('modified', second.name)])
+            self.assertEqual(rules.file_map[modified.resolve()].contents.metadata.maturity, 'development')
+
+            modified.write_text('[metadata]\n')
+            changes = rules.reload_changes()
+            self.assertIsNotNone(changes[0].error)
+            self.assertIn(modified.resolve(), rules.errors)
+            self.assertEqual(len(rules), 1)
+
+            modified.unlink()
+            changes = rules.reload_changes()
+            self.assertEqual([(c.status, c.path.name) for c in changes], [('deleted', second.name)])
+            self.assertEqual(rules.errors, {})
+            self.assertEqual(len(rules.id_map), 1)
+
+            # dangling links, such as editor lock files, and files deleted after they're listed are skipped
+            lock_file = watch_dir / f'.#{first.name}'
+            lock_file.symlink_to(watch_dir / 'missing.toml')
+            self.assertEqual(rules.reload_changes(), [])
+            lock_file.unlink()
+
+            listed = rules._get_paths(watch_dir) + [watch_dir / second.name]
+            with mock.patch.object(rules, '_get_paths', return_value=listed):
+                self.assertEqual(rules.reload_changes(), [])
+
+            # a file which is deleted after it was found to be changed, but before it's loaded
+            watched = (watch_dir / first.name).resolve()
+            with mock.patch.object(Path, 'stat', side_effect=[watched.stat(), FileNotFoundError(watched)]):
+                rules._file_stats[watched] = (0, 0)
+                changes = rules.reload_changes()
+            self.assertEqual([(c.status, c.path.name) for c in changes], [('deleted', first.name)])
+            self.assertEqual(len(rules), 0)
+        finally:
+            shutil.rmtree(watch_dir, ignore_errors=True)
+
+    def test_rule_index(self):
+        """Ensure that the rule index finds rules by ID and name and is refreshed as files change."""
+        index_file = self.temp_dir / 'index' / 'rule-index.json'
+        rules = RuleCollection()
+        rules.load_directory(self.temp_dir)
+        rule = rules.rules[0]
+
+        try:
+            index = RuleIndex(self.temp_dir, index_file=index_file)
+            self.assertTrue(index.refresh())
+            self.assertEqual(index.get_paths(rule_ids=[rule.id]), [rule.path])
+            self.assertEqual(index.get_paths(names=[rule.name]), [rule.path])
+
+            # a saved index is reused without re-reading unchanged files
+            index = RuleIndex(self.temp_dir, index_file=index_file)
+            self.assertFalse(index.refresh())
+
+            renamed = rule.path.with_name('renamed_rule.toml')
+            rule.path.rename(renamed)
+            self.assertTrue(index.refresh())
+            self.assertEqual(index.get_paths(rule_ids=[rule.id]), [renamed])
+            renamed.rename(rule.path)
+        finally:
+            shutil.rmtree(index_file.parent, ignore_errors=True)
+
+    def test_unwritable_rule_index(self):
+        """Ensure that rules are still found when the index can't be saved or read."""
+        blocker = self.temp_dir / 'blocker'
+        blocker.write_text('')
+        rules = RuleCollection()
+        rules.load_directory(self.temp_dir)
+        rule = rules.rules[0]
+
+        try:
+            index = RuleIndex(self.temp_dir, index_file=blocker / 'index' / 'rule-index.json')
+            self.assertTrue(index.refresh())
+            self.assertEqual(index.get_paths(rule_ids=[rule.id]), [rule.path])
+
+            # a corrupted index is rebuilt
+            blocker.write_text('[]')
+            index = RuleIndex(self.temp_dir, index_file=blocker)
+            self.assertEqual(index.entries, {})
+            self.assertTrue(index.refresh())
+            self.assertEqual(index.get_paths(rule_ids=[rule.id]), [rule.path])
+        finally:
+            blocker.unlink()
+
+    def test_rule_store(self):
+        """Ensure that revisions loaded into a store share identical rules but not their version locks."""
+        path = sorted(self.temp_dir.glob('*.toml'))[0]
+        self.assertEqual(git_blob_id(path.read_bytes()), git('hash-object', str(path)))
+
+        store = RuleStore()
+        first = store.load_directory(self.temp_dir, recursive=False)
+        second = store.load_directory(self.temp_dir, recursive=False)
+
+        self.assertEqual(len(store), len(first) + len(first.deprecated))
+        for rule in first:
+            shared = second.id_map[rule.id]
+            self.assertIs(rule.contents.data, shared.contents.data)
+            self.assertIsNot(rule.contents, shared.contents)
+
+        self.assertEqual(first.compare_collections(second), ({}, {}, {}))
+
+    def test_query(self):
+        """Ensure that querying the collection indexes matches filtering the rules."""
+        rules = RuleCollection()
+        rules.load_directory(self.temp_dir)
+        rule = rules.rules[0]
+        tag = rule.contents.data.tags[0]
+
+        expected = [r for r in rules if r.contents.data.type == rule.contents.data.type and tag in r.contents.data.tags]
+        self.assertEqual(list(rules.query(type=rule.contents.data.type, tags=[tag.upper()])), expected)
+        self.assertEqual(list(rules.query()), list(rules))
+        self.assertEqual(list(rules.query(maturity='unknown')), [])
+
+        with self.assertRaises(ValueError):
+            rules.query(unknown_field='value')
+
+        # indexes are kept up to date as rules are removed and added back
+        rules.remove_file(rule.path)
+        self.assertNotIn(rule, rules.query(tags=tag))
+        rules.add_rule(rule)
+        self.assertIn(rule, rules.query(tags=tag))
+
+    def test_lazy_loading(self):
+        """Ensure that lazy rules are only validated when their contents are needed."""
+        rules = RuleCollection()
+        rules.load_directory(self.temp_dir, recursive=False)
+
+        lazy = RuleCollection(lazy=True)
+        lazy.load_directory(self.temp_dir, recursive=False)
+        self.assertTrue(all(isinstance(r, LazyTOMLRule) for r in lazy))
+        self.assertEqual([(r.id, r.name, r.path) for r in rules], [(r.id, r.name, r.path) for r in lazy])
+        self.assertEqual(sorted(rules.deprecated.id_map), sorted(lazy.deprecated.id_map))
+
+        # metadata and indexes don't need the rule validated
+        rule = rules.rules[0]
+        self.assertEqual(lazy.rules[0].metadata, rule.contents.metadata)
+        self.assertEqual([r.id for r in lazy.query(type=rule.contents.data.type)],
+                         [r.id for r in rules.query(type=rule.contents.data.type)])
+        self.assertEqual([r.to_dict() for r in lazy], [r.contents.to_dict() for r in rules])
+        self.assertFalse(any(r.validated for r in lazy))
+
+        lazy.validate()
+        self.assertTrue(all(isinstance(r, TOMLRule) for r in lazy))
+        self.assertEqual([r.contents for r in rules], [r.contents for r in lazy])
+
+    def test_lazy_errors(self):
+        """Ensure that invalid lazy rules only fail when they are validated."""
+        broken = self.temp_dir / 'broken' / 'broken_rule.toml'
+        broken.parent.mkdir(exist_ok=True)
+        broken.write_text('[metadata]\nmaturity = "production"\n\n[rule]\nname = "broken"\nrule_id = "broken"\n')
+
+        try:
+            rules = RuleCollection(lazy=True)
+            rules.load_directory(broken.parent)
+            self.assertEqual(rules.rules[0].name, 'broken')
+
+            with self.assertRaises(Exception):
+                rules.validate()
+
+            self.assertIn(broken.resolve(), rules.errors)
+        finally:
+            shutil.rmtree(broken.parent)
+
+    def test_compact(self):
+        """Ensure that compact collections share repeated strings without changing the rules."""
+        rules = RuleCollection()
+        rules.load_directory(self.temp_dir, recursive=False)
+
+        compact = RuleCollection(compact=True)
+        compact.load_directory(self.temp_dir, recursive=False)
+        self.assertEqual([r.contents for r in rules], [r.contents for r in compact])
+        self.assertEqual(compact._toml_load_cache, {})
+
+        first, second = compact.rules[:2]
+        self.assertIs(first.contents.metadata.maturity, second.contents.metadata.maturity)
+        self.assertIs(first.contents.data.author[0], second.contents.data.author[0])
@@ -0,0 +1,138 @@
+# Copyright Elasticsearch B.V. and/or licensed to Elasticsearch B.V. under one
+# or more contributor license agreements. Licensed under the Elastic License
+# 2.0; you may not use this file except in compliance with the Elastic License
+# 2.0.
+
+"""Test matching events against many rules at once."""
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import kql
+from kql.ast import AndExpr, FieldComparison, OrValues, String
+from kql.errors import KqlRuntimeError
+
+from detection_rules.devtools import get_benchmark_events
+from detection_rules.rule_matcher import CompiledRule, RuleMatcher, get_anchor, iter_event_file
+from detection_rules.rule_validators import EQLValidator, KQLValidator
+
+from .base import BaseRuleTest
+
+
+def build_event(tree) -> dict:
+    """Build an event which satisfies a query of literal comparisons, or return None."""
+    event = {}
+
+    for term in tree.items if isinstance(tree, AndExpr) else [tree]:
+        if not isinstance(term, FieldComparison) or "*" in term.field.name:
+            return
+
+        value = term.value.items[0] if isinstance(term.value, OrValues) else term.value
+        if not isinstance(value, String):
+            return
+
+        *parents, leaf = term.field.name.split(".")
+        document = event
+        for key in parents:
+            document = document.setdefault(key, {})
+            if not isinstance(document, dict):
+                return
+
+        document[leaf] = value.value
+
+    return event
+
+
+class TestRuleMatcher(BaseRuleTest):
+    """Test the multi-rule matcher against evaluating every rule."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.matcher = RuleMatcher(cls.production_rules)
+
+    def test_supported_rules(self):
+        """Ensure that every rule is either compiled or reported as unsupported."""
+        compiled = {c.rule.id for c in self.matcher.rules}
+        self.assertEqual(compiled | set(self.matcher.unsupported), {r.id for r in self.production_rules})
+        self.assertFalse(compiled & set(self.matcher.unsupported))
+        self.assertTrue(any(c.rule.contents.data.language == "eql" for c in self.matcher.rules))
+
+    def test_matches(self):
+        """Ensure that the index never changes which rules an event matches."""
+        events = get_benchmark_events(200)
+        events.extend(filter(None, (build_event(c.rule.contents.data.ast) for c in self.matcher.rules
+                                    if c.rule.contents.data.language == "kuery")))
+
+        expected = {}
+        for event in events:
+            for compiled in self.matcher.rules:
+                try:
+                    if compiled.evaluator(event):
+                        expected.setdefault(compiled.rule.id, []).append(event)
+                except (KqlRuntimeError, TypeError, ValueError):
+                    pass
+
+        self.assertTrue(expected)
+        self.assertEqual(self.matcher.match(events), expected)
+
+    def test_errors(self):
+        """Ensure that events which can't be evaluated are counted with the first error of each rule."""
+        rule = self.matcher.rules[0].rule
+        matcher = RuleMatcher([])
+        matcher.add(CompiledRule(rule, mock.Mock(side_effect=[TypeError("first"), TypeError("second")])))
+
+        self.assertEqual(matcher.match([{}, {}]), {})
+        self.assertEqual(matcher.errors, {rule.id: 2})
+        self.assertEqual(str(matcher.first_errors[rule.id]), "first")
+
+    def test_case_insensitive(self):
+        """Ensure that EQL `:` comparisons ignore case on both sides, unlike `==` and KQL comparisons."""
+        queries = {
+            "insensitive": ("eql", 'process where process.name : ("cmd.exe", "Power*.exe") and process.pid == 4'),
+            "sensitive": ("eql", 'process where process.name == "cmd.exe"'),
+            "kql": ("kuery", "process.name:cmd.exe"),
+        }
+        validators = {"eql": EQLValidator, "kuery": KQLValidator}
+        rules = [SimpleNamespace(id=rule_id, contents=SimpleNamespace(data=SimpleNamespace(
+            type="query", language=language, ast=validators[language](query).ast)))
+            for rule_id, (language, query) in queries.items()]
+        matcher = RuleMatcher(rules)
+
+        events = [{"event": {"category": "process"}, "process": {"name": name, "pid": 4}}
+                  for name in ("cmd.exe", "CMD.EXE", ["other", "POWERSHELL.exe"], "power.exe.bak")]
+        matches = matcher.match(events)
+
+        self.assertEqual(matcher.errors, {})
+        self.assertEqual(matches["insensitive"], events[:3])
+        self.assertEqual(matches["sensitive"], events[:1])
+        self.assertEqual(matches["kql"], events[:1])
+
+    def test_anchor(self):
+        """Test choosing the field to index a query by."""
+        tree = kql.parse('event.category:process and process.name:(cmd.exe or "pwsh.exe") and process.pid:4')
+        self.assertEqual(get_anchor(tree), ("process.name", frozenset(["cmd.exe", "pwsh.exe"])))
+        self.assertEqual(get_anchor(kql.parse("event.category:process and process.pid:4")),
+                         ("event.category", frozenset(["process"])))
+        self.assertIsNone(get_anchor(kql.parse("process.name:cmd* or process.pid:4")))
+        self.assertIsNone(get_anchor(kql.parse("destination.ip:10.0.0.0/8")))
+
+    def test_event_files(self):
+        """Test reading events from json and jsonl files."""
+        events = [{"event": {"category": "process"}}, {"process": {"name": "cmd.exe"}}]
+
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl_path = Path(directory) / "events.jsonl"
+            jsonl_path.write_text("\n".join(json.dumps(e) for e in events) + "\n\n")
+            json_path = Path(directory) / "events.json"
+            json_path.write_text(json.dumps({"source": events}))
+
+            self.assertEqual(list(iter_event_file(jsonl_path)), events)
+            self.assertEqual(list(iter_event_file(json_path)), events)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,8 +5,11 @@
 
 """Test stack versioned schemas."""
 import copy
+import tempfile
 import unittest
 import uuid
+from pathlib import Path
+from unittest import mock
 
 import eql
 
@@ -223,6 +226,215 @@ class TestSchemas(unittest.TestCase):
                     process where process.pid == "some string field"
             """)
 
+    def test_validation_cache(self):
+        """Ensure that saved validation outcomes are reused, and saved errors are raised again exactly."""
+        from detection_rules.rule_cache import ValidationCache
+        from detection_rules.rule_validators import EQLValidator
+
+        contents = TOMLRuleContents.from_dict({
+            "metadata": {"creation_date": "1970/01/01", "updated_date": "1970/01/01", "min_stack_version": "8.0.0"},
+            "rule": dict(self.v78_kql, author=["Elastic"], license="Elastic License v2")
+        })
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = ValidationCache(directory=temp_dir, fingerprint="0" * 64)
+            validator = EQLValidator('process where process.pid == "some string field"')
+
+            with self.assertRaises(eql.EqlTypeMismatchError) as first:
+                cache.validate(validator, contents.data, contents.metadata)
+
+            with mock.patch.object(EQLValidator, "validate") as validate, \
+                    self.assertRaises(eql.EqlTypeMismatchError) as second:
+                cache.validate(validator, contents.data, contents.metadata)
+
+            validate.assert_not_called()
+            self.assertEqual(str(first.exception), str(second.exception))
+
+            validator = EQLValidator('process where process.name == "cmd.exe"')
+            cache.validate(validator, contents.data, contents.metadata)
+            cache.validate(validator, contents.data, contents.metadata)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+            # an unwritable cache folder still validates every query
+            blocker = Path(temp_dir) / "blocker"
+            blocker.write_text("")
+            unwritable = ValidationCache(directory=blocker / "cache", fingerprint="0" * 64)
+
+            for _ in range(2):
+                with self.assertRaises(eql.EqlTypeMismatchError):
+                    unwritable.validate(EQLValidator('process where process.pid == "some string field"'),
+                                        contents.data, contents.metadata)
+            self.assertEqual((unwritable.hits, unwritable.misses), (0, 2))
+
+    def test_unique_schemas(self):
+        """Ensure that stack versions with identical schemas are only validated once."""
+        from detection_rules.rule_validators import get_unique_schemas, schema_validation_counts
+
+        contents = TOMLRuleContents.from_dict({
+            "metadata": {"creation_date": "1970/01/01", "updated_date": "1970/01/01", "min_stack_version": "7.13.0"},
+            "rule": dict(self.v78_kql, author=["Elastic"], license="Elastic License v2")
+        })
+        stack_versions = contents.metadata.get_validation_stack_versions()
+        skipped = schema_validation_counts['skipped']
+
+        unique_schemas = get_unique_schemas(contents.data, contents.metadata, contents.data.ast)
+        trailers = [line for _, _, trailer in unique_schemas for line in trailer.splitlines()]
+
+        self.assertLess(len(unique_schemas), len(stack_versions))
+        self.assertEqual(sorted(trailers), sorted(f"stack: {v}, beats: {m['beats']}, ecs: {m['ecs']}"
+                                                  for v, m in stack_versions.items()))
+        self.assertEqual(schema_validation_counts['skipped'] - skipped, len(stack_versions) - len(unique_schemas))
+
+    def test_same_fields_schemas(self):
+        """Ensure that ECS versions with different files but the same fields are only validated once."""
+        from detection_rules import ecs
+        from detection_rules.rule_validators import get_unique_schemas
+
+        contents = TOMLRuleContents.from_dict({
+            "metadata": {"creation_date": "1970/01/01", "updated_date": "1970/01/01", "min_stack_version": "7.13.0"},
+            "rule": dict(self.v78_kql, author=["Elastic"], license="Elastic License v2", index=["logs-*"])
+        })
+        stack_versions = contents.metadata.get_validation_stack_versions()
+        ecs_versions = sorted({m['ecs'] for m in stack_versions.values()})
+        self.assertGreater(len(ecs_versions), 1)
+        self.assertGreater(len(get_unique_schemas(contents.data, contents.metadata, contents.data.ast)), 1)
+
+        # every version reads the same fields from its own file
+        fields = ecs.get_schema(ecs_versions[-1])
+        utils.clear_caches()
+
+        try:
+            with mock.patch.object(ecs, 'get_schema_artifact', return_value=None), \
+                    mock.patch.object(ecs, 'get_schema', return_value=fields):
+                fingerprints = {ecs.get_kql_schema_fingerprint(version, ["logs-*"]) for version in ecs_versions}
+                unique_schemas = get_unique_schemas(contents.data, contents.metadata, contents.data.ast)
+                schema = ecs.get_kql_schema(ecs_versions[0], ["logs-*"])
+        finally:
+            utils.clear_caches()
+
+        self.assertEqual(len(fingerprints), 1)
+        self.assertEqual(len(unique_schemas), 1)
+        self.assertEqual(len(unique_schemas[0][2].splitlines()), len(stack_versions))
+        self.assertEqual(schema.fingerprint, fingerprints.pop())
+
+    def test_eql_schemas(self):
+        """Ensure that EQL schemas are shared between identical KQL schemas and type check as eql does."""
+        from eql.parser import LarkToEQL
+        from detection_rules import ecs
+        from detection_rules.rule_validators import parse_eql_tree, type_check_eql
+
+        schema = ecs.get_kql_schema(indexes=["logs-*"])
+        eql_schema = ecs.get_kql_schema2eql(schema)
+        self.assertIs(ecs.get_kql_schema2eql(ecs.KqlSchema(dict(schema), fingerprint=schema.fingerprint)), eql_schema)
+
+        # schemas built from the JSON schemas share a fingerprint with those built from the artifacts
+        with mock.patch.object(ecs, 'get_schema_artifact', return_value=None):
+            from_json = ecs.get_kql_schema.__wrapped__(indexes=["logs-*"])
+        self.assertEqual(dict(from_json), dict(schema))
+        self.assertIs(ecs.get_kql_schema2eql(from_json), eql_schema)
+        self.assertEqual(eql_schema.get_event_type_hint("process", ["process", "pid"]),
+                         (eql.types.TypeHint.Numeric, None))
+        self.assertIsNone(eql_schema.get_event_type_hint("process", ["process", "missing"]))
+
+        queries = ('process where process.name == "cmd.exe" and process.`pid` > 4',
+                   'sequence [process where process.args : "a*"] [network where true]',
+                   'process where process.pid == "4"',
+                   'process where process.missing == "4"',
+                   'process where process.while == "4"')
+
+        for query in queries:
+            outcomes = []
+            text, lark_tree = parse_eql_tree(query)
+
+            for converter in (LarkToEQL, None):
+                kwargs = {"converter": converter} if converter else {}
+                try:
+                    with eql_schema, eql.parser.elasticsearch_syntax:
+                        type_check_eql(text, lark_tree, **kwargs)
+                    outcomes.append(None)
+                except eql.EqlParseError as exc:
+                    outcomes.append((type(exc), str(exc)))
+
+            self.assertEqual(outcomes[0], outcomes[1], query)
+
+    def test_schema_artifacts(self):
+        """Ensure that precompiled schema artifacts match the JSON schemas, and are ignored once stale."""
+        from detection_rules import ecs
+        from detection_rules.schema_artifacts import hash_fields, load_artifact
+
+        version = ecs.resolve_version()
+        source_hash = utils.hash_files(ecs.get_artifact_sources(version))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = ecs.build_schema_artifact(version, directory=temp_dir)
+            artifact = load_artifact(path, source_hash)
+            self.assertIsNotNone(artifact)
+
+            try:
+                expected = ecs.flatten_multi_fields(ecs.get_schema(version))
+                fields = artifact.get('ecs')
+                self.assertEqual(fields.to_dict(), expected)
+                self.assertEqual(dict(fields), expected)
+                self.assertEqual(fields['process.name'], expected['process.name'])
+                self.assertNotIn('process.missing', fields)
+                self.assertEqual(fields.fields_hash, hash_fields(expected))
+                self.assertEqual(artifact.get('index:endgame-*').to_dict(),
+                                 ecs.flatten(ecs.get_index_schema('endgame-*')))
+
+                with mock.patch.object(ecs, 'get_schema_artifact', return_value=artifact):
+                    from_artifact = ecs.get_kql_schema.__wrapped__(version, indexes=['endgame-*'])
+                with mock.patch.object(ecs, 'get_schema_artifact', return_value=None):
+                    from_json = ecs.get_kql_schema.__wrapped__(version, indexes=['endgame-*'])
+
+                self.assertNotIsInstance(from_artifact.fields, dict)
+                self.assertEqual(dict(from_artifact), dict(from_json))
+                self.assertEqual(from_artifact.fingerprint, from_json.fingerprint)
+            finally:
+                artifact.close()
+
+            self.assertIsNone(load_artifact(path, '0' * 64))
+            path.write_bytes(path.read_bytes()[:100])
+            self.assertIsNone(load_artifact(path, source_hash))
+
+    def test_beats_shards(self):
+        """Ensure that beats schemas split by beat and module have the same fields as the full schema."""
+        import json
+        from detection_rules import beats
+
+        tree = beats.read_beats_schema()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_dir = beats.build_beats_shards(directory=temp_dir)
+            shards = shard_dir, json.loads((shard_dir / 'index.json').read_text())
+
+            for beat in ('filebeat', 'winlogbeat'):
+                self.assertEqual(beats.get_sharded_root_schema(shards, beat), beats.get_beat_root_schema(tree, beat))
+
+            for args in (('aws', ), ('aws', 'aws.cloudtrail', 's3access'), ('missing', )):
+                self.assertEqual(beats.get_sharded_sub_schema(shards, 'filebeat', *args),
+                                 beats.get_beats_sub_schema(tree, 'filebeat', *args))
+
+            with self.assertRaises(KeyError):
+                beats.get_sharded_root_schema(shards, 'missingbeat')
+
+            # rebuilding replaces the shards at once and leaves no temp folders behind
+            self.assertEqual(beats.build_beats_shards(directory=temp_dir), shard_dir)
+            self.assertEqual(list(Path(temp_dir).iterdir()), [shard_dir])
+
+    def test_beats_shards_workers(self):
+        """Ensure that worker processes fall back to the full schema rather than building shards."""
+        from detection_rules import beats
+
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(beats, 'BEATS_SHARDS_DIR', Path(temp_dir)), \
+                mock.patch.object(beats.multiprocessing, 'parent_process', return_value=object()):
+            beats.get_beats_shards.clear()
+            try:
+                self.assertIsNone(beats.get_beats_shards())
+                self.assertEqual(list(Path(temp_dir).iterdir()), [])
+            finally:
+                beats.get_beats_shards.clear()
+
 
 class TestVersions(unittest.TestCase):
     """Test that schema versioning aligns."""
@@ -5,10 +5,16 @@
 
 """Test util time functions."""
 import random
+import tempfile
+import threading
 import time
 import unittest
+from pathlib import Path
+from unittest import mock
 
-from detection_rules.utils import normalize_timing_and_sort, cached
+from detection_rules import utils
+from detection_rules.utils import (cached, git, git_ls_blobs, hash_files, hash_files_cached, identity_key,
+                                   normalize_timing_and_sort, read_git_blobs)
 from detection_rules.eswrap import RtaEvents
 from detection_rules.ecs import get_kql_schema
 
@@ -66,6 +72,17 @@ class TestTimeUtils(unittest.TestCase):
         self.assertEqual(schema.get("process.name"), "keyword")
         self.assertEqual(schema.get("process.name.text"), "text")
 
+    def test_lazy_schema_loading(self):
+        """Test that getting a schema only reads the file for that version."""
+        from detection_rules import ecs
+
+        ecs.get_schema.clear()
+        with mock.patch.object(ecs, 'read_schema', wraps=ecs.read_schema) as read_schema:
+            ecs.get_schema('1.12.0')
+            ecs.get_schema('1.12.0')
+
+        read_schema.assert_called_once_with('1.12.0', 'ecs_flat')
+
     def test_caching(self):
         """Test that caching is working."""
         counter = 0
@@ -101,3 +118,82 @@ class TestTimeUtils(unittest.TestCase):
         self.assertEqual(increment(), 6)
         self.assertEqual(increment(None), 7)
         self.assertEqual(increment(1), 8)
+
+    def test_bounded_caching(self):
+        """Test that bounded caches evict the least recently used results."""
+        calls = []
+
+        @cached(maxsize=2)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual([square(1), square(2), square(1), square(3)], [1, 4, 1, 9])
+        self.assertEqual(calls, [1, 2, 3])
+
+        # 2 was the least recently used, so it was evicted for 3
+        self.assertEqual([square(1), square(2)], [1, 4])
+        self.assertEqual(calls, [1, 2, 3, 2])
+        self.assertEqual(square.cache.stats(), {'name': square.cache.name, 'hits': 2, 'misses': 4, 'evictions': 2,
+                                                'size': 2, 'maxsize': 2})
+
+    def test_cache_keys(self):
+        """Test caching by the identity of arguments, instead of their frozen values."""
+        @cached(key=identity_key)
+        def copy(obj):
+            return dict(obj)
+
+        first, second = {'a': [1]}, {'a': [1]}
+        self.assertIs(copy(first), copy(first))
+        self.assertIsNot(copy(first), copy(second))
+        self.assertEqual(copy.cache.stats()['hits'], 2)
+
+        @cached(key=lambda obj: obj['id'])
+        def lookup(obj):
+            return obj['name']
+
+        self.assertEqual(lookup({'id': 1, 'name': 'first'}), 'first')
+        self.assertEqual(lookup({'id': 1, 'name': 'second'}), 'first')
+
+
+class TestHashFiles(unittest.TestCase):
+    """Test hashing files."""
+
+    def test_hash_files_cached(self):
+        """Ensure that saved hashes are only reused while the files are unchanged."""
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(utils, 'CACHE_DIR', temp_dir):
+            path = Path(temp_dir) / 'source.json'
+            path.write_text('{"a": 1}')
+            self.assertEqual(hash_files_cached([path]), hash_files([path]))
+
+            with mock.patch.object(utils, 'hash_files') as hash_files_mock:
+                hash_files_cached([path])
+            hash_files_mock.assert_not_called()
+
+            path.write_text('{"a": 12}')
+            self.assertEqual(hash_files_cached([path]), hash_files([path]))
+
+
+class TestGitUtils(unittest.TestCase):
+    """Test git helper functions."""
+
+    def test_read_git_blobs(self):
+        """Ensure that batched blob reads match reading files one at a time."""
+        blobs = git_ls_blobs('HEAD', 'rules')
+        paths = sorted(blobs)[:5]
+        contents = dict(read_git_blobs(blobs[path] for path in paths))
+
+        for path in paths:
+            self.assertEqual(contents[blobs[path]].decode('utf-8').rstrip(), git('show', f'HEAD:{path}'))
+
+    def test_abandon_read_git_blobs(self):
+        """Ensure that stopping after the first blob doesn't wait on git to write the rest."""
+        # request more object IDs than fit in the stdin and stdout pipes
+        blobs = git_ls_blobs('HEAD', 'rules')
+        reader = read_git_blobs(sorted(blobs.values()) * 20)
+        next(reader)
+
+        closer = threading.Thread(target=reader.close, daemon=True)
+        closer.start()
+        closer.join(timeout=30)
+        self.assertFalse(closer.is_alive())